@@ -8,7 +8,8 @@ from django.contrib import messages
 from django.utils import timezone
 from django.db import transaction
 from django import forms
-from .models import ChargingPile, ChargingRequest, ChargingSession, SystemParameter, Notification
+from .counters import refresh_counters, station_counters
+from .models import ChargingPile, ChargingRequest, ChargingSession, SystemParameter, Notification, PileStatusEvent
 from decimal import Decimal
 from django.http import JsonResponse
 from django.utils.safestring import mark_safe
@@ -171,10 +172,7 @@ class ChargingPileAdmin(admin.ModelAdmin):
     def queue_status_display(self, obj):
         """显示队列状态摘要"""
         queue_count = obj.get_queue_count()
-        current_charging = ChargingRequest.objects.filter(
-            charging_pile=obj,
-            current_status='charging'
-        ).first()
+        current_charging = obj.get_current_request()
         
         status_parts = []
         if current_charging:
@@ -191,10 +189,7 @@ class ChargingPileAdmin(admin.ModelAdmin):
     
     def current_charging_display(self, obj):
         """显示当前充电详情"""
-        current_charging = ChargingRequest.objects.filter(
-            charging_pile=obj,
-            current_status='charging'
-        ).first()
+        current_charging = obj.get_current_request()
         
         if current_charging:
             progress = (current_charging.current_amount / current_charging.requested_amount) * 100
@@ -220,16 +215,13 @@ class ChargingPileAdmin(admin.ModelAdmin):
     
     def queue_detail_display(self, obj):
         """显示详细队列信息"""
-        queue_requests = ChargingRequest.objects.filter(
-            charging_pile=obj,
-            queue_level='pile_queue'
-        ).order_by('pile_queue_position')[:5]  # 显示前5个
+        queue_requests = obj.get_queued_requests(5)  # 显示前5个
         
-        if not queue_requests.exists():
+        if not queue_requests:
             return format_html('<span style="color: #6c757d;">队列为空</span>')
         
         html_parts = ['<div style="padding: 10px; background: #fff3cd; border-radius: 5px;">']
-        html_parts.append(f'<strong>队列容量：</strong> {queue_requests.count()}/{obj.max_queue_size}<br>')
+        html_parts.append(f'<strong>队列容量：</strong> {len(queue_requests)}/{obj.max_queue_size}<br>')
         html_parts.append('<strong>队列详情：</strong><br>')
         
         for req in queue_requests:
@@ -243,16 +235,30 @@ class ChargingPileAdmin(admin.ModelAdmin):
                 f'</span><br>'
             )
         
-        if queue_requests.count() >= 5:
+        if len(queue_requests) >= 5:
             html_parts.append('<span style="color: #6c757d; margin-left: 10px;">...</span>')
         
         html_parts.append('</div>')
         return format_html(''.join(html_parts))
     queue_detail_display.short_description = '队列详情'
     
-    # 按类型分组显示
+    # 按类型分组显示，并预取每个桩的当前充电请求和队列
     def get_queryset(self, request):
-        return super().get_queryset(request).order_by('pile_type', 'pile_id')
+        return super().get_queryset(request).with_queue_details().order_by('pile_type', 'pile_id')
+    
+    def save_model(self, request, obj, form, change):
+        """修改充电桩状态时记录状态变更事件，进度守护进程据此立即处理故障或恢复"""
+        previous_status = form.initial.get('status') if change else None
+        super().save_model(request, obj, form, change)
+        if change and 'status' in form.changed_data and previous_status != obj.status:
+            PileStatusEvent.objects.create(
+                pile=obj,
+                from_status=previous_status,
+                to_status=obj.status,
+                source='admin',
+                reason=f'管理员 {request.user.username} 修改'
+            )
+        refresh_counters([obj.pile_type])
 
 @admin.register(ChargingRequest)
 class ChargingRequestAdmin(admin.ModelAdmin):
@@ -383,20 +389,11 @@ class ChargingRequestAdmin(admin.ModelAdmin):
             self._complete_charging(charging_request)
     
     def _complete_charging(self, charging_request):
-        """完成充电"""
-        from .services import BillingService, AdvancedChargingQueueService
+        """完成充电（队列服务在同一事务中结算费用并释放充电桩）"""
+        from .services import AdvancedChargingQueueService
         
-        with transaction.atomic():
-            # 使用新的队列服务完成充电
-            queue_service = AdvancedChargingQueueService()
-            queue_service.complete_charging(charging_request)
-            
-            # 计算费用
-            if hasattr(charging_request, 'session'):
-                session = charging_request.session
-                billing_service = BillingService()
-                billing_service.calculate_bill(session)
-                session.save()
+        queue_service = AdvancedChargingQueueService()
+        queue_service.complete_charging(charging_request)
     
     # Admin Actions
     def update_progress_5kwh(self, request, queryset):
@@ -486,26 +483,23 @@ class QueueStatusView:
     
     def changelist_view(self, request, extra_context=None):
         """队列状态总览页面"""
-        from .services import AdvancedChargingQueueService
-        from .models import ChargingPile, ChargingRequest
-        
-        # 获取队列服务
-        queue_service = AdvancedChargingQueueService()
+        from .snapshots import queue_status_snapshot
         
-        # 获取快充和慢充的队列状态
-        fast_status = queue_service.get_queue_status('fast')
-        slow_status = queue_service.get_queue_status('slow')
+        # 获取快充和慢充的队列状态（队列未变化时使用缓存的快照）
+        fast_status = queue_status_snapshot('fast')
+        slow_status = queue_status_snapshot('slow')
         
-        # 系统统计
+        # 系统统计（调度事件维护的计数）
+        counters = station_counters()
         stats = {
-            'total_piles': ChargingPile.objects.count(),
-            'working_piles': ChargingPile.objects.filter(is_working=True).count(),
-            'fault_piles': ChargingPile.objects.filter(status='fault').count(),
-            'offline_piles': ChargingPile.objects.filter(status='offline').count(),
-            'total_waiting': ChargingRequest.objects.filter(current_status='waiting').count(),
-            'total_charging': ChargingRequest.objects.filter(current_status='charging').count(),
-            'external_waiting': ChargingRequest.objects.filter(queue_level='external_waiting').count(),
-            'pile_queue_waiting': ChargingRequest.objects.filter(queue_level='pile_queue').count(),
+            'total_piles': counters['total_piles'],
+            'working_piles': counters['working_piles'],
+            'fault_piles': counters['fault_piles'],
+            'offline_piles': counters['offline_piles'],
+            'total_waiting': counters['waiting'],
+            'total_charging': counters['charging'],
+            'external_waiting': counters['external_waiting'],
+            'pile_queue_waiting': counters['pile_queue_waiting'],
         }
         
         extra_context = extra_context or {}
@@ -521,11 +515,10 @@ class QueueStatusView:
     
     def refresh_view(self, request):
         """刷新队列状态的AJAX接口"""
-        from .services import AdvancedChargingQueueService
+        from .snapshots import queue_status_snapshot
         
-        queue_service = AdvancedChargingQueueService()
-        fast_status = queue_service.get_queue_status('fast')
-        slow_status = queue_service.get_queue_status('slow')
+        fast_status = queue_status_snapshot('fast')
+        slow_status = queue_status_snapshot('slow')
         
         return JsonResponse({
             'fast_status': fast_status,
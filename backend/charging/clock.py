@@ -0,0 +1,97 @@
+"""
+可替换的时钟
+
+进度守护进程、充电进度计算和排队服务通过注入的时钟读取业务时间（开始、结束充电的时刻和计费时长），
+默认使用 timezone.now。使用加速时钟或虚拟时钟时，守护进程把 clock.now 传给排队服务和进度计算，
+等待也改用时钟的 sleep()，数小时的充电过程可以在几秒内回放完毕。
+
+记录的 updated_at 等维护字段仍使用真实时间：其他进程按自己的时间把它们与水位比较。
+时钟只影响显式传入它的对象，不修改进程内的 timezone.now()。
+"""
+
+import time
+from abc import ABC, abstractmethod
+from datetime import timedelta
+
+from django.utils import timezone
+
+
+class Clock(ABC):
+    """时钟接口：now() 返回当前时间，monotonic() 返回单调秒数，sleep() 等待指定的时钟秒数"""
+
+    @abstractmethod
+    def now(self):
+        pass
+
+    @abstractmethod
+    def monotonic(self):
+        pass
+
+    @abstractmethod
+    def sleep(self, seconds):
+        pass
+
+
+class SystemClock(Clock):
+    """真实时钟"""
+
+    def now(self):
+        return timezone.now()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class ScaledClock(Clock):
+    """加速时钟：从 origin 开始按 scale 倍速流逝，sleep() 的真实等待时间相应缩短"""
+
+    def __init__(self, scale, origin=None):
+        if scale <= 0:
+            raise ValueError('时钟倍速必须大于0')
+        self.scale = scale
+        self.origin = origin or timezone.now()
+        self._started = time.monotonic()
+
+    def monotonic(self):
+        return (time.monotonic() - self._started) * self.scale
+
+    def now(self):
+        return self.origin + timedelta(seconds=self.monotonic())
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.scale)
+
+
+class VirtualClock(Clock):
+    """虚拟时钟：时间只在 sleep()/advance() 时前进，sleep() 立即返回
+
+    处理本身不消耗虚拟时间，回放速度只取决于数据库操作的速度。
+    """
+
+    def __init__(self, origin=None):
+        self.origin = origin or timezone.now()
+        self.current = self.origin
+
+    def now(self):
+        return self.current
+
+    def monotonic(self):
+        return (self.current - self.origin).total_seconds()
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.current += timedelta(seconds=seconds)
+
+    def advance_to(self, minutes):
+        """前进到相对起点的指定分钟数（不会回退）"""
+        self.current = max(self.current, self.origin + timedelta(minutes=minutes))
+
+    def minutes(self, moment):
+        """时间点相对起点的分钟数"""
+        return (moment - self.origin).total_seconds() / 60
@@ -0,0 +1,120 @@
+"""
+充电站计数
+
+公开状态接口和管理后台总览需要等待、充电、各级队列人数以及各状态充电桩数量。
+这些计数保存在 StationCounter 中（每种充电模式一行）：
+
+- 调度事件写回队列状态时，在同一事务中按内存中的完整队列状态写入该模式的计数（绝对值，不会累积误差）；
+- 在调度事件之外修改充电桩（状态接口、管理后台、同步命令）后重新统计该模式的计数。
+
+读取方通过进程内缓存读取全站合计，缓存过期后只有一个请求访问数据库，其余并发请求等待并共享结果。
+"""
+
+import threading
+import time
+
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .models import ChargingPile, ChargingRequest, StationCounter
+
+COUNTER_FIELDS = (
+    'waiting', 'charging', 'external_waiting', 'pile_queue_waiting',
+    'total_piles', 'working_piles', 'fault_piles', 'offline_piles',
+)
+
+CHARGING_MODES = [mode for mode, _ in ChargingRequest.MODE_CHOICES]
+
+# 进程内缓存的有效期（秒）
+CACHE_SECONDS = 1.0
+
+
+def record_counters(charging_mode, counters):
+    """在调用方的事务中写入某个模式的计数"""
+    updated = StationCounter.objects.filter(charging_mode=charging_mode).update(**counters)
+    if not updated:
+        counter, created = StationCounter.objects.get_or_create(charging_mode=charging_mode, defaults=counters)
+        if not created:
+            StationCounter.objects.filter(charging_mode=charging_mode).update(**counters)
+
+
+def count_mode(charging_mode):
+    """从数据库重新统计某个模式的计数（两条聚合查询）"""
+    counters = ChargingPile.objects.filter(pile_type=charging_mode).aggregate(
+        total_piles=Count('pk'),
+        working_piles=Count('pk', filter=Q(is_working=True)),
+        fault_piles=Count('pk', filter=Q(status='fault')),
+        offline_piles=Count('pk', filter=Q(status='offline')),
+    )
+    counters.update(ChargingRequest.objects.filter(
+        charging_mode=charging_mode, current_status__in=['waiting', 'charging']
+    ).aggregate(
+        waiting=Count('pk', filter=Q(current_status='waiting')),
+        charging=Count('pk', filter=Q(current_status='charging')),
+        external_waiting=Count('pk', filter=Q(queue_level='external_waiting')),
+        pile_queue_waiting=Count('pk', filter=Q(queue_level='pile_queue')),
+    ))
+    return counters
+
+
+def refresh_counters(charging_modes=None):
+    """重新统计并写入指定模式（默认全部模式）的计数"""
+    with transaction.atomic():
+        for charging_mode in charging_modes or CHARGING_MODES:
+            record_counters(charging_mode, count_mode(charging_mode))
+
+
+def read_counters():
+    """读取全站合计（一条查询）；缺少计数行的模式先从数据库统计并补写"""
+    rows = {
+        row['charging_mode']: row
+        for row in StationCounter.objects.values('charging_mode', *COUNTER_FIELDS)
+    }
+    missing = [mode for mode in CHARGING_MODES if mode not in rows]
+    if missing:
+        refresh_counters(missing)
+        rows.update({
+            row['charging_mode']: row
+            for row in StationCounter.objects.filter(charging_mode__in=missing).values('charging_mode', *COUNTER_FIELDS)
+        })
+    return {field: sum(row[field] for row in rows.values()) for field in COUNTER_FIELDS}
+
+
+class CoalescedCache:
+    """有效期内直接返回缓存值；过期后只有一个线程调用 load()，并发的其他线程等待并共享结果"""
+
+    def __init__(self, load, ttl=CACHE_SECONDS):
+        self._load = load
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entry = None
+
+    def _fresh(self):
+        entry = self._entry
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry
+        return None
+
+    def get(self):
+        entry = self._fresh()
+        if entry is not None:
+            return entry[1]
+        with self._lock:
+            # 等锁期间其他线程可能已经完成加载
+            entry = self._fresh()
+            if entry is None:
+                entry = (time.monotonic(), self._load())
+                self._entry = entry
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entry = None
+
+
+counters_cache = CoalescedCache(read_counters)
+
+
+def station_counters():
+    """全站计数（进程内缓存，最多延迟 CACHE_SECONDS 秒）"""
+    return counters_cache.get()
@@ -0,0 +1,377 @@
+"""
+排队事件推送
+
+客户端通过一条 Server-Sent Events 长连接接收排队变化，代替轮询 request/status/、requests/active/ 和 notifications/。
+
+- EventBroker：进程内的发布/订阅。服务层在调度事件提交后发布到充电站主题和受影响用户的主题。
+- QueueVersionWatcher：守护进程和其他 Web 进程中发生的变化无法直接发布到本进程，
+  每个进程一个监视任务定期读取队列版本（两条查询），版本变化后按 updated_at 水位找出受影响的用户并发布。
+- UserEventStream：单个连接的推送状态。收到充电站主题时推送排队快照的增量，
+  收到用户主题时推送该用户请求的变化和新通知；通知事件带 id，断线重连时按 Last-Event-ID 补发。
+
+浏览器的 EventSource 无法设置请求头：客户端先用令牌换取短期票据（签名中带用途，只能用于建立推送连接），
+再把票据放进查询参数，令牌本身不会出现在 URL 和访问日志中。
+
+request/status/wait/ 长轮询使用同一个发布/订阅：等待方订阅用户主题，收到通知后重新读取请求状态，
+状态版本（内容摘要）与客户端上次看到的不同才返回。
+
+推送和长轮询依赖异步视图，只能在 ASGI 服务器下使用。等待期间不占用数据库连接：
+每次读取结束后立即关闭本线程的连接。
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ChargingRequest, Notification
+from .queue_state import ACTIVE_STATUSES
+from .serialiazers import ActiveChargingRequestSerializer
+from .snapshots import queue_status_snapshot, snapshot_version
+
+STATION_TOPIC = 'station'
+
+# 无事件时发送心跳注释的间隔，同时用于尽快发现已断开的连接
+KEEPALIVE_SECONDS = 15
+
+# 跨进程变化的检查间隔
+WATCH_INTERVAL = 1.0
+
+# 水位回退的秒数，覆盖事务提交顺序与 updated_at 时间的偏差
+WATERMARK_LAG = 5
+
+# 长轮询的默认和最大等待时间（秒）
+LONG_POLL_TIMEOUT = 30
+MAX_LONG_POLL_TIMEOUT = 60
+
+# 推送票据的有效期（秒），只用于建立连接；签名的 salt 限定票据的用途
+EVENT_TICKET_MAX_AGE = 30
+EVENT_TICKET_SALT = 'charging.events.ticket'
+
+# 推送给客户端的请求字段
+REQUEST_FIELDS = (
+    'id', 'queue_number', 'charging_mode', 'current_status', 'queue_level',
+    'external_queue_position', 'pile_queue_position', 'charging_pile_id',
+    'estimated_wait_time', 'requested_amount', 'current_amount',
+)
+
+
+def user_topic(user_id):
+    return f'user:{user_id}'
+
+
+def released(func):
+    """把数据库读取包装为协程：在同步线程中执行，结束后关闭该线程的连接，长时间等待期间不占用连接"""
+    def call(*args):
+        try:
+            return func(*args)
+        finally:
+            # 事务中（如测试用例）不能关闭连接
+            if not connection.in_atomic_block:
+                connection.close()
+    return sync_to_async(call)
+
+
+def issue_event_ticket(user):
+    """签发只能用于建立推送连接的短期票据"""
+    return signing.dumps({'user': user.pk}, salt=EVENT_TICKET_SALT)
+
+
+def event_ticket_user_id(ticket):
+    """校验推送票据，返回用户ID；签名不符、用途不符或已过期时返回 None"""
+    try:
+        return signing.loads(ticket, salt=EVENT_TICKET_SALT, max_age=EVENT_TICKET_MAX_AGE)['user']
+    except (signing.BadSignature, KeyError, TypeError):
+        return None
+
+
+def format_event(event, data, event_id=None):
+    """按 SSE 格式编码一条事件"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    """一个连接的订阅：事件进入所在事件循环的队列，可以从任意线程投递"""
+
+    def __init__(self, broker, topics, maxsize=256):
+        self.broker = broker
+        self.topics = frozenset(topics)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, topic, payload):
+        self.loop.call_soon_threadsafe(self._put, topic, payload)
+
+    def _put(self, topic, payload):
+        # 事件只是变化的信号，积压时丢弃不影响推送内容：连接处理时会重新读取最新状态
+        if not self.queue.full():
+            self.queue.put_nowait((topic, payload))
+
+    async def wait(self, timeout):
+        """等待至少一条事件，返回此刻积压的所有事件；超时返回空列表"""
+        try:
+            first = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        messages = [first]
+        while not self.queue.empty():
+            messages.append(self.queue.get_nowait())
+        return messages
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class EventBroker:
+    """进程内的发布/订阅"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, *topics):
+        subscription = Subscription(self, topics)
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def publish(self, topic, payload=None):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscription in subscribers:
+            subscription.put(topic, payload)
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def subscribed_user_ids(self):
+        with self._lock:
+            return {int(topic.split(':', 1)[1]) for topic in self._subscribers if topic.startswith('user:')}
+
+
+broker = EventBroker()
+
+
+def publish_queue_change(charging_mode, user_ids=()):
+    """服务层在调度事件提交后调用：通知充电站主题和受影响用户"""
+    broker.publish(STATION_TOPIC, charging_mode)
+    for user_id in user_ids:
+        broker.publish(user_topic(user_id), charging_mode)
+
+
+def changed_user_ids(since, user_ids):
+    """水位之后请求或通知有变化的用户（只在已订阅的用户中查找）"""
+    if not user_ids:
+        return set()
+    changed = set(ChargingRequest.objects.filter(
+        user_id__in=user_ids, updated_at__gte=since
+    ).values_list('user_id', flat=True).distinct())
+    changed.update(Notification.objects.filter(
+        user_id__in=user_ids, created_at__gte=since
+    ).values_list('user_id', flat=True).distinct())
+    return changed
+
+
+class QueueVersionWatcher:
+    """发现其他进程中的变化并发布到本进程的订阅者
+
+    每个进程只运行一个监视任务，没有订阅者时自动退出，下一个连接建立时重新启动。
+    """
+
+    def __init__(self, broker, interval=WATCH_INTERVAL):
+        self.broker = broker
+        self.interval = interval
+        self._task = None
+
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    def stop_if_idle(self):
+        """最后一个连接关闭时立即停止监视任务"""
+        if self._task is not None and not self._task.done() and not self.broker.has_subscribers():
+            self._task.cancel()
+
+    async def _run(self):
+        version = watermark = None
+        while self.broker.has_subscribers():
+            started = timezone.now()
+            current = await released(snapshot_version)()
+            if version is not None and current != version:
+                self.broker.publish(STATION_TOPIC)
+                user_ids = await released(changed_user_ids)(watermark, self.broker.subscribed_user_ids())
+                for user_id in user_ids:
+                    self.broker.publish(user_topic(user_id))
+            if current != version:
+                # 水位只在检查用户之后前进，版本不变期间的修改会在下一次版本变化时一并找到
+                version = current
+                watermark = started - timedelta(seconds=WATERMARK_LAG)
+            await asyncio.sleep(self.interval)
+
+
+watcher = QueueVersionWatcher(broker)
+
+
+def snapshot_delta(old, new):
+    """两次排队快照之间的变化：各模式变化的汇总字段、变化的充电桩和移除的充电桩"""
+    delta = {}
+    for mode, data in new.items():
+        before = old.get(mode, {})
+        changes = {key: value for key, value in data.items() if key != 'piles' and before.get(key) != value}
+        old_piles = {pile['pile_id']: pile for pile in before.get('piles', [])}
+        piles = [pile for pile in data.get('piles', []) if old_piles.get(pile['pile_id']) != pile]
+        removed = sorted(set(old_piles) - {pile['pile_id'] for pile in data.get('piles', [])})
+        if piles:
+            changes['piles'] = piles
+        if removed:
+            changes['removed_piles'] = removed
+        if changes:
+            delta[mode] = changes
+    return delta
+
+
+class UserEventStream:
+    """单个连接的推送状态：上一次推送的排队快照、用户请求和通知游标"""
+
+    def __init__(self, user, last_event_id=None):
+        self.user = user
+        self.station = {}
+        self.requests = {}
+        self.notification_cursor = last_event_id
+
+    def _load_requests(self, extra_ids=()):
+        return {
+            row['id']: row
+            for row in ChargingRequest.objects.filter(
+                Q(current_status__in=ACTIVE_STATUSES) | Q(pk__in=extra_ids), user=self.user
+            ).values(*REQUEST_FIELDS)
+        }
+
+    def initial_events(self):
+        """连接建立时的完整快照，以及断线期间错过的通知"""
+        self.station = queue_status_snapshot()
+        self.requests = self._load_requests()
+        events = [format_event('snapshot', {
+            'station': self.station,
+            'requests': list(self.requests.values()),
+        })]
+        if self.notification_cursor is None:
+            latest = Notification.objects.filter(user=self.user).order_by('-id').values_list('id', flat=True).first()
+            self.notification_cursor = latest or 0
+        else:
+            events.extend(self.notification_events())
+        return events
+
+    def station_events(self):
+        station = queue_status_snapshot()
+        delta = snapshot_delta(self.station, station)
+        self.station = station
+        return [format_event('station', delta)] if delta else []
+
+    def request_events(self):
+        requests = self._load_requests(extra_ids=list(self.requests))
+        changed = [row for pk, row in requests.items() if self.requests.get(pk) != row]
+        # 已结束的请求推送一次最终状态后不再跟踪
+        self.requests = {pk: row for pk, row in requests.items() if row['current_status'] in ACTIVE_STATUSES}
+        return [format_event('request', {'requests': changed})] if changed else []
+
+    def notification_events(self):
+        events = []
+        for notification in Notification.objects.filter(
+            user=self.user, id__gt=self.notification_cursor
+        ).order_by('id').values('id', 'type', 'message', 'created_at'):
+            events.append(format_event(notification['type'], notification, event_id=notification['id']))
+            self.notification_cursor = notification['id']
+        return events
+
+    def changes(self, topics):
+        events = []
+        if STATION_TOPIC in topics:
+            events.extend(self.station_events())
+        if user_topic(self.user.pk) in topics:
+            events.extend(self.request_events())
+            events.extend(self.notification_events())
+        return events
+
+
+async def queue_event_stream(user, last_event_id=None, keepalive=KEEPALIVE_SECONDS):
+    """单个用户的 SSE 事件流"""
+    subscription = broker.subscribe(STATION_TOPIC, user_topic(user.pk))
+    try:
+        watcher.ensure_running()
+        stream = UserEventStream(user, last_event_id)
+        for event in await released(stream.initial_events)():
+            yield event
+
+        while True:
+            messages = await subscription.wait(keepalive)
+            if not messages:
+                yield ': keepalive\n\n'
+                continue
+            topics = {topic for topic, _ in messages}
+            for event in await released(stream.changes)(topics):
+                yield event
+    finally:
+        subscription.close()
+        watcher.stop_if_idle()
+
+
+def request_version(data):
+    """请求状态数据的版本（内容摘要）"""
+    encoded = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(encoded.encode()).hexdigest()
+
+
+def read_request_status(user):
+    """用户当前活跃请求的状态数据（与 request/status/ 相同，没有活跃请求时为 None）及其版本"""
+    charging_request = ChargingRequest.objects.active_for(user).first()
+    data = ActiveChargingRequestSerializer(charging_request).data if charging_request else None
+    return request_version(data), data
+
+
+async def wait_for_request_change(user, version=None, timeout=LONG_POLL_TIMEOUT):
+    """等待用户请求的状态版本不同于 version，返回 (版本, 数据, 是否变化)
+
+    先订阅再读取，读取之后发生的变化不会丢失。超时返回当前数据且不再读取数据库。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    subscription = broker.subscribe(user_topic(user.pk))
+    try:
+        watcher.ensure_running()
+        while True:
+            current, data = await released(read_request_status)(user)
+            if current != version:
+                return current, data, True
+            # 通知只说明可能有变化（也可能是其他请求字段或通知），重新读取后比较版本
+            if not await subscription.wait(deadline - loop.time()):
+                return current, data, False
+    finally:
+        subscription.close()
+        watcher.stop_if_idle()
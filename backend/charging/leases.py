@@ -0,0 +1,125 @@
+"""
+充电桩租约分片
+
+多个进度守护进程同时运行时，每个进程通过 pile_lease 表认领一部分充电桩，
+只处理自己持有租约的桩。持有者每次心跳续约；进程退出时主动释放，
+进程失联时租约过期，由其他进程在下一次心跳时接管。
+
+认领使用带条件的 UPDATE（只更新已过期或未分配的行），
+多个进程同时认领同一个桩时只有一个能成功。
+"""
+
+import math
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ChargingPile, PileLease, PileLeaseHolder
+
+
+def default_worker_id():
+    """默认进程标识：主机名:进程号"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class PileLeaseManager:
+    """单个守护进程的充电桩租约"""
+
+    def __init__(self, holder=None, ttl=30):
+        self.holder = holder or default_worker_id()
+        self.ttl = ttl
+        # 最近一次心跳后持有的充电桩ID
+        self.held = set()
+        # 心跳发现的持有变化：asyncio 模式下心跳与故障检测、完成定时器在不同线程中运行，
+        # 心跳只在锁内记录变化，由各任务在下一轮开始时取走处理，不直接修改它们的状态
+        self._changes_lock = threading.Lock()
+        self._lost = set()
+        self._rescan = False
+        self._resync = False
+
+    def heartbeat(self):
+        """续约并按公平份额认领或释放充电桩，返回当前持有的充电桩ID集合"""
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=self.ttl)
+        self._ensure_leases(now)
+
+        # 续约：只续仍在有效期内的租约，已过期的可能已被其他进程接管
+        PileLease.objects.filter(holder=self.holder, expires_at__gte=now).update(
+            expires_at=expires_at, heartbeat_at=now
+        )
+
+        # 公平份额按当前存活的进程数计算（包括尚未持有任何桩的进程）
+        PileLeaseHolder.objects.update_or_create(holder=self.holder, defaults={'expires_at': expires_at})
+        PileLeaseHolder.objects.filter(expires_at__lt=now).delete()
+        share = math.ceil(PileLease.objects.count() / PileLeaseHolder.objects.count())
+
+        mine = sorted(
+            PileLease.objects.filter(holder=self.holder, expires_at__gte=now).values_list('pile_id', flat=True)
+        )
+        claimable = Q(expires_at__lt=now) | Q(holder='')
+        if len(mine) < share:
+            candidates = list(
+                PileLease.objects.filter(claimable)
+                .order_by('pile_id')
+                .values_list('pile_id', flat=True)[:share - len(mine)]
+            )
+            if candidates:
+                # 条件更新：其他进程已抢先认领的行不会被覆盖
+                PileLease.objects.filter(claimable, pile_id__in=candidates).update(
+                    holder=self.holder, expires_at=expires_at, heartbeat_at=now, acquired_at=now
+                )
+        elif len(mine) > share:
+            # 新进程加入后释放超出份额的部分，由新进程认领
+            PileLease.objects.filter(holder=self.holder, pile_id__in=mine[share:]).update(
+                holder='', expires_at=now
+            )
+
+        previous = self.held
+        self.held = set(
+            PileLease.objects.filter(holder=self.holder, expires_at__gt=now).values_list('pile_id', flat=True)
+        )
+        if self.held != previous:
+            # 持有的桩变化后重新同步完成定时器，并全量检查一次新获得的桩
+            with self._changes_lock:
+                self._lost |= previous - self.held
+                self._rescan = True
+                self._resync = True
+        return self.held
+
+    def take_scan_changes(self):
+        """取走上次调用以来失去的充电桩，以及故障检测是否需要全量扫描"""
+        with self._changes_lock:
+            lost, self._lost = self._lost, set()
+            rescan, self._rescan = self._rescan, False
+        return lost, rescan
+
+    def take_timer_resync(self):
+        """取走完成定时器是否需要重新同步"""
+        with self._changes_lock:
+            resync, self._resync = self._resync, False
+        return resync
+
+    def owned(self, queryset, field='pk'):
+        """只保留持有租约的充电桩相关记录（field 为指向充电桩的字段）"""
+        return queryset.filter(**{f'{field}__in': list(self.held)})
+
+    def release_all(self):
+        """释放本进程持有的全部租约（进程正常退出时调用）"""
+        PileLease.objects.filter(holder=self.holder).update(holder='', expires_at=timezone.now())
+        PileLeaseHolder.objects.filter(holder=self.holder).delete()
+        self.held = set()
+
+    def _ensure_leases(self, now):
+        """为新增的充电桩补建租约行"""
+        existing = set(PileLease.objects.values_list('pile_id', flat=True))
+        missing = [
+            PileLease(pile_id=pile_id, expires_at=now)
+            for pile_id in ChargingPile.objects.values_list('pile_id', flat=True)
+            if pile_id not in existing
+        ]
+        if missing:
+            PileLease.objects.bulk_create(missing, ignore_conflicts=True)
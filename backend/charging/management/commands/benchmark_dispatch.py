@@ -0,0 +1,183 @@
+from django.core.management.base import BaseCommand, CommandError
+from charging.utils import dispatch_optimizer
+from charging.utils.parameter_manager import get_charging_pile_config, get_queue_config
+from collections import deque
+import heapq
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = '对比 greedy 与 batch_optimal 调度策略的平均等待时间、吞吐量和求解耗时（内存模拟，不读写业务数据）'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--mode',
+            choices=['fast', 'slow'],
+            default='fast',
+            help='充电模式，决定默认的桩数量、功率和队列容量'
+        )
+        parser.add_argument('--piles', type=int, default=None, help='充电桩数量（默认使用系统参数）')
+        parser.add_argument(
+            '--powers',
+            type=str,
+            default=None,
+            help='逗号分隔的各桩功率(kW)，用于模拟功率不同的桩，指定后忽略 --piles'
+        )
+        parser.add_argument('--queue-size', type=int, default=None, help='桩队列容量（默认使用系统参数）')
+        parser.add_argument('--cars', type=int, default=300, help='模拟的车辆数量，默认300')
+        parser.add_argument(
+            '--arrival-rate',
+            type=float,
+            default=0,
+            help='每小时到达车辆数（泊松到达），0 表示所有车辆同时到达'
+        )
+        parser.add_argument('--min-amount', type=float, default=5.0, help='最小充电量(kWh)')
+        parser.add_argument('--max-amount', type=float, default=60.0, help='最大充电量(kWh)')
+        parser.add_argument('--runs', type=int, default=5, help='随机场景数量，默认5')
+        parser.add_argument('--seed', type=int, default=1, help='随机种子')
+
+    def handle(self, *args, **options):
+        if not dispatch_optimizer.is_available():
+            raise CommandError('batch_optimal 策略需要安装 NumPy')
+
+        pile_config = get_charging_pile_config()
+        queue_config = get_queue_config()
+        mode = options['mode']
+
+        if options['powers']:
+            powers = [float(power) for power in options['powers'].split(',')]
+        else:
+            pile_count = options['piles'] or pile_config[f'{mode}_pile_num']
+            powers = [pile_config[f'{mode}_power']] * pile_count
+        queue_size = options['queue_size'] or queue_config[f'{mode}_pile_max_queue_size']
+
+        self.stdout.write(f'=== 调度策略对比：{len(powers)} 个桩，队列容量 {queue_size}，'
+                          f'{options["cars"]} 辆车，{options["runs"]} 个场景 ===')
+
+        results = {'greedy': [], 'batch_optimal': []}
+        for run in range(options['runs']):
+            rng = random.Random(options['seed'] + run)
+            cars = self.generate_cars(rng, options)
+            for strategy in results:
+                results[strategy].append(self.simulate(strategy, cars, powers, queue_size))
+
+        for strategy, runs in results.items():
+            self.show_result(strategy, runs)
+
+        greedy_wait = self.mean([r['avg_wait'] for r in results['greedy']])
+        optimal_wait = self.mean([r['avg_wait'] for r in results['batch_optimal']])
+        if greedy_wait > 0:
+            self.stdout.write(self.style.SUCCESS(
+                f'\n✅ batch_optimal 平均等待时间相对 greedy 变化 {(optimal_wait - greedy_wait) / greedy_wait * 100:+.1f}%'
+            ))
+
+    def generate_cars(self, rng, options):
+        """生成 (到达时间(分钟), 充电量) 列表"""
+        cars = []
+        arrival = 0.0
+        for _ in range(options['cars']):
+            if options['arrival_rate'] > 0:
+                arrival += rng.expovariate(options['arrival_rate'] / 60)
+            cars.append((arrival, rng.uniform(options['min_amount'], options['max_amount'])))
+        return cars
+
+    def simulate(self, strategy, cars, powers, queue_size):
+        """离散事件模拟：每个时刻的到达和完成事件处理完后，对外部等候区执行一次调度"""
+        rates = [60 / power for power in powers]
+        charging_car = [None] * len(powers)
+        queues = [deque() for _ in powers]
+        waiting = []
+        start_times = {}
+        finish_times = {}
+        solve_times = []
+
+        # 事件：(时间, 类型, 下标)，类型 0 为充电完成（下标为桩），1 为车辆到达（下标为车辆）
+        events = [(arrival, 1, car) for car, (arrival, _) in enumerate(cars)]
+        heapq.heapify(events)
+
+        def start_next(pile_index, now):
+            if charging_car[pile_index] is None and queues[pile_index]:
+                car = queues[pile_index].popleft()
+                charging_car[pile_index] = car
+                start_times[car] = now
+                heapq.heappush(events, (now + cars[car][1] * rates[pile_index], 0, pile_index))
+
+        while events:
+            now, event_type, index = heapq.heappop(events)
+            if event_type == 0:
+                finish_times[charging_car[index]] = now
+                charging_car[index] = None
+                start_next(index, now)
+            else:
+                waiting.append(index)
+
+            if not waiting or (events and events[0][0] == now):
+                continue
+
+            base_times, capacities = [], []
+            for pile_index, rate in enumerate(rates):
+                current = charging_car[pile_index]
+                remaining = 0 if current is None else start_times[current] + cars[current][1] * rate - now
+                base_times.append(remaining + sum(cars[car][1] for car in queues[pile_index]) * rate)
+                capacity = queue_size - len(queues[pile_index])
+                if current is None and not queues[pile_index]:
+                    capacity += 1
+                capacities.append(capacity)
+
+            if not any(capacity > 0 for capacity in capacities):
+                continue
+
+            amounts = [cars[car][1] for car in waiting]
+            started = time.perf_counter()
+            if strategy == 'batch_optimal':
+                plan = dispatch_optimizer.plan_optimal_dispatch(amounts, rates, base_times, capacities)
+            else:
+                plan = dispatch_optimizer.plan_greedy_dispatch(amounts, rates, base_times, capacities)
+            solve_times.append((time.perf_counter() - started) * 1000)
+
+            dispatched = set()
+            for pile_index, indexes in enumerate(plan):
+                queues[pile_index].extend(waiting[request_index] for request_index in indexes)
+                dispatched.update(indexes)
+                start_next(pile_index, now)
+            waiting = [car for request_index, car in enumerate(waiting) if request_index not in dispatched]
+
+        return self.summarize(cars, start_times, finish_times, solve_times)
+
+    def summarize(self, cars, start_times, finish_times, solve_times):
+        """汇总单个场景的指标（时间单位：分钟）"""
+        waits = sorted(start_times[car] - cars[car][0] for car in finish_times)
+        first_arrival = min(arrival for arrival, _ in cars)
+        makespan = max(finish_times.values()) - first_arrival
+        return {
+            'avg_wait': self.mean(waits),
+            'p95_wait': self.percentile(waits, 95),
+            'avg_turnaround': self.mean([finish_times[car] - cars[car][0] for car in finish_times]),
+            'makespan': makespan,
+            'throughput': len(finish_times) / makespan * 60 if makespan > 0 else 0,
+            'solve_times': solve_times,
+        }
+
+    def show_result(self, strategy, runs):
+        solve_times = sorted(t for run in runs for t in run['solve_times'])
+        self.stdout.write(f'\n📊 {strategy}')
+        self.stdout.write(f'  平均等待时间: {self.mean([r["avg_wait"] for r in runs]):.1f} 分钟'
+                          f'（P95 {self.mean([r["p95_wait"] for r in runs]):.1f} 分钟）')
+        self.stdout.write(f'  平均完成用时: {self.mean([r["avg_turnaround"] for r in runs]):.1f} 分钟')
+        self.stdout.write(f'  全部完成用时: {self.mean([r["makespan"] for r in runs]):.1f} 分钟')
+        self.stdout.write(f'  吞吐量: {self.mean([r["throughput"] for r in runs]):.2f} 辆/小时')
+        self.stdout.write(f'  单次调度耗时: P50 {self.percentile(solve_times, 50):.3f}ms，'
+                          f'P99 {self.percentile(solve_times, 99):.3f}ms，'
+                          f'最大 {solve_times[-1] if solve_times else 0:.3f}ms（共 {len(solve_times)} 次）')
+
+    @staticmethod
+    def mean(values):
+        return sum(values) / len(values) if values else 0
+
+    @staticmethod
+    def percentile(sorted_values, percent):
+        if not sorted_values:
+            return 0
+        index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+        return sorted_values[index]
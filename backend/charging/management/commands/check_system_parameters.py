@@ -60,6 +60,9 @@ class Command(BaseCommand):
             'fast_pile_max_queue_size': {'type': 'int', 'default': '3', 'description': '快充桩队列最大容量'},
             'slow_pile_max_queue_size': {'type': 'int', 'default': '5', 'description': '慢充桩队列最大容量'},
             'queue_position_update_interval': {'type': 'int', 'default': '30', 'description': '队列位置更新间隔(秒)'},
+            'queue_number_block_size': {'type': 'int', 'default': '1', 'description': '每个进程一次领取的排队号数量'},
+            'dispatch_strategy': {'type': 'string', 'default': 'greedy', 'description': '桩队列调度策略(greedy逐个选择最短剩余时间/batch_optimal批量最优指派)'},
+            'dispatch_time_budget_ms': {'type': 'int', 'default': '20', 'description': '批量最优指派的求解时间预算(毫秒)，超时退回贪心策略'},
             
             # 电价配置（services.py 中使用）
             'peak_rate': {'type': 'float', 'default': '1.2', 'description': '峰时电价(元/kWh)'},
@@ -78,9 +81,13 @@ class Command(BaseCommand):
             'notification_enabled': {'type': 'boolean', 'default': 'true', 'description': '是否启用通知功能'},
             'auto_queue_management': {'type': 'boolean', 'default': 'true', 'description': '是否启用自动队列管理'},
             'shortest_wait_time_threshold': {'type': 'int', 'default': '10', 'description': '最短等待时间调度阈值(分钟)'},
+            'scheduler_mode': {'type': 'string', 'default': 'direct', 'description': '调度模式(direct直接调度/queued调度进程串行执行)'},
+            'scheduler_batch_size': {'type': 'int', 'default': '50', 'description': '调度进程单次事务最多执行的命令数'},
+            'scheduler_command_timeout': {'type': 'int', 'default': '10', 'description': '等待调度进程执行命令的超时时间(秒)'},
+            'telemetry_timeout_seconds': {'type': 'int', 'default': '60', 'description': '充电桩电表读数超过该时间未上报时，改用按功率估算的充电进度(秒)'},
             
             # 故障处理配置（services.py 中使用）
-            'fault_dispatch_strategy': {'type': 'string', 'default': 'priority', 'description': '故障调度策略(priority/time_order)'},
+            'fault_dispatch_strategy': {'type': 'string', 'default': 'priority', 'description': '故障调度策略(priority/time_order/batch_optimal)'},
             'fault_detection_enabled': {'type': 'boolean', 'default': 'true', 'description': '是否启用充电桩故障检测'},
             'auto_recovery_enabled': {'type': 'boolean', 'default': 'true', 'description': '是否启用故障自动恢复处理'},
             'fault_notification_delay': {'type': 'int', 'default': '0', 'description': '故障通知延迟时间(秒)'},
@@ -144,7 +144,8 @@ class Command(BaseCommand):
             for i, request in enumerate(pile_requests, 1):
                 if request.pile_queue_position != i:
                     request.pile_queue_position = i
-                    request.estimated_wait_time = pile.calculate_remaining_time()
+                    # 充电桩的预计剩余时间由排队服务维护，直接读取
+                    request.estimated_wait_time = pile.estimated_remaining_time
                     request.save()
         
         self.stdout.write(f'   🔧 修复完成 {mode} 充电队列位置') 
\ No newline at end of file
@@ -103,6 +103,27 @@ class Command(BaseCommand):
                 'description': '队列位置更新间隔(秒)',
                 'is_editable': True
             },
+            {
+                'param_key': 'queue_number_block_size',
+                'param_value': '1',
+                'param_type': 'int',
+                'description': '每个进程一次领取的排队号数量',
+                'is_editable': True
+            },
+            {
+                'param_key': 'dispatch_strategy',
+                'param_value': 'greedy',
+                'param_type': 'string',
+                'description': '桩队列调度策略(greedy逐个选择最短剩余时间/batch_optimal批量最优指派)',
+                'is_editable': True
+            },
+            {
+                'param_key': 'dispatch_time_budget_ms',
+                'param_value': '20',
+                'param_type': 'int',
+                'description': '批量最优指派的求解时间预算(毫秒)，超时退回贪心策略',
+                'is_editable': True
+            },
             
             # 电价配置
             {
@@ -193,13 +214,41 @@ class Command(BaseCommand):
                 'description': '最短等待时间调度阈值(分钟)',
                 'is_editable': True
             },
+            {
+                'param_key': 'scheduler_mode',
+                'param_value': 'direct',
+                'param_type': 'string',
+                'description': '调度模式(direct直接调度/queued调度进程串行执行)',
+                'is_editable': True
+            },
+            {
+                'param_key': 'scheduler_batch_size',
+                'param_value': '50',
+                'param_type': 'int',
+                'description': '调度进程单次事务最多执行的命令数',
+                'is_editable': True
+            },
+            {
+                'param_key': 'scheduler_command_timeout',
+                'param_value': '10',
+                'param_type': 'int',
+                'description': '等待调度进程执行命令的超时时间(秒)',
+                'is_editable': True
+            },
+            {
+                'param_key': 'telemetry_timeout_seconds',
+                'param_value': '60',
+                'param_type': 'int',
+                'description': '充电桩电表读数超过该时间未上报时，改用按功率估算的充电进度(秒)',
+                'is_editable': True
+            },
             
             # 故障处理配置
             {
                 'param_key': 'fault_dispatch_strategy',
                 'param_value': 'priority',
                 'param_type': 'string',
-                'description': '故障调度策略(priority/time_order)',
+                'description': '故障调度策略(priority/time_order/batch_optimal)',
                 'is_editable': True
             },
             {
@@ -308,7 +357,8 @@ class Command(BaseCommand):
             ],
             '队列管理': [
                 'external_waiting_area_size', 'fast_pile_max_queue_size',
-                'slow_pile_max_queue_size', 'queue_position_update_interval'
+                'slow_pile_max_queue_size', 'queue_position_update_interval',
+                'queue_number_block_size', 'dispatch_strategy', 'dispatch_time_budget_ms'
             ],
             '电价配置': [
                 'peak_rate', 'normal_rate', 'valley_rate', 'service_rate'
@@ -319,7 +369,9 @@ class Command(BaseCommand):
             ],
             '系统配置': [
                 'max_charging_time_per_session', 'notification_enabled',
-                'auto_queue_management', 'shortest_wait_time_threshold'
+                'auto_queue_management', 'shortest_wait_time_threshold',
+                'scheduler_mode', 'scheduler_batch_size', 'scheduler_command_timeout',
+                'telemetry_timeout_seconds'
             ]
         }
         
@@ -344,6 +396,8 @@ class Command(BaseCommand):
             'fast_pile_max_queue_size': '人',
             'slow_pile_max_queue_size': '人',
             'queue_position_update_interval': '秒',
+            'queue_number_block_size': '个',
+            'dispatch_time_budget_ms': '毫秒',
             'fast_charging_power': 'kW',
             'slow_charging_power': 'kW',
             'peak_rate': '元/kWh',
@@ -352,6 +406,9 @@ class Command(BaseCommand):
             'service_rate': '元/kWh',
             'max_charging_time_per_session': '分钟',
             'shortest_wait_time_threshold': '分钟',
+            'scheduler_batch_size': '条',
+            'scheduler_command_timeout': '秒',
+            'telemetry_timeout_seconds': '秒',
             'maintenance_check_interval': '小时'
         }
         return units.get(param_key, '') 
\ No newline at end of file
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from charging.scheduler import SchedulerWorker
+import signal
+
+
+class Command(BaseCommand):
+    help = '运行单写者调度进程（scheduler_mode=queued 时使用）'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.running = True
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--mode',
+            choices=['fast', 'slow'],
+            required=True,
+            help='负责调度的充电模式，每种模式运行一个调度进程'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='单次事务最多执行的命令数（默认使用 scheduler_batch_size 参数）'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=0.05,
+            help='没有待执行命令时的轮询间隔（秒），默认0.05秒'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='只执行一批命令'
+        )
+
+    def handle_signal(self, signum, frame):
+        """处理停止信号"""
+        self.stdout.write('\n⏹️ 接收到停止信号，正在安全退出...')
+        self.running = False
+
+    def handle(self, *args, **options):
+        worker = SchedulerWorker(options['mode'], batch_size=options['batch_size'])
+
+        if options['once']:
+            count = worker.run_once()
+            self.stdout.write(self.style.SUCCESS(f'✅ 执行了 {count} 条调度命令'))
+            return
+
+        # 注册信号处理器
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+
+        self.stdout.write(f'🚀 {options["mode"]} 调度进程启动，单批最多 {worker.batch_size} 条命令')
+        self.stdout.write('💡 按 Ctrl+C 或发送 SIGTERM 信号停止')
+
+        try:
+            worker.run(options['poll_interval'], should_stop=lambda: not self.running)
+        except KeyboardInterrupt:
+            self.stdout.write('\n⏹️ 接收到键盘中断')
+        finally:
+            self.stdout.write('🔚 调度进程已停止')
@@ -0,0 +1,167 @@
+from django.core.management.base import BaseCommand, CommandError
+from charging.simulation import (QueueSimulator, WAIT_BUCKETS, create_piles, generate_trace,
+                                 in_memory_database, load_trace, percentile, save_trace)
+from charging.utils.parameter_manager import ParameterManager
+import json
+
+
+class Command(BaseCommand):
+    help = '在内存 SQLite 和虚拟时钟下回放事件轨迹，统计排队服务的查询数、操作耗时和等待时间分布'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trace', type=str, default=None, help='回放 JSON Lines 格式的事件轨迹文件（不指定时生成合成轨迹）')
+        parser.add_argument('--save-trace', type=str, default=None, help='把本次使用的事件轨迹保存到文件，便于复现')
+        parser.add_argument('--report', type=str, default=None, help='把统计结果以 JSON 格式写入文件，便于对比性能变化')
+        parser.add_argument('--cars', type=int, default=200, help='合成轨迹的车辆数，默认200')
+        parser.add_argument('--arrival-rate', type=float, default=60.0, help='合成轨迹每小时到达车辆数，默认60')
+        parser.add_argument('--fast-ratio', type=float, default=0.5, help='快充请求比例，默认0.5')
+        parser.add_argument('--min-amount', type=float, default=5.0, help='最小充电量(kWh)')
+        parser.add_argument('--max-amount', type=float, default=60.0, help='最大充电量(kWh)')
+        parser.add_argument('--cancel-ratio', type=float, default=0.1, help='取消请求的比例，默认0.1')
+        parser.add_argument('--change-mode-ratio', type=float, default=0.05, help='修改充电类型的比例，默认0.05')
+        parser.add_argument('--faults', type=int, default=1, help='充电桩故障次数，默认1')
+        parser.add_argument('--fault-duration', type=float, default=30.0, help='故障持续时间(分钟)，默认30')
+        parser.add_argument('--seed', type=int, default=1, help='随机种子')
+        parser.add_argument('--fast-piles', type=int, default=None, help='快充桩数量（默认使用系统参数）')
+        parser.add_argument('--slow-piles', type=int, default=None, help='慢充桩数量（默认使用系统参数）')
+        parser.add_argument(
+            '--param',
+            action='append',
+            default=[],
+            metavar='KEY=VALUE',
+            help='模拟数据库中的系统参数，可重复指定，如 --param dispatch_strategy=batch_optimal'
+        )
+
+    def handle(self, *args, **options):
+        parameters = [self.parse_parameter(item) for item in options['param']]
+
+        with in_memory_database():
+            for key, value in parameters:
+                ParameterManager.set_parameter(key, value)
+
+            piles = create_piles(options['fast_piles'], options['slow_piles'])
+            if options['trace']:
+                try:
+                    trace = load_trace(options['trace'])
+                except (OSError, ValueError) as e:
+                    raise CommandError(f'读取事件轨迹失败: {e}')
+            else:
+                trace = generate_trace(
+                    cars=options['cars'],
+                    arrival_rate=options['arrival_rate'],
+                    fast_ratio=options['fast_ratio'],
+                    min_amount=options['min_amount'],
+                    max_amount=options['max_amount'],
+                    cancel_ratio=options['cancel_ratio'],
+                    change_mode_ratio=options['change_mode_ratio'],
+                    faults=options['faults'],
+                    fault_duration=options['fault_duration'],
+                    pile_ids=[pile.pile_id for pile in piles],
+                    seed=options['seed'],
+                )
+            if options['save_trace']:
+                save_trace(trace, options['save_trace'])
+
+            fast_count = sum(1 for pile in piles if pile.pile_type == 'fast')
+            self.stdout.write(f'=== 排队服务负载模拟：{len(trace)} 个轨迹事件，'
+                              f'{fast_count} 个快充桩 / {len(piles) - fast_count} 个慢充桩 ===')
+
+            simulator = QueueSimulator(trace)
+            wall_seconds, executed = simulator.run()
+            report = self.build_report(simulator, wall_seconds, executed)
+
+        self.show_report(report)
+        if options['report']:
+            with open(options['report'], 'w', encoding='utf-8') as report_file:
+                json.dump(report, report_file, ensure_ascii=False, indent=2)
+            self.stdout.write(f'\n📝 统计结果已写入 {options["report"]}')
+
+    def parse_parameter(self, item):
+        """解析 KEY=VALUE，数值和布尔值自动转换类型"""
+        if '=' not in item:
+            raise CommandError(f'参数格式应为 KEY=VALUE: {item}')
+        key, value = item.split('=', 1)
+        if value.lower() in ('true', 'false'):
+            return key, value.lower() == 'true'
+        for convert in (int, float):
+            try:
+                return key, convert(value)
+            except ValueError:
+                pass
+        return key, value
+
+    def build_report(self, simulator, wall_seconds, executed):
+        operations = {}
+        for op, stats in simulator.stats.items():
+            latencies = sorted(stats.latencies)
+            operations[op] = {
+                'count': stats.count,
+                'skipped': stats.skipped,
+                'avg_queries': sum(stats.queries) / stats.count if stats.count else 0,
+                'max_queries': max(stats.queries, default=0),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'total_ms': sum(latencies),
+            }
+
+        waits = {}
+        for charging_mode, values in simulator.wait_times().items():
+            buckets = {}
+            lower = 0
+            for upper in WAIT_BUCKETS + (None,):
+                label = f'{lower}-{upper}' if upper is not None else f'>{lower}'
+                buckets[label] = sum(
+                    1 for value in values if value >= lower and (upper is None or value < upper)
+                )
+                lower = upper
+            waits[charging_mode] = {
+                'count': len(values),
+                'mean': sum(values) / len(values) if values else 0,
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': values[-1] if values else 0,
+                'buckets': buckets,
+            }
+
+        return {
+            'executed_operations': executed,
+            'wall_seconds': wall_seconds,
+            'operation_seconds': sum(op['total_ms'] for op in operations.values()) / 1000,
+            'events_per_second': executed / wall_seconds if wall_seconds > 0 else 0,
+            'simulated_minutes': simulator.clock.minutes(simulator.clock.now()),
+            'rejected': simulator.rejected,
+            'outcomes': simulator.outcome_counts(),
+            'operations': operations,
+            'wait_minutes': waits,
+        }
+
+    def show_report(self, report):
+        self.stdout.write('\n📊 操作统计（耗时单位 ms）')
+        self.stdout.write(f'  {"操作":<12}{"次数":>6}{"跳过":>6}{"平均查询":>10}{"最大查询":>10}'
+                          f'{"P50":>9}{"P95":>9}{"P99":>9}')
+        for op, stats in report['operations'].items():
+            self.stdout.write(
+                f'  {op:<12}{stats["count"]:>6}{stats["skipped"]:>6}{stats["avg_queries"]:>10.1f}'
+                f'{stats["max_queries"]:>10}{stats["p50_ms"]:>9.2f}{stats["p95_ms"]:>9.2f}{stats["p99_ms"]:>9.2f}'
+            )
+
+        self.stdout.write(
+            f'\n⚡ 执行 {report["executed_operations"]} 个操作，墙钟 {report["wall_seconds"]:.2f} 秒'
+            f'（操作本身 {report["operation_seconds"]:.2f} 秒），{report["events_per_second"]:.1f} 个事件/秒，'
+            f'模拟时长 {report["simulated_minutes"]:.0f} 分钟'
+        )
+
+        for charging_mode, waits in report['wait_minutes'].items():
+            mode_name = '快充' if charging_mode == 'fast' else '慢充'
+            self.stdout.write(
+                f'\n⏱️ {mode_name}等待时间（分钟，共 {waits["count"]} 个请求）：平均 {waits["mean"]:.1f}，'
+                f'P50 {waits["p50"]:.1f}，P90 {waits["p90"]:.1f}，P99 {waits["p99"]:.1f}，最大 {waits["max"]:.1f}'
+            )
+            for label, count in waits['buckets'].items():
+                bar = '█' * round(count / waits['count'] * 40) if waits['count'] else ''
+                self.stdout.write(f'  {label:>8} {count:>5} {bar}')
+
+        outcomes = '，'.join(f'{status} {count}' for status, count in sorted(report['outcomes'].items()))
+        self.stdout.write(f'\n📋 请求结果：{outcomes}；等候区已满被拒绝 {report["rejected"]}')
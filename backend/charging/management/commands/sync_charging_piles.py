@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from django.db import transaction
+from charging.counters import refresh_counters
 from charging.models import ChargingPile, SystemParameter, ChargingRequest
 from charging.utils.parameter_manager import ParameterManager
 import logging
@@ -341,6 +342,9 @@ class Command(BaseCommand):
                 updated += 1
                 self.stdout.write(f'     🔧 更新: {pile.pile_id} - {", ".join(update_fields)}')
         
+        # 充电桩数量变化后重新统计充电站计数
+        refresh_counters([pile_type])
+        
         return {'added': added, 'removed': removed, 'updated': updated}
 
     def _generate_pile_id(self, pile_type, index):
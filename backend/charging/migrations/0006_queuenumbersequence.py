@@ -0,0 +1,31 @@
+# Generated by Django 4.2.21 on 2026-10-16 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charging', '0005_alter_notification_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueNumberSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('charging_mode', models.CharField(choices=[('fast', '快充'), ('slow', '慢充')], max_length=10, verbose_name='充电模式')),
+                ('last_value', models.IntegerField(default=0, verbose_name='已分配的最大序号')),
+            ],
+            options={
+                'verbose_name': '排队号序列',
+                'verbose_name_plural': '排队号序列',
+                'db_table': 'queue_number_sequence',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='queuenumbersequence',
+            constraint=models.UniqueConstraint(fields=('date', 'charging_mode'), name='unique_queue_number_sequence_per_day'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.21 on 2026-10-16 23:02
+
+from django.db import migrations, models
+
+
+def create_queue_locks(apps, schema_editor):
+    QueueLock = apps.get_model('charging', 'QueueLock')
+    for charging_mode in ('fast', 'slow'):
+        QueueLock.objects.get_or_create(charging_mode=charging_mode)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charging', '0006_queuenumbersequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueLock',
+            fields=[
+                ('charging_mode', models.CharField(choices=[('fast', '快充'), ('slow', '慢充')], max_length=10, primary_key=True, serialize=False, verbose_name='充电模式')),
+                ('version', models.BigIntegerField(default=0, verbose_name='队列版本号')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': '调度锁',
+                'verbose_name_plural': '调度锁',
+                'db_table': 'queue_lock',
+            },
+        ),
+        migrations.RunPython(create_queue_locks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.21 on 2026-10-16 23:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charging', '0007_queuelock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerCommand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('charging_mode', models.CharField(choices=[('fast', '快充'), ('slow', '慢充')], max_length=10, verbose_name='调度模式')),
+                ('command', models.CharField(choices=[('submit', '提交充电请求'), ('cancel', '取消充电请求'), ('change_mode', '修改充电类型'), ('complete', '完成充电')], max_length=20, verbose_name='命令')),
+                ('payload', models.JSONField(default=dict, verbose_name='命令参数')),
+                ('status', models.CharField(choices=[('pending', '待执行'), ('done', '已完成'), ('failed', '失败')], default='pending', max_length=10, verbose_name='状态')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='执行结果')),
+                ('error', models.TextField(blank=True, verbose_name='错误信息')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': '调度命令',
+                'verbose_name_plural': '调度命令',
+                'db_table': 'scheduler_command',
+                'indexes': [models.Index(fields=['charging_mode', 'status', 'id'], name='scheduler_cmd_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.21 on 2026-10-16 23:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charging', '0008_schedulercommand'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PileLeaseHolder',
+            fields=[
+                ('holder', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='持有者')),
+                ('expires_at', models.DateTimeField(verbose_name='过期时间')),
+                ('heartbeat_at', models.DateTimeField(auto_now=True, verbose_name='最近心跳时间')),
+            ],
+            options={
+                'verbose_name': '租约持有者',
+                'verbose_name_plural': '租约持有者',
+                'db_table': 'pile_lease_holder',
+            },
+        ),
+        migrations.CreateModel(
+            name='PileLease',
+            fields=[
+                ('pile', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='lease', serialize=False, to='charging.chargingpile', verbose_name='充电桩')),
+                ('holder', models.CharField(blank=True, default='', max_length=100, verbose_name='持有者')),
+                ('expires_at', models.DateTimeField(verbose_name='过期时间')),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True, verbose_name='最近心跳时间')),
+                ('acquired_at', models.DateTimeField(blank=True, null=True, verbose_name='获得租约时间')),
+            ],
+            options={
+                'verbose_name': '充电桩租约',
+                'verbose_name_plural': '充电桩租约',
+                'db_table': 'pile_lease',
+                'indexes': [models.Index(fields=['holder', 'expires_at'], name='pile_lease_holder_idx')],
+            },
+        ),
+    ]
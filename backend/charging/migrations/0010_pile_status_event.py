@@ -0,0 +1,40 @@
+# Generated by Django 4.2.21 on 2026-10-16 23:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charging', '0009_pilelease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PileStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(choices=[('normal', '正常'), ('fault', '故障'), ('offline', '离线')], max_length=10, verbose_name='原状态')),
+                ('to_status', models.CharField(choices=[('normal', '正常'), ('fault', '故障'), ('offline', '离线')], max_length=10, verbose_name='新状态')),
+                ('source', models.CharField(choices=[('admin', '管理后台'), ('api', '接口'), ('system', '系统')], default='api', max_length=10, verbose_name='来源')),
+                ('reason', models.CharField(blank=True, default='', max_length=200, verbose_name='原因')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '充电桩状态事件',
+                'verbose_name_plural': '充电桩状态事件',
+                'db_table': 'pile_status_event',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='chargingpile',
+            index=models.Index(fields=['updated_at'], name='charging_pile_updated_idx'),
+        ),
+        migrations.AddField(
+            model_name='pilestatusevent',
+            name='pile',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_events', to='charging.chargingpile', verbose_name='充电桩'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.21 on 2026-10-16 23:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charging', '0010_pile_status_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chargingsession',
+            name='meter_kwh',
+            field=models.FloatField(blank=True, null=True, verbose_name='最新电表读数(kWh)'),
+        ),
+        migrations.AddField(
+            model_name='chargingsession',
+            name='meter_power',
+            field=models.FloatField(blank=True, null=True, verbose_name='最新功率(kW)'),
+        ),
+        migrations.AddField(
+            model_name='chargingsession',
+            name='meter_reading_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='最新读数时间'),
+        ),
+        migrations.AddField(
+            model_name='chargingsession',
+            name='meter_start_kwh',
+            field=models.FloatField(blank=True, null=True, verbose_name='会话开始电表读数(kWh)'),
+        ),
+    ]
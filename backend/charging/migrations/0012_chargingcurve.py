@@ -0,0 +1,28 @@
+# Generated by Django 4.2.21 on 2026-10-16 23:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charging', '0011_session_meter_telemetry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChargingCurve',
+            fields=[
+                ('session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='curve', serialize=False, to='charging.chargingsession', verbose_name='充电会话')),
+                ('samples', models.BinaryField(default=b'', verbose_name='采样数据')),
+                ('sample_count', models.IntegerField(default=0, verbose_name='采样点数')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '充电曲线',
+                'verbose_name_plural': '充电曲线',
+                'db_table': 'charging_curve',
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.21 on 2026-10-17 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charging', '0012_chargingcurve'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StationCounter',
+            fields=[
+                ('charging_mode', models.CharField(choices=[('fast', '快充'), ('slow', '慢充')], max_length=10, primary_key=True, serialize=False, verbose_name='充电模式')),
+                ('waiting', models.IntegerField(default=0, verbose_name='等待中的请求数')),
+                ('charging', models.IntegerField(default=0, verbose_name='充电中的请求数')),
+                ('external_waiting', models.IntegerField(default=0, verbose_name='外部等候区人数')),
+                ('pile_queue_waiting', models.IntegerField(default=0, verbose_name='桩队列等待人数')),
+                ('total_piles', models.IntegerField(default=0, verbose_name='充电桩总数')),
+                ('working_piles', models.IntegerField(default=0, verbose_name='工作中的充电桩数')),
+                ('fault_piles', models.IntegerField(default=0, verbose_name='故障充电桩数')),
+                ('offline_piles', models.IntegerField(default=0, verbose_name='离线充电桩数')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': '充电站计数',
+                'verbose_name_plural': '充电站计数',
+                'db_table': 'station_counter',
+            },
+        ),
+    ]
@@ -55,6 +55,27 @@ class SystemParameter(models.Model):
 
 User = get_user_model()
 
+class ChargingPileQuerySet(models.QuerySet):
+    def with_queue_details(self):
+        """一次性预取每个桩正在充电的请求（含用户、车辆）和桩队列（含车辆）
+        
+        预取结果放在 current_requests / queued_requests 属性中，查询数固定为三条，不随桩数增长。
+        """
+        return self.prefetch_related(
+            models.Prefetch(
+                'chargingrequest_set',
+                queryset=ChargingRequest.objects.filter(current_status='charging').select_related('user', 'vehicle'),
+                to_attr='current_requests'
+            ),
+            models.Prefetch(
+                'chargingrequest_set',
+                queryset=ChargingRequest.objects.filter(queue_level='pile_queue')
+                .select_related('user', 'vehicle').order_by('pile_queue_position'),
+                to_attr='queued_requests'
+            ),
+        )
+
+
 class ChargingPile(models.Model):
     """充电桩模型"""
     PILE_TYPES = [
@@ -87,16 +108,42 @@ class ChargingPile(models.Model):
     total_energy = models.FloatField(default=0.0)    # kWh
     total_revenue = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     
+    objects = ChargingPileQuerySet.as_manager()
+    
     class Meta:
         db_table = 'charging_pile'
         verbose_name = '充电桩'
         verbose_name_plural = '充电桩'
+        indexes = [
+            # 故障检测按 updated_at 水位增量读取状态有变化的充电桩
+            models.Index(fields=['updated_at'], name='charging_pile_updated_idx'),
+        ]
     
     def __str__(self):
         return f"{self.pile_id} ({self.get_pile_type_display()})"
     
+    def get_current_request(self):
+        """当前正在充电的请求（优先使用 with_queue_details 的预取结果）"""
+        if hasattr(self, 'current_requests'):
+            return self.current_requests[0] if self.current_requests else None
+        return ChargingRequest.objects.filter(
+            charging_pile=self,
+            current_status='charging'
+        ).select_related('user', 'vehicle').first()
+    
+    def get_queued_requests(self, limit=None):
+        """桩队列中的请求，按位置排序（优先使用 with_queue_details 的预取结果）"""
+        if hasattr(self, 'queued_requests'):
+            return self.queued_requests[:limit]
+        return list(ChargingRequest.objects.filter(
+            charging_pile=self,
+            queue_level='pile_queue'
+        ).select_related('user', 'vehicle').order_by('pile_queue_position')[:limit])
+    
     def get_queue_count(self):
         """获取当前桩队列中的请求数量"""
+        if hasattr(self, 'queued_requests'):
+            return len(self.queued_requests)
         return ChargingRequest.objects.filter(
             charging_pile=self,
             queue_level='pile_queue'
@@ -107,7 +154,11 @@ class ChargingPile(models.Model):
         return self.get_queue_count() >= self.max_queue_size
     
     def calculate_remaining_time(self):
-        """计算该桩的预计剩余时间"""
+        """从数据库重新计算该桩的预计剩余时间（只读，不写回）
+        
+        estimated_remaining_time 由调度服务在入队、出队、开始/完成充电和进度更新时维护，
+        读取时直接使用该字段；本方法仅用于校对和修复。
+        """
         # 获取当前正在充电的请求
         current_charging = ChargingRequest.objects.filter(
             charging_pile=self,
@@ -133,9 +184,17 @@ class ChargingPile(models.Model):
             charging_time = (request.requested_amount / self.charging_power) * 60
             total_time += charging_time
         
-        self.estimated_remaining_time = int(total_time)
-        self.save(update_fields=['estimated_remaining_time'])
-        return self.estimated_remaining_time
+        return int(total_time)
+
+class ChargingRequestQuerySet(models.QuerySet):
+    def with_details(self):
+        """连同车辆、充电桩和充电会话一次查询读出，序列化时不再逐个加载关联对象"""
+        return self.select_related('vehicle', 'charging_pile', 'session')
+    
+    def active_for(self, user):
+        """用户的活跃请求（等待中或充电中），按提交时间排序"""
+        return self.filter(user=user, current_status__in=['waiting', 'charging']).with_details().order_by('created_at')
+
 
 class ChargingRequest(models.Model):
     """充电请求模型"""
@@ -183,6 +242,8 @@ class ChargingRequest(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = ChargingRequestQuerySet.as_manager()
+    
     class Meta:
         db_table = 'charging_request'
         verbose_name = '充电请求'
@@ -203,14 +264,9 @@ class ChargingRequest(models.Model):
     
     def save(self, *args, **kwargs):
         if not self.queue_number:
-            # 生成队列号
-            prefix = 'F' if self.charging_mode == 'fast' else 'S'
-            timestamp = timezone.now().strftime('%m%d%H%M')
-            count = ChargingRequest.objects.filter(
-                charging_mode=self.charging_mode,
-                created_at__date=timezone.now().date()
-            ).count() + 1
-            self.queue_number = f"{prefix}{timestamp}{count:03d}"
+            # 生成队列号（按日期和充电模式的序列分配，不会重复）
+            from charging.utils.queue_number import QueueNumberAllocator
+            self.queue_number = QueueNumberAllocator.next_queue_number(self.charging_mode)
         super().save(*args, **kwargs)
     
     def get_estimated_charging_time(self):
@@ -221,6 +277,14 @@ class ChargingRequest(models.Model):
         default_power = 120 if self.charging_mode == 'fast' else 7
         return (self.requested_amount / default_power) * 60
     
+    def get_ahead_count(self):
+        """当前队列中排在前面的人数"""
+        if self.queue_level == 'external_waiting':
+            return self.external_queue_position - 1
+        elif self.queue_level == 'pile_queue':
+            return self.pile_queue_position - 1
+        return 0
+    
     def get_queue_status_display(self):
         """获取队列状态的友好显示"""
         if self.queue_level == 'external_waiting':
@@ -232,6 +296,169 @@ class ChargingRequest(models.Model):
         else:
             return self.get_queue_level_display()
 
+class QueueNumberSequence(models.Model):
+    """排队号序列：每天每种充电模式一行计数器"""
+    date = models.DateField(verbose_name='日期')
+    charging_mode = models.CharField(max_length=10, choices=ChargingRequest.MODE_CHOICES, verbose_name='充电模式')
+    last_value = models.IntegerField(default=0, verbose_name='已分配的最大序号')
+    
+    class Meta:
+        db_table = 'queue_number_sequence'
+        verbose_name = '排队号序列'
+        verbose_name_plural = '排队号序列'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'charging_mode'],
+                name='unique_queue_number_sequence_per_day'
+            )
+        ]
+    
+    def __str__(self):
+        return f"{self.date} {self.get_charging_mode_display()} - {self.last_value}"
+
+class QueueLock(models.Model):
+    """调度锁：每种充电模式一行，调度事件开始时锁定该行以串行化同一模式的调度
+    
+    每次调度事件都会递增 version，读取方可以据此判断队列是否发生变化。
+    """
+    charging_mode = models.CharField(max_length=10, choices=ChargingRequest.MODE_CHOICES, primary_key=True, verbose_name='充电模式')
+    version = models.BigIntegerField(default=0, verbose_name='队列版本号')
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'queue_lock'
+        verbose_name = '调度锁'
+        verbose_name_plural = '调度锁'
+    
+    def __str__(self):
+        return f"{self.get_charging_mode_display()} v{self.version}"
+
+class StationCounter(models.Model):
+    """充电站计数：每种充电模式一行
+    
+    调度事件写回队列状态时在同一事务中写入该模式的计数，充电桩状态变更时重新统计，
+    公开状态接口和管理后台直接读取，不再对请求表和充电桩表执行 COUNT。
+    """
+    charging_mode = models.CharField(max_length=10, choices=ChargingRequest.MODE_CHOICES, primary_key=True, verbose_name='充电模式')
+    waiting = models.IntegerField(default=0, verbose_name='等待中的请求数')
+    charging = models.IntegerField(default=0, verbose_name='充电中的请求数')
+    external_waiting = models.IntegerField(default=0, verbose_name='外部等候区人数')
+    pile_queue_waiting = models.IntegerField(default=0, verbose_name='桩队列等待人数')
+    total_piles = models.IntegerField(default=0, verbose_name='充电桩总数')
+    working_piles = models.IntegerField(default=0, verbose_name='工作中的充电桩数')
+    fault_piles = models.IntegerField(default=0, verbose_name='故障充电桩数')
+    offline_piles = models.IntegerField(default=0, verbose_name='离线充电桩数')
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'station_counter'
+        verbose_name = '充电站计数'
+        verbose_name_plural = '充电站计数'
+    
+    def __str__(self):
+        return f"{self.get_charging_mode_display()} 等待{self.waiting} 充电{self.charging}"
+
+class PileLease(models.Model):
+    """充电桩租约：多个进度守护进程分片处理充电桩
+    
+    每个桩同一时间只由持有未过期租约的进程处理；持有者按心跳续约，进程退出或失联后
+    租约过期，由其他进程接管。
+    """
+    pile = models.OneToOneField(ChargingPile, on_delete=models.CASCADE, primary_key=True, related_name='lease', verbose_name='充电桩')
+    holder = models.CharField(max_length=100, blank=True, default='', verbose_name='持有者')
+    expires_at = models.DateTimeField(verbose_name='过期时间')
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='最近心跳时间')
+    acquired_at = models.DateTimeField(null=True, blank=True, verbose_name='获得租约时间')
+    
+    class Meta:
+        db_table = 'pile_lease'
+        verbose_name = '充电桩租约'
+        verbose_name_plural = '充电桩租约'
+        indexes = [
+            models.Index(fields=['holder', 'expires_at'], name='pile_lease_holder_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.pile_id} -> {self.holder or '未分配'}"
+
+class PileStatusEvent(models.Model):
+    """充电桩状态变更事件
+    
+    管理后台或接口修改充电桩状态时写入，进度守护进程按事件ID增量读取，
+    下一次故障检测即可处理对应充电桩，无需等待全量扫描。
+    """
+    SOURCE_CHOICES = [
+        ('admin', '管理后台'),
+        ('api', '接口'),
+        ('system', '系统'),
+    ]
+    
+    pile = models.ForeignKey(ChargingPile, on_delete=models.CASCADE, related_name='status_events', verbose_name='充电桩')
+    from_status = models.CharField(max_length=10, choices=ChargingPile.STATUS_CHOICES, verbose_name='原状态')
+    to_status = models.CharField(max_length=10, choices=ChargingPile.STATUS_CHOICES, verbose_name='新状态')
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default='api', verbose_name='来源')
+    reason = models.CharField(max_length=200, blank=True, default='', verbose_name='原因')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    
+    class Meta:
+        db_table = 'pile_status_event'
+        verbose_name = '充电桩状态事件'
+        verbose_name_plural = '充电桩状态事件'
+        ordering = ['id']
+    
+    def __str__(self):
+        return f"{self.pile_id}: {self.from_status} -> {self.to_status}"
+
+
+class PileLeaseHolder(models.Model):
+    """持有充电桩租约的守护进程登记：用于计算各进程的公平份额（尚未持有任何桩的进程也要计入）"""
+    holder = models.CharField(max_length=100, primary_key=True, verbose_name='持有者')
+    expires_at = models.DateTimeField(verbose_name='过期时间')
+    heartbeat_at = models.DateTimeField(auto_now=True, verbose_name='最近心跳时间')
+    
+    class Meta:
+        db_table = 'pile_lease_holder'
+        verbose_name = '租约持有者'
+        verbose_name_plural = '租约持有者'
+    
+    def __str__(self):
+        return self.holder
+
+class SchedulerCommand(models.Model):
+    """调度命令：单写者调度模式下由接口写入、调度进程批量执行"""
+    COMMAND_CHOICES = [
+        ('submit', '提交充电请求'),
+        ('cancel', '取消充电请求'),
+        ('change_mode', '修改充电类型'),
+        ('complete', '完成充电'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('pending', '待执行'),
+        ('done', '已完成'),
+        ('failed', '失败'),
+    ]
+    
+    charging_mode = models.CharField(max_length=10, choices=ChargingRequest.MODE_CHOICES, verbose_name='调度模式')
+    command = models.CharField(max_length=20, choices=COMMAND_CHOICES, verbose_name='命令')
+    payload = models.JSONField(default=dict, verbose_name='命令参数')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', verbose_name='状态')
+    result = models.JSONField(null=True, blank=True, verbose_name='执行结果')
+    error = models.TextField(blank=True, verbose_name='错误信息')
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'scheduler_command'
+        verbose_name = '调度命令'
+        verbose_name_plural = '调度命令'
+        indexes = [
+            models.Index(fields=['charging_mode', 'status', 'id'], name='scheduler_cmd_pending_idx'),
+        ]
+    
+    def __str__(self):
+        return f"#{self.pk} {self.get_command_display()} ({self.get_status_display()})"
+
 class ChargingSession(models.Model):
     """充电会话模型"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -245,6 +472,12 @@ class ChargingSession(models.Model):
     charging_amount = models.FloatField(default=0.0)  # 实际充电量
     charging_duration = models.FloatField(default=0.0)  # 充电时长(小时)
     
+    # 充电桩电表遥测（电表读数为累计电量，会话充电量 = 当前读数 - 会话开始时的读数）
+    meter_start_kwh = models.FloatField(null=True, blank=True, verbose_name='会话开始电表读数(kWh)')
+    meter_kwh = models.FloatField(null=True, blank=True, verbose_name='最新电表读数(kWh)')
+    meter_power = models.FloatField(null=True, blank=True, verbose_name='最新功率(kW)')
+    meter_reading_at = models.DateTimeField(null=True, blank=True, verbose_name='最新读数时间')
+    
     # 费用计算
     peak_hours = models.FloatField(default=0.0)
     normal_hours = models.FloatField(default=0.0)
@@ -269,6 +502,30 @@ class ChargingSession(models.Model):
 
 
 
+class ChargingCurve(models.Model):
+    """充电会话的充电曲线（采样点按 float32 差分打包为二进制块，见 charging.utils.charging_curve）"""
+    session = models.OneToOneField(ChargingSession, on_delete=models.CASCADE, primary_key=True, related_name='curve', verbose_name='充电会话')
+    samples = models.BinaryField(default=b'', verbose_name='采样数据')
+    sample_count = models.IntegerField(default=0, verbose_name='采样点数')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+    
+    class Meta:
+        db_table = 'charging_curve'
+        verbose_name = '充电曲线'
+        verbose_name_plural = '充电曲线'
+    
+    def __str__(self):
+        return f"{self.session_id} ({self.sample_count} 个采样点)"
+    
+    def get_buffer(self):
+        from .utils.charging_curve import CurveBuffer
+        return CurveBuffer.from_bytes(self.samples)
+    
+    def set_buffer(self, buffer):
+        self.samples = buffer.to_bytes()
+        self.sample_count = len(buffer)
+
+
 class Notification(models.Model):
     """通知模型"""
     TYPE_CHOICES = [
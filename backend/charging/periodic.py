@@ -0,0 +1,806 @@
+"""
+基于 asyncio 的周期任务调度
+
+每个周期任务在事件循环中独立调度：按单调时钟计算下一次执行时刻（start + k × interval），
+不会因为执行耗时而逐渐漂移；执行时间超过周期时跳过错过的轮次并计数。
+数据库操作在有界线程池中执行，一个任务变慢不会推迟其他任务的执行。
+
+调度使用注入的时钟：默认是事件循环的单调时钟；VirtualTime 在所有任务都处于等待时直接前进到最早的等待时刻，
+不做真实等待，用于测试和离线回放。
+
+ProgressDaemon 是 update_charging_progress 命令的守护进程本体：同步循环、完成定时器和 asyncio 三种运行模式，
+以及它们执行的进度更新、增量故障检测等周期任务。
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import signal
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import OutputWrapper
+from django.core.management.color import color_style
+from django.db import close_old_connections
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .clock import SystemClock, VirtualClock
+from .models import ChargingPile, ChargingRequest, PileStatusEvent, QueueLock
+from .progress import apply_progress, without_live_telemetry
+from .utils.completion_timers import CompletionTimerHeap
+
+logger = logging.getLogger(__name__)
+
+
+class TaskMetrics:
+    """单个周期任务的执行统计（耗时单位：毫秒）"""
+
+    # 计算百分位数时保留的最近耗时样本数
+    WINDOW = 500
+
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.missed_ticks = 0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self.recent = deque(maxlen=self.WINDOW)
+
+    def record(self, latency_ms):
+        self.runs += 1
+        self.total_latency += latency_ms
+        self.max_latency = max(self.max_latency, latency_ms)
+        self.recent.append(latency_ms)
+
+    def percentile(self, percent):
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+    def summary(self):
+        average = self.total_latency / self.runs if self.runs else 0.0
+        return (
+            f'执行 {self.runs} 次，失败 {self.errors} 次，错过 {self.missed_ticks} 轮，'
+            f'耗时 平均 {average:.1f} / P50 {self.percentile(50):.1f} / '
+            f'P95 {self.percentile(95):.1f} / 最大 {self.max_latency:.1f} ms'
+        )
+
+
+class PeriodicTask:
+    """按固定周期在线程池中执行的同步函数"""
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.metrics = TaskMetrics()
+
+    def call(self):
+        """在线程池中执行，前后清理失效的数据库连接"""
+        close_old_connections()
+        try:
+            self.func()
+        finally:
+            close_old_connections()
+
+
+class LoopTime:
+    """事件循环的单调时钟：按真实时间等待"""
+
+    def monotonic(self):
+        return asyncio.get_running_loop().time()
+
+    def join(self, count):
+        pass
+
+    def leave(self):
+        pass
+
+    async def sleep_until(self, deadline, stopping):
+        """睡到指定的时钟时刻，收到停止信号时提前返回 False"""
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=max(0, deadline - self.monotonic()))
+            return False
+        except asyncio.TimeoutError:
+            return True
+
+
+class VirtualTime:
+    """虚拟时间：所有参与者都在等待时，时钟直接前进到最早的等待时刻
+
+    参与者是各周期任务的调度协程，以及在任务函数中调用 sleep() 的线程。
+    任务函数执行期间（未调用 sleep()）虚拟时间不前进，因此结果与线程的执行快慢无关。
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or VirtualClock()
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._running = 0
+
+    def monotonic(self):
+        return self.clock.monotonic()
+
+    def join(self, count):
+        """登记开始运行的参与者"""
+        with self._lock:
+            self._running += count
+
+    def leave(self):
+        """参与者退出，不再阻止时钟前进"""
+        with self._lock:
+            self._running -= 1
+            self._advance()
+
+    def sleep(self, seconds):
+        """在任务函数中等待指定的虚拟秒数（阻塞当前线程）"""
+        woken = threading.Event()
+        self._wait(self.monotonic() + seconds, woken.set)
+        woken.wait()
+
+    async def sleep_until(self, deadline, stopping):
+        """睡到指定的虚拟时刻，收到停止信号时提前返回 False"""
+        if stopping.is_set():
+            return False
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+        waiter = self._wait(deadline, wake)
+        stop = asyncio.ensure_future(stopping.wait())
+        try:
+            await asyncio.wait({woken, stop}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stop.cancel()
+        if woken.done():
+            return True
+
+        with self._lock:
+            # 停止时撤销等待，参与者恢复为运行状态，随后由 leave() 退出
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                self._running += 1
+        return False
+
+    def _wait(self, deadline, wake):
+        waiter = [deadline, next(self._sequence), wake]
+        with self._lock:
+            heapq.heappush(self._waiters, waiter)
+            self._running -= 1
+            self._advance()
+        return waiter
+
+    def _advance(self):
+        """（持有锁）没有参与者在运行时，前进到最早的等待时刻并唤醒到期的等待者"""
+        while self._running == 0 and self._waiters:
+            deadline = self._waiters[0][0]
+            self.clock.advance(deadline - self.clock.monotonic())
+            while self._waiters and self._waiters[0][0] <= deadline:
+                _, _, wake = heapq.heappop(self._waiters)
+                self._running += 1
+                wake()
+
+
+class PeriodicScheduler:
+    """在一个事件循环中独立调度多个周期任务
+
+    clock 为 None 时按事件循环的单调时钟调度，也可以传入 VirtualTime 按虚拟时间调度。
+    """
+
+    def __init__(self, tasks, max_workers=None, metrics_interval=None, report=None, clock=None):
+        self.tasks = list(tasks)
+        self.max_workers = max_workers or len(self.tasks)
+        self.metrics_interval = metrics_interval
+        self.report = report or (lambda task: logger.info(f'{task.name}: {task.metrics.summary()}'))
+        self.clock = clock or LoopTime()
+        self._stopping = None
+        self._loop = None
+
+    def stop(self):
+        """停止调度，可以在任务函数所在的线程中调用"""
+        if self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def run(self):
+        """运行所有任务直到 stop() 被调用"""
+        self._stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='periodic')
+        try:
+            runners = [self._run_task(task, executor) for task in self.tasks]
+            if self.metrics_interval:
+                runners.append(self._report_metrics())
+            self.clock.join(len(runners))
+            await asyncio.gather(*(self._participate(runner) for runner in runners))
+        finally:
+            # 等待正在执行的任务结束，避免中途关闭数据库连接
+            executor.shutdown(wait=True)
+
+    async def _participate(self, runner):
+        try:
+            await runner
+        finally:
+            self.clock.leave()
+
+    async def _sleep_until(self, deadline):
+        """睡到指定的时钟时刻，收到停止信号时提前返回 False"""
+        return await self.clock.sleep_until(deadline, self._stopping)
+
+    async def _run_task(self, task, executor):
+        loop = asyncio.get_running_loop()
+        next_run = self.clock.monotonic()
+
+        while not self._stopping.is_set():
+            started = self.clock.monotonic()
+            try:
+                await loop.run_in_executor(executor, task.call)
+            except Exception as e:
+                task.metrics.errors += 1
+                logger.error(f'周期任务 {task.name} 执行失败: {e}')
+            finished = self.clock.monotonic()
+            task.metrics.record((finished - started) * 1000)
+
+            # 下一次执行时刻只由起始时刻和周期决定；执行超时则跳到下一个未错过的轮次
+            next_run += task.interval
+            if next_run < finished:
+                missed = int((finished - next_run) // task.interval) + 1
+                task.metrics.missed_ticks += missed
+                next_run += missed * task.interval
+
+            if not await self._sleep_until(next_run):
+                return
+
+    async def _report_metrics(self):
+        next_report = self.clock.monotonic() + self.metrics_interval
+        while await self._sleep_until(next_report):
+            for task in self.tasks:
+                self.report(task)
+            next_report += self.metrics_interval
+
+
+class ProgressDaemon:
+    """充电进度守护进程：进度更新、故障检测、完成定时器和叫号恢复，以及按这些任务组合的运行模式
+
+    同步守护进程按 interval 依次执行一个更新周期；定时器模式睡到最近的预计完成时刻；
+    asyncio 模式把各任务交给 PeriodicScheduler 独立调度。分片模式下只处理 lease_manager 持有租约的充电桩。
+    """
+
+    # updated_at 水位回退的时间，覆盖保存后延迟提交的事务和服务器间的时钟偏差
+    WATERMARK_LAG = timedelta(seconds=5)
+
+    def __init__(self, clock=None, stdout=None, style=None, verbosity=1, lease_manager=None):
+        # 时钟（业务时间的来源，传给排队服务和进度计算）和按时钟计的停止时刻
+        self.clock = clock or SystemClock()
+        self.stop_at = None
+        self.stdout = stdout if isinstance(stdout, OutputWrapper) else OutputWrapper(stdout or sys.stdout)
+        self.style = style or color_style()
+        self.verbosity = verbosity
+        self.running = True
+        # 分片模式下的充电桩租约（None 表示处理全部充电桩）
+        self.lease_manager = lease_manager
+        # 用于跟踪充电桩状态变化
+        self.pile_status_cache = {}
+        # 故障检测的增量水位：充电桩 updated_at 和状态变更事件ID（None 表示下次全量扫描）
+        self.pile_watermark = None
+        self.event_watermark = None
+        # 完成定时器上次同步时各模式的调度锁版本号
+        self.timer_versions = None
+
+    def stop(self):
+        """停止守护进程循环（在当前周期结束后退出）"""
+        self.running = False
+
+    def shutdown(self):
+        """退出时释放租约并输出时钟回放的时长"""
+        if self.lease_manager is not None:
+            self.lease_manager.release_all()
+            self.stdout.write(f'🔓 {self.lease_manager.holder} 已释放充电桩租约')
+        if not isinstance(self.clock, SystemClock):
+            self.stdout.write(
+                f'🕒 时钟时间 {timezone.localtime(self.clock.now()).strftime("%Y-%m-%d %H:%M:%S")}，'
+                f'共回放 {self.clock.monotonic() / 3600:.2f} 小时'
+            )
+
+    def initialize_pile_status_cache(self):
+        """初始化充电桩状态缓存"""
+        piles = ChargingPile.objects.all()
+        for pile in piles:
+            self.pile_status_cache[pile.pile_id] = pile.status
+        self.stdout.write(f'📝 初始化充电桩状态缓存，监控 {len(self.pile_status_cache)} 个充电桩')
+
+    def renew_leases(self):
+        """分片模式下续约并重新平衡持有的充电桩"""
+        if self.lease_manager is None:
+            return
+
+        previous = self.lease_manager.held
+        held = self.lease_manager.heartbeat()
+        if held != previous:
+            self.stdout.write(
+                f'🔑 {self.lease_manager.holder} 持有 {len(held)} 个充电桩租约: {", ".join(sorted(held)) or "无"}'
+            )
+
+    def apply_lease_changes(self):
+        """故障检测开始时处理续约记录的租约变化"""
+        if self.lease_manager is None:
+            return
+        lost, rescan = self.lease_manager.take_scan_changes()
+        # 失去租约的桩不再跟踪状态，重新获得时按初次发现处理（由其他进程可能已处理过状态变化）
+        for pile_id in lost:
+            self.pile_status_cache.pop(pile_id, None)
+        if rescan:
+            self.pile_watermark = None
+
+    def owned(self, queryset, field='pk'):
+        """分片模式下只保留本进程持有租约的充电桩相关记录"""
+        if self.lease_manager is None:
+            return queryset
+        return self.lease_manager.owned(queryset, field)
+
+    def keep_running(self):
+        """守护进程循环条件：未收到停止信号且未超过 --duration 指定的时钟时长"""
+        if self.stop_at is not None and self.clock.monotonic() >= self.stop_at:
+            self.running = False
+        return self.running
+
+    def run_daemon(self, interval, enable_fault_detection):
+        """守护进程模式，持续运行"""
+        self.stdout.write(f'🚀 充电进度守护进程启动，更新间隔: {interval}秒')
+        if enable_fault_detection:
+            self.stdout.write('🔍 故障检测已启用')
+        self.stdout.write('💡 按 Ctrl+C 或发送 SIGTERM 信号停止')
+
+        try:
+            while self.keep_running():
+                start_time = self.clock.monotonic()
+
+                # 执行更新
+                self.update_single_cycle(enable_fault_detection)
+
+                # 计算下次更新时间
+                elapsed = self.clock.monotonic() - start_time
+                sleep_time = max(0, interval - elapsed)
+
+                if self.running and sleep_time > 0:
+                    self.clock.sleep(sleep_time)
+
+        except KeyboardInterrupt:
+            self.stdout.write('\n⏹️ 接收到键盘中断')
+        except Exception as e:
+            self.stdout.write(f'\n❌ 守护进程异常: {e}')
+        finally:
+            self.stdout.write('🔚 充电进度守护进程已停止')
+
+    def run_async_daemon(self, interval, enable_fault_detection, fault_interval=1.0, resume_interval=10.0,
+                         workers=3, metrics_interval=60.0, completion_timers=False, watch_interval=1.0):
+        """asyncio 守护进程：各周期任务按单调时钟独立调度，数据库操作在有界线程池中执行
+
+        故障检测变慢不会推迟进度更新，反之亦然；每个任务单独统计耗时和错过的轮次。
+        """
+        tasks = [PeriodicTask('progress', interval, self.update_charging_progress)]
+        if enable_fault_detection:
+            tasks.append(PeriodicTask(
+                'fault_detection', fault_interval or interval, self.detect_and_handle_pile_faults
+            ))
+        tasks.append(PeriodicTask('queue_resume', resume_interval, self.resume_paused_queues))
+        if self.lease_manager is not None:
+            tasks.append(PeriodicTask('lease_heartbeat', self.lease_manager.ttl / 3, self.renew_leases))
+        if completion_timers:
+            timers = CompletionTimerHeap()
+            self.timer_versions = None
+            tasks.append(PeriodicTask(
+                'completion_timers', watch_interval, lambda: self.process_completion_timers(timers)
+            ))
+
+        def report(task):
+            self.stdout.write(f'📈 {task.name}: {task.metrics.summary()}')
+
+        scheduler = PeriodicScheduler(
+            tasks,
+            max_workers=workers,
+            metrics_interval=metrics_interval,
+            report=report
+        )
+
+        def stop():
+            self.stdout.write('\n⏹️ 接收到停止信号，正在安全退出...')
+            self.running = False
+            scheduler.stop()
+
+        # 事件循环按真实时间调度：加速时钟下按倍速缩短各任务的真实间隔
+        scale = getattr(self.clock, 'scale', 1)
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, stop)
+            if self.stop_at is not None:
+                loop.call_later(max(0, self.stop_at - self.clock.monotonic()) / scale, scheduler.stop)
+            await scheduler.run()
+
+        self.stdout.write(f'🚀 充电进度守护进程启动（asyncio 模式），任务: '
+                          + '，'.join(f'{task.name} 每{task.interval:g}秒' for task in tasks))
+        self.stdout.write('💡 按 Ctrl+C 或发送 SIGTERM 信号停止')
+        for task in tasks:
+            task.interval /= scale
+
+        try:
+            asyncio.run(main())
+        except Exception as e:
+            self.stdout.write(f'\n❌ 守护进程异常: {e}')
+        finally:
+            for task in tasks:
+                report(task)
+            self.stdout.write('🔚 充电进度守护进程已停止')
+
+    def resume_paused_queues(self):
+        """恢复遗留的外部等候区叫号暂停（故障桩队列已处理完但暂停标志未清除）"""
+        from .services import AdvancedChargingQueueService
+
+        service = AdvancedChargingQueueService(self.clock.now)
+        for pile_type in ('fast', 'slow'):
+            if service.resume_stalled_external_queue(pile_type):
+                self.stdout.write(self.style.WARNING(f'▶️ 已恢复 {pile_type} 外部等候区叫号'))
+
+    def run_timer_daemon(self, interval, enable_fault_detection, watch_interval):
+        """定时器模式的守护进程：睡到最近的预计完成时刻准时完成充电
+
+        充电中请求的完成时刻在开始充电时即可确定，放入定时器堆后无需轮询；调度锁版本号变化
+        （有请求开始或结束充电）时才重新同步定时器。全量进度更新和故障检测按 interval 低频执行。
+        """
+        self.stdout.write(f'🚀 充电进度守护进程启动（完成定时器模式），全量更新间隔: {interval}秒')
+        if enable_fault_detection:
+            self.stdout.write('🔍 故障检测已启用')
+        self.stdout.write('💡 按 Ctrl+C 或发送 SIGTERM 信号停止')
+
+        timers = CompletionTimerHeap()
+        self.timer_versions = None
+        next_sweep = self.clock.monotonic()
+
+        try:
+            while self.keep_running():
+                if self.clock.monotonic() >= next_sweep:
+                    self.update_single_cycle(enable_fault_detection)
+                    next_sweep = self.clock.monotonic() + interval
+
+                self.process_completion_timers(timers)
+                if enable_fault_detection:
+                    # 增量故障检测开销很小，每次唤醒都检查以便及时处理状态变化
+                    self.detect_and_handle_pile_faults()
+
+                # 睡到最近的完成时刻、下次全量更新或下次版本检查
+                wake_after = min(next_sweep - self.clock.monotonic(), watch_interval)
+                next_deadline = timers.next_deadline()
+                if next_deadline is not None:
+                    wake_after = min(wake_after, (next_deadline - self.clock.now()).total_seconds())
+
+                if self.running and wake_after > 0:
+                    self.clock.sleep(wake_after)
+
+        except KeyboardInterrupt:
+            self.stdout.write('\n⏹️ 接收到键盘中断')
+        except Exception as e:
+            self.stdout.write(f'\n❌ 守护进程异常: {e}')
+        finally:
+            self.stdout.write('🔚 充电进度守护进程已停止')
+
+    def process_completion_timers(self, timers):
+        """同步定时器并完成所有已到期的充电，返回完成的数量"""
+        if self.lease_manager is not None and self.lease_manager.take_timer_resync():
+            self.timer_versions = None
+
+        versions = dict(QueueLock.objects.values_list('charging_mode', 'version'))
+        if versions != self.timer_versions:
+            timers.sync(
+                self.owned(ChargingRequest.objects.filter(
+                    current_status='charging', start_time__isnull=False, charging_pile__isnull=False
+                ), 'charging_pile').values_list('id', 'start_time', 'requested_amount', 'charging_pile__charging_power')
+            )
+            self.timer_versions = versions
+
+        now = self.clock.now()
+        due = timers.pop_due(now)
+        if not due:
+            return 0
+
+        requests = list(
+            self.owned(ChargingRequest.objects.filter(
+                pk__in=[request_id for request_id, _ in due], current_status='charging'
+            ), 'charging_pile')
+            .select_related('charging_pile', 'session', 'user')
+        )
+        # 故障桩上的请求交给全量更新周期中的故障处理
+        requests = [r for r in requests if not r.charging_pile or r.charging_pile.status == 'normal']
+        # 电表仍在上报读数的请求由遥测接口完成，不再设置定时器
+        requests = without_live_telemetry(requests, self.clock.now)
+        _, completed_count = apply_progress(requests, clock=self.clock.now)
+
+        deadlines = dict(due)
+        lateness = []
+        for request in requests:
+            if request.current_status == 'charging':
+                # 计算误差导致未达到请求量，稍后重试
+                timers.schedule(request.pk, now + timedelta(seconds=1))
+            else:
+                lateness.append((now - deadlines[request.pk]).total_seconds() * 1000)
+
+        if completed_count:
+            self.stdout.write(self.style.SUCCESS(
+                f'⏱️ {now.strftime("%H:%M:%S")} - 按预计完成时刻完成 {completed_count} 个充电，'
+                f'平均延迟 {sum(lateness) / len(lateness):.0f} ms'
+            ))
+        return completed_count
+
+    def update_single_cycle(self, enable_fault_detection=True):
+        """单次更新周期"""
+        # 0. 分片模式下续约
+        self.renew_leases()
+
+        # 1. 检测充电桩故障（如果启用）
+        if enable_fault_detection:
+            self.detect_and_handle_pile_faults()
+
+        # 2. 更新充电进度
+        self.update_charging_progress()
+
+    def detect_and_handle_pile_faults(self):
+        """检测并处理充电桩故障"""
+        from .services import AdvancedChargingQueueService
+
+        try:
+            self.apply_lease_changes()
+
+            # 只读取自上次检测以来可能有状态变化的充电桩（水位与 updated_at 比较，使用真实时间）
+            scan_started = timezone.now()
+            current_piles = list(self.owned(self.changed_piles()))
+            # 没有变化时不构造队列服务（构造时会读取系统参数）
+            queue_service = AdvancedChargingQueueService(self.clock.now) if current_piles else None
+
+            fault_detected = False
+            recovery_detected = False
+            existing_fault_handled = False
+
+            for pile in current_piles:
+                cached_status = self.pile_status_cache.get(pile.pile_id)
+                current_status = pile.status
+
+                # 检测状态变化
+                if cached_status != current_status:
+                    self.stdout.write(
+                        f'📊 检测到充电桩 {pile.pile_id} 状态变化: {cached_status} -> {current_status}'
+                    )
+
+                    # 检测故障
+                    if cached_status == 'normal' and current_status == 'fault':
+                        self.stdout.write(
+                            self.style.WARNING(f'🚨 检测到充电桩 {pile.pile_id} 发生故障')
+                        )
+                        # 调用故障处理
+                        queue_service.handle_pile_fault(pile)
+                        fault_detected = True
+
+                    # 检测恢复
+                    elif cached_status == 'fault' and current_status == 'normal':
+                        self.stdout.write(
+                            self.style.SUCCESS(f'✅ 检测到充电桩 {pile.pile_id} 故障恢复')
+                        )
+                        # 调用恢复处理
+                        queue_service.handle_pile_recovery(pile)
+                        recovery_detected = True
+
+                    # 检测离线/上线
+                    elif cached_status == 'offline' and current_status == 'normal':
+                        self.stdout.write(
+                            self.style.SUCCESS(f'🔌 检测到充电桩 {pile.pile_id} 重新上线')
+                        )
+                        # 离线恢复也需要重新调度
+                        queue_service.handle_pile_recovery(pile)
+                        recovery_detected = True
+
+                    elif cached_status == 'normal' and current_status == 'offline':
+                        self.stdout.write(
+                            self.style.WARNING(f'📴 检测到充电桩 {pile.pile_id} 离线')
+                        )
+                        # 离线按故障处理
+                        queue_service.handle_pile_fault(pile)
+                        fault_detected = True
+
+                    # 更新缓存
+                    self.pile_status_cache[pile.pile_id] = current_status
+
+                # 检查已存在的故障状态（特别是在守护进程启动时）
+                elif current_status in ['fault', 'offline'] and cached_status is None:
+                    # 这是初始化时发现的故障桩
+                    self.stdout.write(
+                        self.style.WARNING(f'🔍 初始化时发现故障桩 {pile.pile_id} (状态: {current_status})')
+                    )
+
+                    # 检查是否有活跃的充电或队列请求
+                    has_active_requests = ChargingRequest.objects.filter(
+                        charging_pile=pile,
+                        current_status__in=['charging', 'waiting']
+                    ).exists()
+
+                    if has_active_requests:
+                        self.stdout.write(
+                            self.style.WARNING(f'🚨 故障桩 {pile.pile_id} 上有活跃请求，触发故障处理')
+                        )
+                        queue_service.handle_pile_fault(pile)
+                        existing_fault_handled = True
+
+                    # 更新缓存
+                    self.pile_status_cache[pile.pile_id] = current_status
+
+            # 本次检测成功后推进水位（回退一段时间，容忍延迟提交的事务）
+            self.pile_watermark = scan_started - self.WATERMARK_LAG
+
+            # 输出检测结果摘要
+            if fault_detected or recovery_detected or existing_fault_handled:
+                status_summary = []
+                if fault_detected:
+                    status_summary.append('发现故障')
+                if recovery_detected:
+                    status_summary.append('发现恢复')
+                if existing_fault_handled:
+                    status_summary.append('处理既有故障')
+                self.stdout.write(
+                    f'🔄 故障检测周期完成 - {", ".join(status_summary)}'
+                )
+            else:
+                # 只在详细模式下输出
+                if self.verbosity >= 2:
+                    self.stdout.write('🔍 故障检测周期完成 - 无状态变化')
+
+        except Exception as e:
+            self.stdout.write(
+                self.style.ERROR(f'❌ 故障检测过程发生错误: {e}')
+            )
+
+    def changed_piles(self):
+        """自上次水位以来可能有状态变化的充电桩：updated_at 不早于水位，或有新的状态变更事件
+
+        首次检测（以及持有的充电桩变化后）全量扫描。通过 save() 修改状态会更新 updated_at，
+        管理后台和状态接口还会写入状态变更事件；不经过 save() 的批量 update 需要自行写入事件。
+        进度更新和调度事件批量写回剩余时间、占用状态时不更新 updated_at，不会让所有充电桩落入水位。
+        """
+        if self.pile_watermark is None or self.event_watermark is None:
+            self.event_watermark = PileStatusEvent.objects.aggregate(latest=Max('id'))['latest'] or 0
+            return ChargingPile.objects.all()
+
+        events = list(
+            PileStatusEvent.objects.filter(id__gt=self.event_watermark).values_list('id', 'pile_id')
+        )
+        changed = Q(updated_at__gte=self.pile_watermark)
+        if events:
+            self.event_watermark = max(event_id for event_id, _ in events)
+            changed |= Q(pk__in={pile_id for _, pile_id in events})
+        return ChargingPile.objects.filter(changed)
+
+    def update_charging_progress(self):
+        """更新充电进度（一次查询加载所有充电中的请求及其充电桩和会话）"""
+        charging_requests = list(
+            self.owned(ChargingRequest.objects.filter(current_status='charging'), 'charging_pile')
+            .select_related('charging_pile', 'session', 'user')
+        )
+
+        if not charging_requests:
+            # 只在详细模式下输出
+            if self.verbosity >= 2:
+                self.stdout.write(f'⏰ {self.clock.now().strftime("%H:%M:%S")} - 没有正在充电的请求')
+            return
+
+        active_requests = []
+        fault_requests_found = []  # 收集在故障桩上的充电请求
+
+        for request in charging_requests:
+            # 检查桩是否仍然正常（防止在故障检测和进度更新之间的状态变化）
+            if request.charging_pile and request.charging_pile.status != 'normal':
+                self.stdout.write(
+                    f'⚠️ 跳过故障桩 {request.charging_pile.pile_id} 上的充电进度更新'
+                )
+                # 收集故障桩上的充电请求，稍后处理
+                fault_requests_found.append(request)
+                continue
+            active_requests.append(request)
+
+        updated_count, completed_count = apply_progress(
+            without_live_telemetry(active_requests, self.clock.now), clock=self.clock.now
+        )
+
+        # 处理在故障桩上发现的充电请求
+        if fault_requests_found:
+            self._handle_fault_charging_requests(fault_requests_found)
+
+        status_msg = f'✅ {self.clock.now().strftime("%H:%M:%S")} - 更新了 {updated_count} 个充电请求'
+        if completed_count > 0:
+            status_msg += f', 完成了 {completed_count} 个'
+        if fault_requests_found:
+            status_msg += f', 处理了 {len(fault_requests_found)} 个故障桩请求'
+
+        self.stdout.write(self.style.SUCCESS(status_msg))
+
+    def _handle_fault_charging_requests(self, fault_requests):
+        """处理在故障桩上发现的充电请求"""
+        from .services import AdvancedChargingQueueService
+
+        processed_piles = set()  # 避免重复处理同一个桩
+
+        for request in fault_requests:
+            pile = request.charging_pile
+            if not pile or pile.pile_id in processed_piles:
+                continue
+
+            if pile.status != 'normal':
+                self.stdout.write(
+                    self.style.WARNING(f'🚨 发现故障桩 {pile.pile_id} 上有活跃充电，触发故障处理')
+                )
+
+                try:
+                    # 调用故障处理逻辑
+                    queue_service = AdvancedChargingQueueService(self.clock.now)
+                    queue_service.handle_pile_fault(pile)
+                    processed_piles.add(pile.pile_id)
+
+                    self.stdout.write(
+                        self.style.SUCCESS(f'✅ 已处理故障桩 {pile.pile_id} 的充电和队列调度')
+                    )
+
+                except Exception as e:
+                    self.stdout.write(
+                        self.style.ERROR(f'❌ 处理故障桩 {pile.pile_id} 时发生错误: {e}')
+                    )
+
+    def manual_fault_check(self):
+        """手动检查并处理所有故障桩"""
+        from .services import AdvancedChargingQueueService
+
+        self.stdout.write('🔧 手动故障检查模式启动...')
+
+        # 查找所有故障桩
+        fault_piles = ChargingPile.objects.filter(status__in=['fault', 'offline'])
+
+        if not fault_piles.exists():
+            self.stdout.write(self.style.SUCCESS('✅ 未发现故障桩'))
+            return
+
+        self.stdout.write(f'🔍 发现 {fault_piles.count()} 个故障桩:')
+
+        queue_service = AdvancedChargingQueueService(self.clock.now)
+        processed_count = 0
+
+        for pile in fault_piles:
+            self.stdout.write(f'   - {pile.pile_id}: {pile.get_status_display()}')
+
+            # 检查是否有活跃请求
+            active_requests = ChargingRequest.objects.filter(
+                charging_pile=pile,
+                current_status__in=['charging', 'waiting']
+            )
+
+            if active_requests.exists():
+                self.stdout.write(
+                    f'     ⚠️ 发现 {active_requests.count()} 个活跃请求，执行故障处理...'
+                )
+
+                try:
+                    queue_service.handle_pile_fault(pile)
+                    processed_count += 1
+                    self.stdout.write(f'     ✅ 故障处理完成')
+                except Exception as e:
+                    self.stdout.write(f'     ❌ 故障处理失败: {e}')
+            else:
+                self.stdout.write(f'     📝 无活跃请求，跳过')
+
+        self.stdout.write(
+            self.style.SUCCESS(f'🔧 手动故障检查完成，处理了 {processed_count} 个故障桩')
+        )
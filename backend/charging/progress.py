@@ -0,0 +1,219 @@
+"""
+充电进度
+
+进度守护进程按充电时长和桩功率估算充电量，遥测接口按电表读数计算充电量，两者都通过
+apply_progress 在一个事务中批量写回请求、会话、充电桩剩余时间和充电曲线；
+达到请求充电量的请求随即完成（结算、通知、释放充电桩在同一个事务中提交）。
+"""
+
+import logging
+import random
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ChargingCurve, ChargingPile, ChargingRequest, ChargingSession, QueueLock
+from .scheduler import get_queue_service
+from charging.utils.parameter_manager import get_telemetry_config
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_progress(request, now):
+    """按充电时长和桩功率计算已充电量（写入 request.current_amount），返回充电时长（小时）"""
+    # 计算充电时长（小时）
+    charging_duration = (now - request.start_time).total_seconds() / 3600
+
+    # 获取充电桩的实际功率
+    power = 120  # 默认快充功率
+    if request.charging_pile:
+        power = request.charging_pile.charging_power
+    elif request.charging_mode == 'slow':
+        power = 7   # 慢充功率约7kW
+
+    # 计算已充电量
+    charged_amount = min(
+        charging_duration * power,
+        request.requested_amount
+    )
+
+    # 添加一些随机性模拟真实情况
+    if charged_amount < request.requested_amount:
+        # 充电效率在80%-100%之间变动
+        efficiency = random.uniform(0.8, 1.0)
+        charged_amount = min(charged_amount * efficiency, request.requested_amount)
+
+    request.current_amount = round(charged_amount, 2)
+    return charging_duration
+
+
+def without_live_telemetry(requests, clock=None):
+    """去掉电表仍在上报读数的请求（其进度和完成由遥测接口驱动，读数中断超时后才改为估算）"""
+    if not any(hasattr(r, 'session') and r.session.meter_reading_at for r in requests):
+        return requests
+
+    cutoff = (clock or timezone.now)() - timedelta(seconds=get_telemetry_config()['timeout_seconds'])
+    return [
+        r for r in requests
+        if not (hasattr(r, 'session') and r.session.meter_reading_at and r.session.meter_reading_at >= cutoff)
+    ]
+
+
+def apply_progress(requests, progress=None, session_fields=(), clock=None):
+    """在内存中计算一批请求的充电进度，并在一个事务中按模型批量写回
+
+    每次的写入语句数固定（请求、会话、充电桩各一条批量更新），不随充电中的请求数增长。
+    progress(request, now) 写入 request.current_amount 并返回充电时长（小时），默认按桩功率估算；
+    session_fields 为 progress 额外修改的会话字段，clock 为当前时间的来源（默认 timezone.now）。
+    返回 (更新的请求数, 完成充电的请求数)。
+    """
+    clock = clock or timezone.now
+    now = clock()
+    estimated = progress is None
+    progress = progress or estimate_progress
+    progressed = []
+    sessions = []
+    samples = []
+    changed_piles = {}
+
+    for request in requests:
+        if not request.start_time:
+            continue
+
+        old_amount = request.current_amount
+        charging_duration = progress(request, now)
+        request.updated_at = timezone.now()
+        progressed.append((request, old_amount))
+
+        # 更新会话数据
+        if hasattr(request, 'session'):
+            session = request.session
+            session.charging_amount = request.current_amount
+            session.charging_duration = charging_duration
+            sessions.append(session)
+
+            # 充电曲线采样：估算进度用桩的额定功率，电表读数用上报的功率
+            power = request.charging_pile.charging_power if request.charging_pile else 0.0
+            if not estimated and session.meter_power is not None:
+                power = session.meter_power
+            samples.append((session.pk, charging_duration * 3600, request.current_amount, power))
+
+        # 充电量变化后需要同步充电桩的预计剩余时间（读取方直接使用该字段）
+        if request.charging_pile and request.current_amount != old_amount:
+            changed_piles[request.charging_pile_id] = request
+
+    if not progressed:
+        return 0, 0
+
+    with transaction.atomic():
+        # 充电量变化后递增队列版本号，使排队状态快照重建；先锁调度锁行，与调度事件的加锁顺序一致
+        changed_modes = sorted({request.charging_mode for request, old in progressed if request.current_amount != old})
+        if changed_modes:
+            QueueLock.objects.filter(charging_mode__in=changed_modes).update(
+                version=F('version') + 1, updated_at=timezone.now()
+            )
+        ChargingRequest.objects.bulk_update(
+            [request for request, _ in progressed], ['current_amount', 'updated_at']
+        )
+        if sessions:
+            ChargingSession.objects.bulk_update(
+                sessions, ['charging_amount', 'charging_duration', *session_fields]
+            )
+        if changed_piles:
+            update_pile_remaining_times(changed_piles)
+        if samples:
+            record_curve_samples(samples)
+
+    completed_count = 0
+    for request, old_amount in progressed:
+        # 只在有显著变化时记录详细信息
+        if abs(request.current_amount - old_amount) > 0.1:
+            logger.info(
+                f"{request.queue_number} ({request.user.username}): "
+                f"{old_amount:.2f} -> {request.current_amount:.2f} kWh "
+                f"({request.current_amount / request.requested_amount * 100:.1f}%)"
+            )
+
+        # 检查是否完成充电
+        if request.current_amount >= request.requested_amount and complete_charging(request, clock):
+            completed_count += 1
+
+    return len(progressed), completed_count
+
+
+def record_curve_samples(samples):
+    """把一批 (会话ID, 距开始秒数, 充电量, 功率) 采样点追加到各会话的充电曲线
+
+    一次查询读出已有曲线，一条 upsert 语句写回，语句数不随会话数增长。
+    """
+    curves = ChargingCurve.objects.in_bulk([session_id for session_id, _, _, _ in samples])
+    changed = []
+    for session_id, offset, amount, power in samples:
+        curve = curves.get(session_id) or ChargingCurve(session_id=session_id)
+        buffer = curve.get_buffer()
+        if buffer.append(offset, amount, power):
+            curve.set_buffer(buffer)
+            changed.append(curve)
+
+    if changed:
+        ChargingCurve.objects.bulk_create(
+            changed,
+            update_conflicts=True,
+            update_fields=['samples', 'sample_count', 'updated_at'],
+            # MySQL 的 ON DUPLICATE KEY UPDATE 不指定冲突列
+            unique_fields=['session'] if connection.features.supports_update_conflicts_with_target else None,
+        )
+
+
+def update_pile_remaining_times(charging_by_pile):
+    """重新计算充电量有变化的充电桩的预计剩余时间并批量写回
+
+    charging_by_pile 为 {充电桩主键: 桩上正在充电的请求}，桩队列中的请求用一次查询取出，
+    计算方式与 ChargingPile.calculate_remaining_time 一致。
+    """
+    queued_amounts = defaultdict(list)
+    pile_queue = ChargingRequest.objects.filter(
+        charging_pile_id__in=list(charging_by_pile),
+        queue_level='pile_queue'
+    ).order_by('pile_queue_position').values_list('charging_pile_id', 'requested_amount')
+    for pile_id, requested_amount in pile_queue:
+        queued_amounts[pile_id].append(requested_amount)
+
+    changed = []
+    for pile_id, request in charging_by_pile.items():
+        pile = request.charging_pile
+        remaining_amount = request.requested_amount - request.current_amount
+        total_time = (remaining_amount / pile.charging_power) * 60
+        for requested_amount in queued_amounts[pile_id]:
+            total_time += (requested_amount / pile.charging_power) * 60
+
+        remaining = int(total_time)
+        if remaining != pile.estimated_remaining_time:
+            pile.estimated_remaining_time = remaining
+            changed.append(pile)
+
+    if changed:
+        # 不更新 updated_at：故障检测按它的水位读取状态有变化的充电桩
+        ChargingPile.objects.bulk_update(changed, ['estimated_remaining_time'])
+
+
+def complete_charging(request, clock=None):
+    """完成达到请求充电量的充电，返回是否完成
+
+    结算、完成通知、释放充电桩并推进队列在同一个事务中提交（单写者模式下由调度进程执行）；
+    失败时请求保持充电中，下一次更新时重试。
+    """
+    try:
+        get_queue_service(clock).complete_charging(request)
+    except Exception as e:
+        logger.error(f"完成充电请求 {request.queue_number} 失败: {e}")
+        return False
+
+    message = f"{request.queue_number} ({request.user.username}) 充电完成"
+    if hasattr(request, 'session'):
+        message += f"，费用: {request.session.total_cost} 元"
+    logger.info(message)
+    return True
@@ -0,0 +1,445 @@
+"""
+多级队列内存状态引擎
+
+每个调度事件开始时按充电模式一次性加载该模式下的充电桩、外部等候区、
+各桩队列以及正在充电的请求；事件过程中的计数、选桩、位置调整全部在内存中完成，
+事件结束时把变更一次性写回 ChargingRequest / ChargingPile。
+"""
+
+import heapq
+from collections import defaultdict
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from .counters import record_counters
+from .models import ChargingRequest, ChargingPile, ChargingSession, Notification
+
+ACTIVE_STATUSES = ['waiting', 'charging']
+
+# 由调度逻辑维护的字段，attach 时以数据库中的最新值为准
+QUEUE_FIELDS = [
+    'queue_level', 'current_status', 'external_queue_position',
+    'pile_queue_position', 'estimated_wait_time', 'charging_pile_id',
+]
+
+# 没有可用桩时的预计等待时间(分钟)
+NO_PILE_WAIT_TIME = 999
+
+# 可以按位移量合并写回的位置字段
+POSITION_FIELDS = ('external_queue_position', 'pile_queue_position')
+
+
+class ModeQueueState:
+    """单一充电模式的队列状态"""
+
+    def __init__(self, charging_mode, piles, requests):
+        self.charging_mode = charging_mode
+        self.piles = {pile.pile_id: pile for pile in piles}
+        self.external = []
+        self.pile_queues = {pile_id: [] for pile_id in self.piles}
+        self.charging = {}
+        # 外部等候区叫号是否暂停，由服务层在事件中首次用到时填充
+        self.external_paused = None
+
+        self._dirty_requests = {}
+        self._dirty_piles = {}
+        self._new_sessions = []
+        self._notifications = []
+        # 加载时数据库中的位置，用于把位置变化折算为位移量
+        self._loaded_positions = {}
+
+        for request in requests:
+            self._remember_positions(request)
+            pile = self.piles.get(request.charging_pile_id)
+            if pile is not None:
+                request.charging_pile = pile
+            if request.queue_level == 'external_waiting':
+                self.external.append(request)
+            elif request.queue_level == 'pile_queue' and pile is not None:
+                self.pile_queues[pile.pile_id].append(request)
+            elif request.queue_level == 'charging' and pile is not None:
+                self.charging[pile.pile_id] = request
+
+        self.external.sort(key=lambda r: (r.external_queue_position, r.created_at))
+        for queue in self.pile_queues.values():
+            queue.sort(key=lambda r: (r.pile_queue_position, r.created_at))
+
+    @classmethod
+    def load(cls, charging_mode, for_update=False):
+        """从数据库加载指定模式的队列状态（固定两次查询）
+
+        for_update 为 True 时使用加锁读，保证在持有调度锁后读到最新提交的数据。
+        """
+        piles = ChargingPile.objects.filter(pile_type=charging_mode).order_by('pile_id')
+        requests = ChargingRequest.objects.filter(
+            charging_mode=charging_mode,
+            current_status__in=ACTIVE_STATUSES
+        ).select_related('user')
+        if for_update:
+            piles = piles.select_for_update()
+            # 只锁请求行，不锁关联查询出的用户行
+            of = ('self',) if connection.features.has_select_for_update_of else ()
+            requests = requests.select_for_update(of=of)
+        return cls(charging_mode, list(piles), list(requests))
+
+    # ------------------------------------------------------------------
+    # 查询
+    # ------------------------------------------------------------------
+
+    def normal_piles(self):
+        """状态正常的充电桩"""
+        return [pile for pile in self.piles.values() if pile.status == 'normal']
+
+    def queue_count(self, pile):
+        """桩队列中的请求数量"""
+        return len(self.pile_queues.get(pile.pile_id, []))
+
+    def counters(self):
+        """该模式的充电站计数（见 charging.counters）"""
+        external = len(self.external)
+        pile_queue = sum(len(queue) for queue in self.pile_queues.values())
+        piles = self.piles.values()
+        return {
+            'waiting': external + pile_queue,
+            'charging': len(self.charging),
+            'external_waiting': external,
+            'pile_queue_waiting': pile_queue,
+            'total_piles': len(self.piles),
+            'working_piles': sum(1 for pile in piles if pile.is_working),
+            'fault_piles': sum(1 for pile in piles if pile.status == 'fault'),
+            'offline_piles': sum(1 for pile in piles if pile.status == 'offline'),
+        }
+
+    def is_queue_full(self, pile):
+        """桩队列是否已满"""
+        return self.queue_count(pile) >= pile.max_queue_size
+
+    def has_free_slot(self, pile):
+        """桩状态正常且队列未满"""
+        return pile.status == 'normal' and not self.is_queue_full(pile)
+
+    def charging_minutes(self, request, pile=None):
+        """请求在指定桩上的充电时间(分钟)，未指定桩时使用请求自身的估算"""
+        pile = pile or request.charging_pile
+        if pile is None:
+            return request.get_estimated_charging_time()
+        return (request.requested_amount / pile.charging_power) * 60
+
+    def current_remaining_minutes(self, pile):
+        """桩上正在充电请求的剩余时间(分钟)"""
+        current = self.charging.get(pile.pile_id)
+        if current is None:
+            return 0
+        remaining_amount = max(current.requested_amount - current.current_amount, 0)
+        return (remaining_amount / pile.charging_power) * 60
+
+    def remaining_time(self, pile):
+        """桩的预计剩余时间(分钟)：当前充电剩余时间 + 桩队列中所有请求的充电时间"""
+        total = self.current_remaining_minutes(pile)
+        for request in self.pile_queues.get(pile.pile_id, []):
+            total += self.charging_minutes(request, pile)
+        return total
+
+    def external_wait_times(self, extra=None):
+        """模拟各桩依次接车，估算外部等候区每个请求开始充电前的等待时间(分钟)
+
+        以各桩的完成时间（当前充电剩余 + 桩队列充电时间的前缀和）建立最小堆，
+        外部等候区按顺序依次交给最早空出的桩，每次交接 O(log P)。
+        extra 为不在外部等候区中的请求时，按排在队尾估算。返回 {pk: 分钟}。
+        """
+        candidates = list(self.external)
+        if extra is not None and all(request.pk != extra.pk for request in candidates):
+            candidates.append(extra)
+
+        timeline = [(self.remaining_time(pile), pile.pile_id) for pile in self.normal_piles()]
+        if not timeline:
+            return {request.pk: NO_PILE_WAIT_TIME for request in candidates}
+        heapq.heapify(timeline)
+
+        waits = {}
+        for request in candidates:
+            finish_time, pile_id = timeline[0]
+            waits[request.pk] = int(finish_time)
+            heapq.heapreplace(timeline, (
+                finish_time + self.charging_minutes(request, self.piles[pile_id]),
+                pile_id
+            ))
+        return waits
+
+    def find(self, request):
+        """返回请求在状态中的实例，不存在时返回 None"""
+        for queued in self._all_requests():
+            if queued.pk == request.pk:
+                return queued
+        return None
+
+    def _all_requests(self):
+        yield from self.external
+        for queue in self.pile_queues.values():
+            yield from queue
+        yield from self.charging.values()
+
+    # ------------------------------------------------------------------
+    # 实例归并
+    # ------------------------------------------------------------------
+
+    def attach(self, request):
+        """用调用方持有的实例替换状态中的同一请求，调度字段以加载时的数据库值为准"""
+        containers = [self.external] + list(self.pile_queues.values())
+        for container in containers:
+            for index, existing in enumerate(container):
+                if existing.pk == request.pk:
+                    if existing is not request:
+                        self._adopt(existing, request)
+                        container[index] = request
+                    return request
+
+        for pile_id, existing in self.charging.items():
+            if existing.pk == request.pk:
+                if existing is not request:
+                    self._adopt(existing, request)
+                    self.charging[pile_id] = request
+                return request
+
+        if request.charging_pile_id in self.piles:
+            request.charging_pile = self.piles[request.charging_pile_id]
+        return request
+
+    def _adopt(self, existing, request):
+        for field in QUEUE_FIELDS:
+            setattr(request, field, getattr(existing, field))
+        request.charging_pile = self.piles.get(existing.charging_pile_id)
+        dirty = self._dirty_requests.pop(existing.pk, None)
+        if dirty is not None:
+            self._dirty_requests[request.pk] = (request, dirty[1])
+
+    def attach_pile(self, pile):
+        """用调用方持有的充电桩实例替换状态中的实例"""
+        existing = self.piles.get(pile.pile_id)
+        if existing is None or existing is pile:
+            return pile
+        pile.is_working = existing.is_working
+        pile.estimated_remaining_time = existing.estimated_remaining_time
+        self.piles[pile.pile_id] = pile
+        for request in self._all_requests():
+            if request.charging_pile_id == pile.pile_id:
+                request.charging_pile = pile
+        dirty = self._dirty_piles.pop(pile.pile_id, None)
+        if dirty is not None:
+            self._dirty_piles[pile.pile_id] = (pile, dirty[1])
+        return pile
+
+    def detach(self, request):
+        """把请求从所有队列中移除（已记录的待写变更保留）"""
+        self.external = [r for r in self.external if r.pk != request.pk]
+        for pile_id, queue in self.pile_queues.items():
+            self.pile_queues[pile_id] = [r for r in queue if r.pk != request.pk]
+        for pile_id, current in list(self.charging.items()):
+            if current.pk == request.pk:
+                del self.charging[pile_id]
+
+    # ------------------------------------------------------------------
+    # 变更
+    # ------------------------------------------------------------------
+
+    def mark_dirty(self, request, *fields):
+        """记录请求需要写回的字段"""
+        _, existing = self._dirty_requests.get(request.pk, (request, set()))
+        existing.update(fields)
+        self._dirty_requests[request.pk] = (request, existing)
+
+    def mark_pile_dirty(self, pile, *fields):
+        """记录充电桩需要写回的字段"""
+        _, existing = self._dirty_piles.get(pile.pile_id, (pile, set()))
+        existing.update(fields)
+        self._dirty_piles[pile.pile_id] = (pile, existing)
+
+    def insert_external(self, request, index=None):
+        """加入外部等候区（默认排到末尾），位置由 renumber_external 统一重排"""
+        self.detach(request)
+        request.queue_level = 'external_waiting'
+        request.current_status = 'waiting'
+        request.charging_pile = None
+        request.pile_queue_position = 0
+        if index is None:
+            self.external.append(request)
+        else:
+            self.external.insert(index, request)
+        self.mark_dirty(request, 'queue_level', 'current_status', 'charging_pile',
+                        'pile_queue_position', 'external_queue_position')
+
+    def renumber_external(self):
+        """按当前顺序把外部等候区位置重排为 1..N，返回位置发生变化的请求"""
+        changed = []
+        for position, request in enumerate(self.external, 1):
+            if request.external_queue_position != position:
+                request.external_queue_position = position
+                self.mark_dirty(request, 'external_queue_position')
+                changed.append(request)
+        return changed
+
+    def enqueue_pile(self, request, pile):
+        """把请求从外部等候区移入桩队列末尾"""
+        self.detach(request)
+        request.queue_level = 'pile_queue'
+        request.charging_pile = pile
+        request.external_queue_position = 0
+        self.pile_queues[pile.pile_id].append(request)
+        request.pile_queue_position = len(self.pile_queues[pile.pile_id])
+        self.mark_dirty(request, 'queue_level', 'charging_pile',
+                        'pile_queue_position', 'external_queue_position')
+
+    def renumber_pile_queue(self, pile):
+        """把桩队列位置重排为 1..N，返回位置发生变化的请求"""
+        changed = []
+        for position, request in enumerate(self.pile_queues[pile.pile_id], 1):
+            if request.pile_queue_position != position:
+                request.pile_queue_position = position
+                self.mark_dirty(request, 'pile_queue_position')
+                changed.append(request)
+        return changed
+
+    def pile_wait_times(self, pile):
+        """桩队列中每个请求开始充电前的等待时间(分钟)，与队列顺序一一对应"""
+        elapsed = self.current_remaining_minutes(pile)
+        waits = []
+        for request in self.pile_queues[pile.pile_id]:
+            waits.append(int(elapsed))
+            elapsed += self.charging_minutes(request, pile)
+        return waits
+
+    def refresh_pile_wait_times(self, pile):
+        """刷新桩队列中所有请求的预计等待时间"""
+        queue = self.pile_queues[pile.pile_id]
+        for request, wait in zip(queue, self.pile_wait_times(pile)):
+            if request.estimated_wait_time != wait:
+                request.estimated_wait_time = wait
+                self.mark_dirty(request, 'estimated_wait_time')
+
+    def start_charging(self, request, pile, start_time):
+        """请求离开桩队列并开始充电"""
+        self.detach(request)
+        request.queue_level = 'charging'
+        request.current_status = 'charging'
+        request.start_time = start_time
+        request.pile_queue_position = 0
+        request.estimated_wait_time = 0
+        request.charging_pile = pile
+        self.charging[pile.pile_id] = request
+        self.mark_dirty(request, 'queue_level', 'current_status', 'start_time',
+                        'pile_queue_position', 'estimated_wait_time')
+
+        pile.is_working = True
+        self.mark_pile_dirty(pile, 'is_working')
+
+        self._new_sessions.append(ChargingSession(
+            request=request,
+            pile=pile,
+            user_id=request.user_id,
+            vehicle_id=request.vehicle_id,
+            start_time=start_time
+        ))
+
+    def finish_charging(self, request, pile):
+        """请求结束充电并释放充电桩"""
+        self.detach(request)
+        if pile is not None:
+            pile.is_working = False
+            self.mark_pile_dirty(pile, 'is_working')
+
+    def notify(self, user_id, notification_type, message):
+        """记录一条待发送的通知"""
+        self._notifications.append(Notification(
+            user_id=user_id,
+            type=notification_type,
+            message=message
+        ))
+
+    # ------------------------------------------------------------------
+    # 写回
+    # ------------------------------------------------------------------
+
+    def _remember_positions(self, request):
+        self._loaded_positions[request.pk] = {
+            field: getattr(request, field)
+            for field in POSITION_FIELDS + ('queue_level', 'charging_pile_id')
+        }
+
+    def flush(self):
+        """把本次事件的所有变更写回数据库，返回请求或通知有变化的用户ID集合
+
+        整体平移的位置（如队首离开后其后所有请求前移一位）合并为按位移量分组的
+        F 表达式 UPDATE，其余字段按字段组合批量写回。
+        """
+        now = timezone.now()
+
+        for pile in self.piles.values():
+            remaining = int(self.remaining_time(pile))
+            if pile.estimated_remaining_time != remaining:
+                pile.estimated_remaining_time = remaining
+                self.mark_pile_dirty(pile, 'estimated_remaining_time')
+
+        self._shift_positions(now)
+        self._bulk_update(ChargingRequest, self._dirty_requests, now)
+        # 充电桩的 updated_at 只随状态修改（save()）更新，故障检测按它的水位增量读取
+        self._bulk_update(ChargingPile, self._dirty_piles)
+
+        if self._new_sessions:
+            ChargingSession.objects.bulk_create(self._new_sessions)
+        if self._notifications:
+            Notification.objects.bulk_create(self._notifications)
+        record_counters(self.charging_mode, self.counters())
+
+        changed_users = {request.user_id for request, _ in self._dirty_requests.values()}
+        changed_users.update(notification.user_id for notification in self._notifications)
+
+        for request in self._all_requests():
+            self._remember_positions(request)
+        self._dirty_requests = {}
+        self._dirty_piles = {}
+        self._new_sessions = []
+        self._notifications = []
+        return changed_users
+
+    def _shift_positions(self, now):
+        """把位移量相同的位置变化合并为一条 UPDATE ... SET pos = pos + delta"""
+        shifts = defaultdict(list)
+        for pk, (request, fields) in self._dirty_requests.items():
+            loaded = self._loaded_positions.get(pk)
+            # 只有仍在原队列中的请求才是位移，换了队列的请求按绝对位置写回
+            if (loaded is None or loaded['queue_level'] != request.queue_level
+                    or loaded['charging_pile_id'] != request.charging_pile_id):
+                continue
+            for field in POSITION_FIELDS:
+                if field not in fields:
+                    continue
+                delta = getattr(request, field) - loaded[field]
+                if delta == 0:
+                    fields.discard(field)
+                else:
+                    shifts[(field, delta)].append(pk)
+
+        for (field, delta), pks in shifts.items():
+            # 单条记录的变化直接随批量写回，无需单独的语句
+            if len(pks) < 2:
+                continue
+            ChargingRequest.objects.filter(pk__in=pks).update(
+                **{field: F(field) + delta, 'updated_at': now}
+            )
+            for pk in pks:
+                self._dirty_requests[pk][1].discard(field)
+
+    @staticmethod
+    def _bulk_update(model, dirty, now=None):
+        """按字段组合分组批量写回，每组只更新自身变化的字段；给出 now 时一并更新 updated_at"""
+        groups = defaultdict(list)
+        for obj, obj_fields in dirty.values():
+            if obj_fields:
+                groups[frozenset(obj_fields)].append(obj)
+
+        for fields, objs in groups.items():
+            if now is not None:
+                for obj in objs:
+                    obj.updated_at = now
+                fields = fields | {'updated_at'}
+            model.objects.bulk_update(objs, sorted(fields))
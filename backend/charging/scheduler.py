@@ -0,0 +1,199 @@
+"""
+单写者调度
+
+scheduler_mode 参数为 queued 时，接口和充电进度进程不再直接修改队列，而是写入
+SchedulerCommand 并等待执行结果。每种充电模式由一个调度进程（run_scheduler 命令）
+批量读取待执行命令，在同一个事务、同一次队列状态加载中依次执行后统一写回，
+从而消除多个写者之间的锁竞争，高峰期一次提交即可处理多个事件。
+"""
+
+import logging
+import time
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import ChargingRequest, SchedulerCommand
+from .services import AdvancedChargingQueueService
+from charging.utils.parameter_manager import get_scheduler_config
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerCommandError(Exception):
+    """调度命令执行失败或等待超时"""
+
+
+def get_queue_service(clock=None):
+    """按 scheduler_mode 参数返回直接调度服务或调度命令代理
+
+    clock 为业务时间的来源（默认 timezone.now）；单写者模式下命令由调度进程按其自身时间执行。
+    """
+    if get_scheduler_config()['mode'] == 'queued':
+        return QueuedChargingQueueService(clock)
+    return AdvancedChargingQueueService(clock)
+
+
+def execute_command(service, command):
+    """在调度进程中执行一条命令，返回可序列化的执行结果"""
+    payload = command.payload
+
+    if command.command == 'submit':
+        user = get_user_model().objects.get(pk=payload['user_id'])
+        charging_request = service.submit_charging_request(user, payload['data'])
+        return {'request_id': str(charging_request.pk)}
+
+    charging_request = ChargingRequest.objects.select_related('user').get(pk=payload['request_id'])
+    if command.command == 'cancel':
+        service.cancel_charging_request(charging_request)
+    elif command.command == 'change_mode':
+        service.change_charging_mode(charging_request, payload['new_charging_mode'])
+    elif command.command == 'complete':
+        service.complete_charging(charging_request, payload.get('charged_amount'))
+    else:
+        raise SchedulerCommandError(f'未知的调度命令: {command.command}')
+
+    return {'request_id': str(charging_request.pk)}
+
+
+class SchedulerWorker:
+    """单一充电模式的调度进程：批量读取命令并在一个事务中执行"""
+
+    def __init__(self, charging_mode, batch_size=None):
+        self.charging_mode = charging_mode
+        self.batch_size = batch_size or get_scheduler_config()['batch_size']
+
+    def run(self, poll_interval=0.05, should_stop=lambda: False):
+        """循环执行命令，没有待执行命令时按 poll_interval 休眠"""
+        while not should_stop():
+            if not self.run_once():
+                time.sleep(poll_interval)
+
+    def run_once(self):
+        """执行一批待执行命令，返回本批命令数"""
+        with transaction.atomic():
+            commands = list(
+                SchedulerCommand.objects.select_for_update(skip_locked=True)
+                .filter(charging_mode=self.charging_mode, status='pending')
+                .order_by('id')[:self.batch_size]
+            )
+            if not commands:
+                return 0
+
+            try:
+                with transaction.atomic():
+                    self._execute(commands)
+            except Exception as e:
+                # 整批回滚后逐条执行，只让出错的命令失败
+                logger.warning(f"{self.charging_mode} 调度批次执行失败，改为逐条执行: {e}")
+                for command in commands:
+                    try:
+                        with transaction.atomic():
+                            self._execute([command])
+                    except Exception as command_error:
+                        self._fail(command, command_error)
+
+            SchedulerCommand.objects.bulk_update(commands, ['status', 'result', 'error', 'processed_at'])
+
+        logger.debug(f"{self.charging_mode} 调度进程执行 {len(commands)} 条命令")
+        return len(commands)
+
+    def _execute(self, commands):
+        """在一次调度事件中依次执行命令（共享调度锁、队列状态和最终写回）"""
+        service = AdvancedChargingQueueService()
+
+        # 修改充电类型会涉及另一个模式，两个模式的调度锁按固定顺序预先获取
+        modes = {self.charging_mode}
+        modes.update(
+            command.payload['new_charging_mode']
+            for command in commands if command.command == 'change_mode'
+        )
+
+        with service._mode_locks(modes), service._queue_event(self.charging_mode):
+            for command in commands:
+                command.result = execute_command(service, command)
+                command.status = 'done'
+                command.error = ''
+                command.processed_at = timezone.now()
+
+    def _fail(self, command, error):
+        logger.error(f"调度命令 #{command.pk} ({command.command}) 执行失败: {error}")
+        command.status = 'failed'
+        command.result = {'error_type': type(error).__name__}
+        command.error = str(error)
+        command.processed_at = timezone.now()
+
+
+class QueuedChargingQueueService(AdvancedChargingQueueService):
+    """单写者模式下的队列服务：修改队列的操作写入调度命令表并等待调度进程执行
+
+    调用方处于事务中时无法等待调度进程读取到命令，此时直接在当前事务中执行。
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def submit_charging_request(self, user, data):
+        if connection.in_atomic_block:
+            return super().submit_charging_request(user, data)
+
+        result = self._send(data['charging_mode'], 'submit', {'user_id': user.pk, 'data': dict(data)})
+        return ChargingRequest.objects.select_related('user', 'vehicle').get(pk=result['request_id'])
+
+    def cancel_charging_request(self, charging_request):
+        if connection.in_atomic_block:
+            return super().cancel_charging_request(charging_request)
+
+        self._send(charging_request.charging_mode, 'cancel', {'request_id': str(charging_request.pk)})
+        charging_request.refresh_from_db()
+
+    def change_charging_mode(self, charging_request, new_charging_mode):
+        if connection.in_atomic_block:
+            return super().change_charging_mode(charging_request, new_charging_mode)
+
+        self._send(charging_request.charging_mode, 'change_mode', {
+            'request_id': str(charging_request.pk),
+            'new_charging_mode': new_charging_mode
+        })
+        charging_request.refresh_from_db()
+        return charging_request
+
+    def complete_charging(self, charging_request, charged_amount=None):
+        if connection.in_atomic_block:
+            return super().complete_charging(charging_request, charged_amount)
+
+        # 结算、通知和释放充电桩由调度进程在同一个事务中执行
+        self._send(charging_request.charging_mode, 'complete', {
+            'request_id': str(charging_request.pk),
+            'charged_amount': charged_amount
+        })
+        charging_request.refresh_from_db()
+
+    def _send(self, charging_mode, command, payload):
+        """写入调度命令并等待执行结果"""
+        scheduler_command = SchedulerCommand.objects.create(
+            charging_mode=charging_mode,
+            command=command,
+            payload=payload
+        )
+        deadline = time.monotonic() + get_scheduler_config()['command_timeout']
+
+        while True:
+            row = SchedulerCommand.objects.filter(pk=scheduler_command.pk).values('status', 'result', 'error').get()
+            if row['status'] == 'done':
+                return row['result'] or {}
+            if row['status'] == 'failed':
+                if (row['result'] or {}).get('error_type') == 'ValueError':
+                    raise ValueError(row['error'])
+                raise SchedulerCommandError(row['error'])
+
+            if time.monotonic() >= deadline:
+                # 超时后撤销仍未执行的命令，避免调用方放弃后命令仍被执行
+                cancelled = SchedulerCommand.objects.filter(pk=scheduler_command.pk, status='pending').update(
+                    status='failed',
+                    error='等待调度进程超时',
+                    processed_at=timezone.now()
+                )
+                if cancelled:
+                    raise SchedulerCommandError(f'等待调度进程执行命令 #{scheduler_command.pk} 超时')
+                # 撤销失败说明调度进程已取走命令，按轮询间隔继续等待执行结果
+
+            time.sleep(self.POLL_INTERVAL)
@@ -69,7 +69,7 @@ class ChargingRequestSerializer(serializers.ModelSerializer):
         
         # 如果已分配充电桩，添加桩的预计剩余时间
         if obj.charging_pile:
-            pile_remaining = obj.charging_pile.calculate_remaining_time()
+            pile_remaining = obj.charging_pile.estimated_remaining_time
             estimates['pile_remaining_time'] = pile_remaining
             estimates['pile_remaining_display'] = format_time(pile_remaining)
         
@@ -129,6 +129,18 @@ class ChargingRequestSerializer(serializers.ModelSerializer):
             }
         return None
 
+class ActiveChargingRequestSerializer(ChargingRequestSerializer):
+    """活跃请求的读取模型：附加前方等待人数和队列状态描述
+    
+    配合 ChargingRequest.objects.active_for() 使用，所有字段都来自同一条联表查询。
+    """
+    ahead_count = serializers.IntegerField(source='get_ahead_count', read_only=True)
+    queue_status = serializers.CharField(source='get_queue_status_display', read_only=True)
+    
+    class Meta(ChargingRequestSerializer.Meta):
+        fields = ChargingRequestSerializer.Meta.fields + ['ahead_count', 'queue_status']
+        read_only_fields = ChargingRequestSerializer.Meta.read_only_fields + ['ahead_count', 'queue_status']
+
 class ChargingRequestCreateSerializer(serializers.ModelSerializer):
     vehicle_id = serializers.IntegerField(write_only=True, required=True)
     
@@ -199,7 +211,6 @@ class ChargingPileSerializer(serializers.ModelSerializer):
     current_vehicle = serializers.SerializerMethodField()
     queue = serializers.SerializerMethodField()
     queue_count = serializers.SerializerMethodField()
-    estimated_remaining_time = serializers.SerializerMethodField()
     
     class Meta:
         model = ChargingPile
@@ -210,19 +221,13 @@ class ChargingPileSerializer(serializers.ModelSerializer):
     
     def get_current_user(self, obj):
         if obj.is_working:
-            current_request = ChargingRequest.objects.filter(
-                charging_pile=obj, 
-                current_status='charging'
-            ).first()
+            current_request = obj.get_current_request()
             return current_request.user.username if current_request else None
         return None
     
     def get_current_vehicle(self, obj):
         if obj.is_working:
-            current_request = ChargingRequest.objects.filter(
-                charging_pile=obj, 
-                current_status='charging'
-            ).first()
+            current_request = obj.get_current_request()
             if current_request and current_request.vehicle:
                 return {
                     'license_plate': current_request.vehicle.license_plate,
@@ -234,17 +239,8 @@ class ChargingPileSerializer(serializers.ModelSerializer):
         """获取当前桩队列数量"""
         return obj.get_queue_count()
     
-    def get_estimated_remaining_time(self, obj):
-        """获取预计剩余时间"""
-        return obj.calculate_remaining_time()
-    
     def get_queue(self, obj):
-        """获取桩队列信息"""
-        queue_requests = ChargingRequest.objects.filter(
-            charging_pile=obj,
-            queue_level='pile_queue'
-        ).order_by('pile_queue_position')[:3]  # 显示前3个
-        
+        """获取桩队列信息（批量序列化时先用 ChargingPile.objects.with_queue_details() 预取）"""
         return [
             {
                 'queue_number': req.queue_number,
@@ -252,7 +248,7 @@ class ChargingPileSerializer(serializers.ModelSerializer):
                 'position': req.pile_queue_position,
                 'requested_amount': req.requested_amount
             }
-            for req in queue_requests
+            for req in obj.get_queued_requests(3)  # 显示前3个
         ]
 
 class ChargingSessionSerializer(serializers.ModelSerializer):
@@ -283,6 +279,42 @@ class ChargingSessionSerializer(serializers.ModelSerializer):
             }
         return None
 
+class PileTelemetryBatchSerializer(serializers.ListSerializer):
+    """一批电表读数：逐条校验字段后用一次查询校验充电桩是否存在
+
+    校验失败的读数记入 rejected（[{'index', 'errors'}]），不影响同一批中的其他读数，
+    validated_data 只包含通过校验的读数。
+    """
+    
+    def to_internal_value(self, data):
+        self.rejected = []
+        valid = []
+        for index, item in enumerate(data):
+            try:
+                valid.append((index, self.child.run_validation(item)))
+            except serializers.ValidationError as e:
+                self.rejected.append({'index': index, 'errors': e.detail})
+        
+        piles = ChargingPile.objects.in_bulk({reading['pile_id'] for _, reading in valid})
+        readings = []
+        for index, reading in valid:
+            if reading['pile_id'] in piles:
+                readings.append(reading)
+            else:
+                self.rejected.append({'index': index, 'errors': {'pile_id': ['充电桩不存在']}})
+        self.rejected.sort(key=lambda item: item['index'])
+        return readings
+
+class PileTelemetryReadingSerializer(serializers.Serializer):
+    """充电桩电表读数（累计电量）"""
+    pile_id = serializers.CharField(max_length=20)
+    timestamp = serializers.DateTimeField()
+    cumulative_kwh = serializers.FloatField(min_value=0)
+    power_kw = serializers.FloatField(min_value=0)
+    
+    class Meta:
+        list_serializer_class = PileTelemetryBatchSerializer
+
 class SystemParameterSerializer(serializers.ModelSerializer):
     class Meta:
         model = SystemParameter
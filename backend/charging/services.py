@@ -1,9 +1,16 @@
+from contextlib import contextmanager
+from functools import partial
 from django.db import transaction
 from django.utils import timezone
 from django.db.models import F
-from .models import ChargingRequest, ChargingPile, Notification, SystemParameter
+from .models import ChargingRequest, ChargingPile, Notification, PileStatusEvent, QueueLock, SystemParameter
+from .counters import refresh_counters
+from .events import publish_queue_change
+from .queue_state import ModeQueueState
 from decimal import Decimal
-from charging.utils.parameter_manager import ParameterManager, get_queue_config, get_fault_handling_config
+from charging.utils.parameter_manager import ParameterManager, get_queue_config, get_fault_handling_config, get_dispatch_config
+from charging.utils.queue_number import QueueNumberAllocator
+from charging.utils import dispatch_optimizer
 import logging
 
 logger = logging.getLogger(__name__)
@@ -11,15 +18,75 @@ logger = logging.getLogger(__name__)
 class AdvancedChargingQueueService:
     """高级充电排队服务 - 多级队列系统"""
     
-    def __init__(self):
+    def __init__(self, clock=None):
+        # 业务时间（开始、结束充电的时刻）的来源，加速或虚拟时钟下由守护进程和模拟器传入
+        self.clock = clock or timezone.now
         # 使用新的参数管理器获取配置
         queue_config = get_queue_config()
         self.external_waiting_limit = queue_config['external_waiting_area_size']
         self.SystemParameter = SystemParameter
+        # 当前调度事件中已加载的各模式队列状态
+        self._states = {}
+        # 当前事务中已持有调度锁的模式
+        self._locked_modes = set()
         
     def _get_parameter(self, key, default):
         """获取系统参数（优化版，使用参数管理器）"""
         return ParameterManager.get_parameter(key, default)
+    
+    @contextmanager
+    def _mode_locks(self, charging_modes):
+        """在当前事务中锁定指定模式的调度锁行（按固定顺序加锁，避免死锁）
+        
+        锁通过 UPDATE 递增版本号获得，直到事务结束才释放，同一模式的调度因此串行执行。
+        """
+        acquired = []
+        try:
+            for charging_mode in sorted(set(charging_modes)):
+                if charging_mode in self._locked_modes:
+                    continue
+                updated = QueueLock.objects.filter(charging_mode=charging_mode).update(
+                    version=F('version') + 1,
+                    updated_at=timezone.now()
+                )
+                if not updated:
+                    QueueLock.objects.get_or_create(charging_mode=charging_mode)
+                    QueueLock.objects.filter(charging_mode=charging_mode).update(
+                        version=F('version') + 1,
+                        updated_at=timezone.now()
+                    )
+                self._locked_modes.add(charging_mode)
+                acquired.append(charging_mode)
+            yield
+        finally:
+            self._locked_modes.difference_update(acquired)
+    
+    @contextmanager
+    def _queue_event(self, charging_mode):
+        """调度事件：首次进入时锁定并加载该模式的队列状态，最外层退出时统一写回"""
+        state = self._states.get(charging_mode)
+        if state is not None:
+            yield state
+            return
+        
+        with transaction.atomic(), self._mode_locks([charging_mode]):
+            state = ModeQueueState.load(charging_mode, for_update=True)
+            self._states[charging_mode] = state
+            try:
+                yield state
+                self._refresh_external_wait_times(state)
+                changed_users = state.flush()
+                # 提交后推送给本进程中订阅的连接
+                transaction.on_commit(partial(publish_queue_change, charging_mode, changed_users))
+            finally:
+                del self._states[charging_mode]
+    
+    def _queue_snapshot(self, charging_mode):
+        """只读访问队列状态：处于调度事件中时复用事件状态，否则临时加载且不写回"""
+        state = self._states.get(charging_mode)
+        if state is not None:
+            return state
+        return ModeQueueState.load(charging_mode)
         
     def can_join_external_queue(self):
         """检查是否可以加入外部等候区"""
@@ -32,163 +99,185 @@ class AdvancedChargingQueueService:
             logger.error(f"检查外部等候区容量失败: {e}")
             return True
     
+    def submit_charging_request(self, user, data):
+        """创建充电请求并加入外部等候区
+        
+        data 为已校验的提交参数（charging_mode、requested_amount、battery_capacity、vehicle_id）
+        """
+        with transaction.atomic():
+            charging_request = ChargingRequest.objects.create(
+                user=user,
+                vehicle_id=data['vehicle_id'],
+                charging_mode=data['charging_mode'],
+                requested_amount=data['requested_amount'],
+                battery_capacity=data['battery_capacity']
+            )
+            self.add_to_external_queue(charging_request)
+        return charging_request
+    
     def add_to_external_queue(self, charging_request):
         """添加到外部等候区"""
-        with transaction.atomic():
-            # 计算外部等候区位置
-            same_mode_external = ChargingRequest.objects.filter(
-                charging_mode=charging_request.charging_mode,
-                queue_level='external_waiting'
-            ).count()
-            
-            charging_request.queue_level = 'external_waiting'
-            charging_request.external_queue_position = same_mode_external + 1
-            charging_request.pile_queue_position = 0
-            charging_request.current_status = 'waiting'
-            
-            # 计算预计等待时间
-            charging_request.estimated_wait_time = self._calculate_external_wait_time(charging_request)
-            charging_request.save()
-            
-            # 在尝试转移前，先标准化队列位置（防止数据不一致）
-            self._normalize_external_queue_positions(charging_request.charging_mode)
+        with self._queue_event(charging_request.charging_mode) as state:
+            # 排到外部等候区末尾（预计等待时间在事件结束时统一计算）
+            state.insert_external(charging_request)
+            self._update_external_queue_positions(charging_request.charging_mode)
+            position = charging_request.external_queue_position
             
             # 立即尝试转移到桩队列
             transferred = self._try_transfer_to_pile_queue(charging_request)
             
-            # 如果转移成功，再次确保位置连续
-            if transferred:
-                self._normalize_external_queue_positions(charging_request.charging_mode)
-            
-            logger.info(f"用户 {charging_request.user.username} 加入外部等候区，位置: {charging_request.external_queue_position}, 已转移: {transferred}")
+            logger.info(f"用户 {charging_request.user.username} 加入外部等候区，位置: {position}, 已转移: {transferred}")
     
     def _calculate_external_wait_time(self, charging_request):
         """计算外部等候区的预计等待时间"""
-        # 获取所有同模式的可用桩
-        available_piles = ChargingPile.objects.filter(
-            pile_type=charging_request.charging_mode,
-            status='normal'
-        )
-        
-        if not available_piles.exists():
-            return 999  # 没有可用桩
-        
-        # 计算最短等待时间
-        min_wait_time = float('inf')
-        for pile in available_piles:
-            pile_wait_time = pile.calculate_remaining_time()
-            if not pile.is_queue_full():
-                # 桩队列未满，可以直接加入
-                min_wait_time = min(min_wait_time, pile_wait_time)
-            else:
-                # 桩队列已满，需要等待队列中的最后一个完成
-                min_wait_time = min(min_wait_time, pile_wait_time + charging_request.get_estimated_charging_time())
-        
-        # 考虑前面等待的人数
-        ahead_count = charging_request.external_queue_position - 1
-        base_wait_time = min_wait_time if min_wait_time != float('inf') else 30
-        
-        return int(base_wait_time + ahead_count * 10)  # 每个前面的人额外等待10分钟
+        state = self._queue_snapshot(charging_request.charging_mode)
+        return self._estimate_external_wait(state, charging_request)
     
-    def _try_transfer_to_pile_queue(self, charging_request):
+    def _estimate_external_wait(self, state, charging_request):
+        """基于内存队列状态估算外部等候区的等待时间"""
+        return state.external_wait_times(extra=charging_request)[charging_request.pk]
+    
+    def _refresh_external_wait_times(self, state):
+        """事件结束前统一刷新外部等候区所有请求的预计等待时间（每个模式只模拟一次）"""
+        if not state.external:
+            return
+        wait_times = state.external_wait_times()
+        for request in state.external:
+            wait_time = wait_times[request.pk]
+            if request.estimated_wait_time != wait_time:
+                request.estimated_wait_time = wait_time
+                state.mark_dirty(request, 'estimated_wait_time')
+    
+    def _try_transfer_to_pile_queue(self, charging_request, ignore_pause=False):
         """尝试将请求从外部等候区转移到桩队列（修改版，考虑暂停状态）"""
         if charging_request.queue_level != 'external_waiting':
             return False
         
-        # 检查是否暂停了叫号
-        if self.is_external_queue_paused(charging_request.charging_mode):
+        # 检查是否暂停了叫号（故障队列优先调度时跳过该检查）
+        if not ignore_pause and self._external_queue_paused(charging_request.charging_mode):
             logger.debug(f"外部等候区叫号已暂停，跳过转移请求 {charging_request.queue_number}")
             return False
         
-        # 查找最优桩（剩余时间最短且队列未满）
-        best_pile = self._find_best_available_pile(charging_request.charging_mode)
-        
-        if best_pile:
-            with transaction.atomic():
-                # 记录原来的位置
-                original_position = charging_request.external_queue_position
-                
-                # 转移到桩队列
-                self._transfer_to_pile_queue(charging_request, best_pile)
-                
-                # 更新外部等候区位置
-                self._update_external_queue_positions(charging_request.charging_mode, original_position)
-                
-                # 尝试开始充电
-                self._try_start_charging(charging_request)
-                
-                return True
-        
-        return False
+        with self._queue_event(charging_request.charging_mode) as state:
+            return self._dispatch_to_piles(state, [charging_request]) == 1
     
-    def _find_best_available_pile(self, charging_mode):
-        """找到最优的可用充电桩（剩余时间最短且队列未满）"""
-        available_piles = ChargingPile.objects.filter(
-            pile_type=charging_mode,
-            status='normal'
-        )
+    def _dispatch_to_piles(self, state, requests, strategy=None):
+        """批量调度：把请求分配到有空位的桩，返回转移的数量
+        
+        strategy 未指定时使用 dispatch_strategy 参数：greedy 逐个选择剩余时间最短的桩，
+        batch_optimal 把本轮请求与所有空位作为一个指派问题求解（不可用或超时时退回 greedy）。
+        """
+        if not requests:
+            return 0
+        
+        dispatch_config = get_dispatch_config()
+        strategy = strategy or dispatch_config['strategy']
+        
+        plan = None
+        if strategy == 'batch_optimal':
+            plan = self._plan_batch_optimal_dispatch(state, requests, dispatch_config['time_budget_ms'])
+        if plan is None:
+            plan = self._plan_greedy_dispatch(state, requests)
+        
+        transferred = 0
+        for pile, pile_requests in plan:
+            for request in pile_requests:
+                # 转移到桩队列并尝试开始充电
+                self._transfer_to_pile_queue(request, pile)
+                self._try_start_charging(request)
+                transferred += 1
         
-        best_pile = None
-        min_wait_time = float('inf')
+        if transferred:
+            # 更新外部等候区位置
+            self._update_external_queue_positions(state.charging_mode)
+        return transferred
+    
+    def _dispatch_problem(self, state, requests):
+        """构造调度问题：返回可用桩列表和 (请求电量, 桩每kWh分钟数, 桩剩余时间, 桩可接收数量)
+        
+        空闲桩接收的第一个请求会直接开始充电，不占队列位置，因此可多接收一个请求。
+        """
+        piles, rates, base_times, capacities = [], [], [], []
+        for pile in state.normal_piles():
+            if state.is_queue_full(pile):
+                continue
+            queue_count = state.queue_count(pile)
+            capacity = pile.max_queue_size - queue_count
+            if not pile.is_working and queue_count == 0:
+                capacity += 1
+            piles.append(pile)
+            rates.append(60 / pile.charging_power)
+            base_times.append(state.remaining_time(pile))
+            capacities.append(capacity)
+        
+        amounts = [request.requested_amount for request in requests]
+        return piles, (amounts, rates, base_times, capacities)
+    
+    def _plan_greedy_dispatch(self, state, requests):
+        """贪心调度方案：按顺序把每个请求交给预计完成时间最早的桩
+        
+        对所有有空位的桩建立以预计完成时间为键的最小堆（与逐个选择剩余时间最短的桩等价）。
+        """
+        piles, arguments = self._dispatch_problem(state, requests)
+        plan = dispatch_optimizer.plan_greedy_dispatch(*arguments)
+        return [
+            (pile, [requests[index] for index in indexes])
+            for pile, indexes in zip(piles, plan) if indexes
+        ]
+    
+    def _plan_batch_optimal_dispatch(self, state, requests, time_budget_ms):
+        """批量最优调度方案：最小化本轮调度请求的完成时间之和
+        
+        本轮调度数量与贪心策略相同（按顺序取前 N 个请求，N 为空位总数），只优化它们在各桩上的分配和先后。
+        返回 None 表示无法求解，由调用方退回贪心策略。
+        """
+        if not dispatch_optimizer.is_available():
+            logger.warning("未安装 NumPy，batch_optimal 调度退回贪心策略")
+            return None
         
-        for pile in available_piles:
-            if not pile.is_queue_full():
-                # 更新桩的剩余时间
-                remaining_time = pile.calculate_remaining_time()
-                
-                if remaining_time < min_wait_time:
-                    min_wait_time = remaining_time
-                    best_pile = pile
+        piles, arguments = self._dispatch_problem(state, requests)
+        try:
+            plan = dispatch_optimizer.plan_optimal_dispatch(*arguments, time_budget_ms=time_budget_ms)
+        except dispatch_optimizer.DispatchTimeout:
+            logger.warning(
+                f"{state.charging_mode} 批量最优调度超出 {time_budget_ms}ms 预算"
+                f"（{len(requests)} 个请求，{len(piles)} 个桩），退回贪心策略"
+            )
+            return None
         
-        return best_pile
+        return [
+            (pile, [requests[index] for index in indexes])
+            for pile, indexes in zip(piles, plan) if indexes
+        ]
     
     def _transfer_to_pile_queue(self, charging_request, pile):
         """将请求转移到指定桩的队列"""
-        # 计算在该桩队列中的位置
-        pile_queue_count = pile.get_queue_count()
-        
-        charging_request.queue_level = 'pile_queue'
-        charging_request.charging_pile = pile
-        charging_request.pile_queue_position = pile_queue_count + 1
-        charging_request.estimated_wait_time = pile.calculate_remaining_time()
-        charging_request.save()
-        
-        # 发送通知
-        Notification.objects.create(
-            user=charging_request.user,
-            type='queue_transfer',
-            message=f'您的充电请求 {charging_request.queue_number} 已转入充电桩 {pile.pile_id} 的队列，位置：第{charging_request.pile_queue_position}位'
-        )
-        
-        logger.info(f"请求 {charging_request.queue_number} 转移到桩 {pile.pile_id} 队列，位置: {charging_request.pile_queue_position}")
+        with self._queue_event(charging_request.charging_mode) as state:
+            state.enqueue_pile(charging_request, pile)
+            state.refresh_pile_wait_times(pile)
+            
+            # 发送通知
+            state.notify(
+                charging_request.user_id,
+                'queue_transfer',
+                f'您的充电请求 {charging_request.queue_number} 已转入充电桩 {pile.pile_id} 的队列，位置：第{charging_request.pile_queue_position}位'
+            )
+            
+            logger.info(f"请求 {charging_request.queue_number} 转移到桩 {pile.pile_id} 队列，位置: {charging_request.pile_queue_position}")
     
-    def _update_external_queue_positions(self, charging_mode, removed_position):
-        """更新外部等候区中后续请求的位置"""
-        subsequent_requests = ChargingRequest.objects.filter(
-            charging_mode=charging_mode,
-            queue_level='external_waiting',
-            external_queue_position__gt=removed_position
-        )
-        
-        for request in subsequent_requests:
-            request.external_queue_position -= 1
-            request.estimated_wait_time = self._calculate_external_wait_time(request)
-            request.save()
+    def _update_external_queue_positions(self, charging_mode):
+        """按当前顺序重排外部等候区位置（等待时间在事件结束时统一刷新）"""
+        with self._queue_event(charging_mode) as state:
+            state.renumber_external()
     
     def _normalize_external_queue_positions(self, charging_mode):
         """标准化外部等候区的队列位置，确保从1开始连续排列"""
-        external_requests = ChargingRequest.objects.filter(
-            charging_mode=charging_mode,
-            queue_level='external_waiting'
-        ).order_by('created_at')  # 按创建时间排序，保持公平
-        
-        for i, request in enumerate(external_requests, 1):
-            if request.external_queue_position != i:
-                request.external_queue_position = i
-                request.estimated_wait_time = self._calculate_external_wait_time(request)
-                request.save()
-        
-        logger.info(f"标准化 {charging_mode} 充电外部等候区位置，共 {external_requests.count()} 个请求")
+        with self._queue_event(charging_mode) as state:
+            # 按创建时间排序，保持公平
+            state.external.sort(key=lambda request: request.created_at)
+            self._update_external_queue_positions(charging_mode)
+            
+            logger.info(f"标准化 {charging_mode} 充电外部等候区位置，共 {len(state.external)} 个请求")
     
     def _try_start_charging(self, charging_request):
         """尝试开始充电"""
@@ -202,132 +291,112 @@ class AdvancedChargingQueueService:
     
     def _start_charging(self, charging_request, pile):
         """开始充电"""
-        with transaction.atomic():
-            charging_request.queue_level = 'charging'
-            charging_request.current_status = 'charging'
-            charging_request.start_time = timezone.now()
-            charging_request.save()
-            
-            pile.is_working = True
-            pile.save()
-            
-            # 创建充电会话
-            from .models import ChargingSession
-            ChargingSession.objects.create(
-                request=charging_request,
-                pile=pile,
-                user=charging_request.user,
-                vehicle=charging_request.vehicle,
-                start_time=timezone.now()
-            )
+        with self._queue_event(charging_request.charging_mode) as state:
+            # 离开桩队列、占用充电桩并创建充电会话
+            state.start_charging(charging_request, pile, self.clock())
             
             # 更新桩队列位置
-            self._update_pile_queue_positions(pile, charging_request.pile_queue_position)
+            self._update_pile_queue_positions(pile)
             
             # 发送通知
-            Notification.objects.create(
-                user=charging_request.user,
-                type='charging_start',
-                message=f'您的充电请求 {charging_request.queue_number} 已开始充电，充电桩：{pile.pile_id}'
+            state.notify(
+                charging_request.user_id,
+                'charging_start',
+                f'您的充电请求 {charging_request.queue_number} 已开始充电，充电桩：{pile.pile_id}'
             )
             
             logger.info(f"请求 {charging_request.queue_number} 开始在桩 {pile.pile_id} 充电")
     
-    def _update_pile_queue_positions(self, pile, removed_position):
-        """更新桩队列中后续请求的位置"""
-        subsequent_requests = ChargingRequest.objects.filter(
-            charging_pile=pile,
-            queue_level='pile_queue',
-            pile_queue_position__gt=removed_position
-        )
-        
-        for request in subsequent_requests:
-            request.pile_queue_position -= 1
-            request.estimated_wait_time = pile.calculate_remaining_time()
-            request.save()
+    def _update_pile_queue_positions(self, pile):
+        """重排桩队列位置，并刷新队列中请求的等待时间"""
+        with self._queue_event(pile.pile_type) as state:
+            state.renumber_pile_queue(pile)
+            state.refresh_pile_wait_times(pile)
     
-    def complete_charging(self, charging_request):
-        """完成充电"""
-        with transaction.atomic():
+    def complete_charging(self, charging_request, charged_amount=None):
+        """完成充电：结算会话、发送完成通知、释放充电桩并推进队列
+
+        所有变更在同一个调度事件（同一事务）中提交，任何一步失败都整体回滚。
+        charged_amount 为主动结束充电时记入的充电量，默认使用已充电量。
+        """
+        with self._queue_event(charging_request.charging_mode) as state:
+            state.attach(charging_request)
             pile = charging_request.charging_pile
-            
-            # 更新请求状态
+
+            # 调用方读取状态后请求可能已被其他事件结束，以加锁后的状态为准
+            if not any(current.pk == charging_request.pk for current in state.charging.values()):
+                raise ValueError("充电请求不在充电中，无法完成")
+
+            # 更新请求状态并释放充电桩
+            now = self.clock()
+            if charged_amount is not None:
+                charging_request.current_amount = charged_amount
             charging_request.queue_level = 'completed'
             charging_request.current_status = 'completed'
-            charging_request.end_time = timezone.now()
-            charging_request.save()
-            
-            # 释放充电桩
-            pile.is_working = False
-            pile.save()
-            
+            charging_request.end_time = now
+            state.finish_charging(charging_request, pile)
+            state.mark_dirty(charging_request, 'queue_level', 'current_status', 'end_time', 'current_amount')
+
+            # 结算充电会话并发送完成通知
+            message = f'您的充电请求 {charging_request.queue_number} 已完成，共充电 {charging_request.current_amount} kWh'
+            if hasattr(charging_request, 'session'):
+                session = charging_request.session
+                session.end_time = now
+                session.charging_amount = charging_request.current_amount
+                BillingService().calculate_bill(session)
+                session.save()
+                message += f'，总费用 {session.total_cost} 元'
+            state.notify(charging_request.user_id, 'charging_complete', message)
+
             # 处理桩队列中的下一个请求
-            self._process_next_in_pile_queue(pile)
-            
-            # 更新所有桩的剩余时间（因为一个桩空闲了，可能影响外部等候区的计算）
-            self._update_all_pile_remaining_times(charging_request.charging_mode)
+            if pile is not None:
+                self._process_next_in_pile_queue(pile)
             
-            # 尝试从外部等候区转移更多请求
+            # 尝试从外部等候区转移更多请求（桩剩余时间在事件写回时统一刷新）
             self._process_external_queue_transfers(charging_request.charging_mode)
     
     def _process_next_in_pile_queue(self, pile):
         """处理桩队列中的下一个请求"""
-        next_request = ChargingRequest.objects.filter(
-            charging_pile=pile,
-            queue_level='pile_queue'
-        ).order_by('pile_queue_position').first()
-        
-        if next_request:
-            self._start_charging(next_request, pile)
-    
-    def _update_all_pile_remaining_times(self, charging_mode):
-        """更新所有同模式桩的剩余时间"""
-        piles = ChargingPile.objects.filter(
-            pile_type=charging_mode,
-            status='normal'
-        )
-        
-        for pile in piles:
-            pile.calculate_remaining_time()
+        with self._queue_event(pile.pile_type) as state:
+            pile_queue = state.pile_queues.get(pile.pile_id)
+            if pile_queue:
+                self._start_charging(pile_queue[0], pile)
     
     def _process_external_queue_transfers(self, charging_mode):
-        """处理外部等候区的转移请求"""
-        external_requests = ChargingRequest.objects.filter(
-            charging_mode=charging_mode,
-            queue_level='external_waiting'
-        ).order_by('external_queue_position')
-        
-        for request in external_requests:
-            if self._try_transfer_to_pile_queue(request):
-                # 成功转移一个后，继续尝试下一个
-                continue
-            else:
-                # 没有可用桩了，停止尝试
-                break
+        """处理外部等候区的转移请求（一次调度填满所有空位）"""
+        if self._external_queue_paused(charging_mode):
+            return 0
+        
+        with self._queue_event(charging_mode) as state:
+            transferred = self._dispatch_to_piles(state, list(state.external))
+            if transferred:
+                logger.info(f"{charging_mode} 外部等候区批量转移 {transferred} 个请求到桩队列")
+            return transferred
     
     def cancel_charging_request(self, charging_request):
         """取消充电请求"""
-        with transaction.atomic():
-            if charging_request.queue_level == 'external_waiting':
+        with self._queue_event(charging_request.charging_mode) as state:
+            state.attach(charging_request)
+            previous_level = charging_request.queue_level
+            pile = charging_request.charging_pile
+            
+            # 调用方读取状态后请求可能已被其他事件叫号开始充电，以加锁后的状态为准
+            if previous_level not in ('external_waiting', 'pile_queue'):
+                raise ValueError("正在充电中或已结束的请求无法取消")
+            
+            state.detach(charging_request)
+            charging_request.current_status = 'cancelled'
+            charging_request.queue_level = 'completed'
+            state.mark_dirty(charging_request, 'current_status', 'queue_level')
+            
+            if previous_level == 'external_waiting':
                 # 更新外部等候区位置
-                self._update_external_queue_positions(
-                    charging_request.charging_mode, 
-                    charging_request.external_queue_position
-                )
-                # 确保位置连续
-                self._normalize_external_queue_positions(charging_request.charging_mode)
-            elif charging_request.queue_level == 'pile_queue':
+                self._update_external_queue_positions(charging_request.charging_mode)
+            elif previous_level == 'pile_queue' and pile is not None:
                 # 更新桩队列位置
-                self._update_pile_queue_positions(
-                    charging_request.charging_pile, 
-                    charging_request.pile_queue_position
-                )
+                self._update_pile_queue_positions(pile)
                 # 尝试从外部等候区转移请求补充
                 self._process_external_queue_transfers(charging_request.charging_mode)
-            
-            charging_request.current_status = 'cancelled'
-            charging_request.queue_level = 'completed'
-            charging_request.save()
     
     def change_charging_mode(self, charging_request, new_charging_mode):
         """修改充电类型（仅限外部等候区的请求）"""
@@ -340,62 +409,50 @@ class AdvancedChargingQueueService:
         if new_charging_mode not in ['fast', 'slow']:
             raise ValueError("充电类型必须是 'fast' 或 'slow'")
         
-        with transaction.atomic():
-            old_mode = charging_request.charging_mode
-            old_position = charging_request.external_queue_position
-            
-            # 记录原始信息用于通知
-            original_queue_number = charging_request.queue_number
-            
+        old_mode = charging_request.charging_mode
+        
+        # 记录原始信息用于通知
+        original_queue_number = charging_request.queue_number
+        
+        # 两个模式的调度锁按固定顺序一次性获取
+        with transaction.atomic(), self._mode_locks([old_mode, new_charging_mode]), \
+                self._queue_event(old_mode) as old_state:
             # 从原队列中移除
-            self._update_external_queue_positions(old_mode, old_position)
-            self._normalize_external_queue_positions(old_mode)
-            
-            # 修改充电类型
-            charging_request.charging_mode = new_charging_mode
-            
-            # 重新生成排队号
-            prefix = 'F' if new_charging_mode == 'fast' else 'S'
-            timestamp = timezone.now().strftime('%m%d%H%M')
-            count = ChargingRequest.objects.filter(
-                charging_mode=new_charging_mode,
-                created_at__date=timezone.now().date()
-            ).count() + 1
-            charging_request.queue_number = f"{prefix}{timestamp}{count:03d}"
-            
-            # 重新加入外部等候区（排队到末尾）
-            same_mode_external = ChargingRequest.objects.filter(
-                charging_mode=new_charging_mode,
-                queue_level='external_waiting'
-            ).count()
-            
-            charging_request.external_queue_position = same_mode_external + 1
-            charging_request.estimated_wait_time = self._calculate_external_wait_time(charging_request)
-            charging_request.save()
+            old_state.attach(charging_request)
+            old_state.detach(charging_request)
+            self._update_external_queue_positions(old_mode)
             
-            # 立即尝试转移到桩队列
-            transferred = self._try_transfer_to_pile_queue(charging_request)
-            
-            # 如果转移成功，再次确保位置连续
-            if transferred:
-                self._normalize_external_queue_positions(new_charging_mode)
-            
-            # 发送通知
-            from .models import Notification
-            mode_display = "快充" if new_charging_mode == 'fast' else "慢充"
-            old_mode_display = "快充" if old_mode == 'fast' else "慢充"
-            
-            Notification.objects.create(
-                user=charging_request.user,
-                type='charging_mode_change',
-                message=f'您的充电请求已从{old_mode_display}（{original_queue_number}）改为{mode_display}（{charging_request.queue_number}），'
-                       f'当前位置：{charging_request.get_queue_status_display()}'
-            )
-            
-            logger.info(f"用户 {charging_request.user.username} 修改充电类型：{old_mode} -> {new_charging_mode}，"
-                       f"新排队号：{charging_request.queue_number}，位置：{charging_request.external_queue_position}")
-            
-            return charging_request
+            with self._queue_event(new_charging_mode) as new_state:
+                # 修改充电类型
+                charging_request.charging_mode = new_charging_mode
+                
+                # 重新生成排队号
+                charging_request.queue_number = QueueNumberAllocator.next_queue_number(new_charging_mode)
+                
+                # 重新加入外部等候区（排队到末尾）
+                new_state.insert_external(charging_request)
+                new_state.mark_dirty(charging_request, 'charging_mode', 'queue_number')
+                self._update_external_queue_positions(new_charging_mode)
+                new_position = charging_request.external_queue_position
+                
+                # 立即尝试转移到桩队列
+                self._try_transfer_to_pile_queue(charging_request)
+                
+                # 发送通知
+                mode_display = "快充" if new_charging_mode == 'fast' else "慢充"
+                old_mode_display = "快充" if old_mode == 'fast' else "慢充"
+                
+                new_state.notify(
+                    charging_request.user_id,
+                    'charging_mode_change',
+                    f'您的充电请求已从{old_mode_display}（{original_queue_number}）改为{mode_display}（{charging_request.queue_number}），'
+                    f'当前位置：{charging_request.get_queue_status_display()}'
+                )
+                
+                logger.info(f"用户 {charging_request.user.username} 修改充电类型：{old_mode} -> {new_charging_mode}，"
+                           f"新排队号：{charging_request.queue_number}，位置：{new_position}")
+        
+        return charging_request
     
     def get_queue_status(self, charging_mode=None):
         """获取队列状态"""
@@ -407,29 +464,18 @@ class AdvancedChargingQueueService:
         result = {}
         
         for mode in modes:
+            state = self._queue_snapshot(mode)
+            
             # 外部等候区状态
-            external_queue = ChargingRequest.objects.filter(
-                charging_mode=mode,
-                queue_level='external_waiting'
-            ).order_by('external_queue_position')
+            external_queue = state.external
             
             # 获取所有桩的状态
-            piles = ChargingPile.objects.filter(
-                pile_type=mode,
-                status='normal'
-            )
+            piles = state.normal_piles()
             
             pile_status = []
             for pile in piles:
-                pile_queue = ChargingRequest.objects.filter(
-                    charging_pile=pile,
-                    queue_level='pile_queue'
-                ).order_by('pile_queue_position')
-                
-                current_charging = ChargingRequest.objects.filter(
-                    charging_pile=pile,
-                    current_status='charging'
-                ).first()
+                pile_queue = state.pile_queues[pile.pile_id]
+                current_charging = state.charging.get(pile.pile_id)
                 
                 pile_status.append({
                     'pile_id': pile.pile_id,
@@ -438,7 +484,7 @@ class AdvancedChargingQueueService:
                         'queue_number': current_charging.queue_number if current_charging else None,
                         'progress': (current_charging.current_amount / current_charging.requested_amount * 100) if current_charging else 0
                     },
-                    'queue_count': pile_queue.count(),
+                    'queue_count': len(pile_queue),
                     'max_queue_size': pile.max_queue_size,
                     'estimated_remaining_time': pile.estimated_remaining_time,
                     'queue_list': [
@@ -453,7 +499,7 @@ class AdvancedChargingQueueService:
             
             result[mode] = {
                 'external_waiting': {
-                    'count': external_queue.count(),
+                    'count': len(external_queue),
                     'queue_list': [
                         {
                             'queue_number': req.queue_number,
@@ -464,7 +510,7 @@ class AdvancedChargingQueueService:
                     ]
                 },
                 'piles': pile_status,
-                'total_waiting': external_queue.count() + sum(pile.get_queue_count() for pile in piles)
+                'total_waiting': len(external_queue) + sum(state.queue_count(pile) for pile in piles)
             }
         
         return result
@@ -548,13 +594,44 @@ class AdvancedChargingQueueService:
         
         return enhanced_data
 
+    def change_pile_status(self, pile_id, new_status, source='api', reason=''):
+        """修改充电桩状态并记录状态变更事件，返回 (充电桩, 事件)；状态未变化时事件为 None
+        
+        故障和恢复处理由进度守护进程读取事件后执行，与守护进程发现状态变化时的处理一致。
+        """
+        with transaction.atomic():
+            pile = ChargingPile.objects.select_for_update().get(pile_id=pile_id)
+            previous_status = pile.status
+            if previous_status == new_status:
+                return pile, None
+            
+            pile.status = new_status
+            pile.save(update_fields=['status', 'updated_at'])
+            # 递增队列版本号，使排队状态快照和完成定时器重新读取
+            QueueLock.objects.filter(charging_mode=pile.pile_type).update(
+                version=F('version') + 1,
+                updated_at=timezone.now()
+            )
+            refresh_counters([pile.pile_type])
+            transaction.on_commit(partial(publish_queue_change, pile.pile_type))
+            event = PileStatusEvent.objects.create(
+                pile=pile,
+                from_status=previous_status,
+                to_status=new_status,
+                source=source,
+                reason=reason
+            )
+        
+        logger.info(f"充电桩 {pile_id} 状态变更: {previous_status} -> {new_status}（来源: {source}）")
+        return pile, event
+
     def handle_pile_fault(self, pile):
         """处理充电桩故障"""
-        from django.db import transaction
-        
         logger.warning(f"检测到充电桩 {pile.pile_id} 故障，开始故障处理流程")
         
-        with transaction.atomic():
+        with self._queue_event(pile.pile_type) as state:
+            state.attach_pile(pile)
+            
             # 1. 立即停止当前充电（如果有）
             current_charging = self._stop_current_charging_due_to_fault(pile)
             
@@ -571,6 +648,9 @@ class AdvancedChargingQueueService:
             elif dispatch_strategy == 'time_order':
                 # 时间顺序调度：与同类车辆合并排序
                 self._handle_fault_time_order_dispatch(pile, fault_queue_requests)
+            elif dispatch_strategy == 'batch_optimal':
+                # 批量最优调度：故障队列整体优先，一次求解分配到各桩
+                self._handle_fault_batch_optimal_dispatch(pile, fault_queue_requests)
             else:
                 # 默认使用优先级调度
                 self._handle_fault_priority_dispatch(pile, fault_queue_requests)
@@ -586,60 +666,49 @@ class AdvancedChargingQueueService:
 
     def _stop_current_charging_due_to_fault(self, pile):
         """停止故障桩上的当前充电"""
-        from .models import ChargingRequest, ChargingSession, Notification
-        from django.utils import timezone
-        
-        current_charging = ChargingRequest.objects.filter(
-            charging_pile=pile,
-            current_status='charging'
-        ).first()
-        
-        if not current_charging:
-            return None
+        with self._queue_event(pile.pile_type) as state:
+            current_charging = state.charging.get(pile.pile_id)
             
-        logger.info(f"停止用户 {current_charging.user.username} 在故障桩 {pile.pile_id} 的充电")
-        
-        # 更新请求状态
-        current_charging.current_status = 'completed'
-        current_charging.end_time = timezone.now()
-        current_charging.queue_level = 'completed'
-        current_charging.save()
-        
-        # 释放充电桩
-        pile.is_working = False
-        pile.save()
-        
-        # 结束充电会话并计费
-        session = current_charging.session
-        session.end_time = timezone.now()
-        
-        # 计算充电时长
-        duration = session.end_time - session.start_time
-        session.charging_duration = duration.total_seconds() / 3600
-        session.charging_amount = current_charging.current_amount
-        
-        # 计算费用（故障导致的提前结束）
-        billing_service = BillingService()
-        billing_service.calculate_bill(session)
-        session.save()
-        
-        # 创建故障通知
-        Notification.objects.create(
-            user=current_charging.user,
-            type='pile_fault',
-            message=f'充电桩 {pile.pile_id} 发生故障，您的充电已提前结束。实际充电 {current_charging.current_amount:.2f} kWh，费用 {session.total_cost} 元。'
-        )
-        
-        return current_charging
+            if not current_charging:
+                return None
+                
+            logger.info(f"停止用户 {current_charging.user.username} 在故障桩 {pile.pile_id} 的充电")
+            
+            # 更新请求状态并释放充电桩
+            now = self.clock()
+            current_charging.current_status = 'completed'
+            current_charging.end_time = now
+            current_charging.queue_level = 'completed'
+            state.finish_charging(current_charging, pile)
+            state.mark_dirty(current_charging, 'current_status', 'end_time', 'queue_level')
+            
+            # 结束充电会话并计费
+            session = current_charging.session
+            session.end_time = now
+            
+            # 计算充电时长
+            duration = session.end_time - session.start_time
+            session.charging_duration = duration.total_seconds() / 3600
+            session.charging_amount = current_charging.current_amount
+            
+            # 计算费用（故障导致的提前结束）
+            billing_service = BillingService()
+            billing_service.calculate_bill(session)
+            session.save()
+            
+            # 创建故障通知
+            state.notify(
+                current_charging.user_id,
+                'pile_fault',
+                f'充电桩 {pile.pile_id} 发生故障，您的充电已提前结束。实际充电 {current_charging.current_amount:.2f} kWh，费用 {session.total_cost} 元。'
+            )
+            
+            return current_charging
 
     def _get_fault_queue_requests(self, pile):
         """获取故障桩队列中的所有请求"""
-        from .models import ChargingRequest
-        
-        return list(ChargingRequest.objects.filter(
-            charging_pile=pile,
-            queue_level='pile_queue'
-        ).order_by('pile_queue_position'))
+        state = self._queue_snapshot(pile.pile_type)
+        return list(state.pile_queues.get(pile.pile_id, []))
 
     def _handle_fault_priority_dispatch(self, fault_pile, fault_queue_requests):
         """优先级调度：暂停等候区叫号，优先处理故障队列"""
@@ -648,9 +717,9 @@ class AdvancedChargingQueueService:
         # 1. 暂停等候区叫号（通过设置系统参数）
         self._pause_external_queue_calling(fault_pile.pile_type)
         
-        # 2. 优先重新分配故障队列中的请求
-        for request in fault_queue_requests:
-            self._reassign_request_priority(request)
+        # 2. 优先重新分配故障队列中的请求（保持其在原桩队列中的先后顺序）
+        for index, request in enumerate(fault_queue_requests):
+            self._reassign_request_priority(request, index)
         
         # 3. 在所有故障请求处理完毕后恢复等候区叫号
         self._schedule_resume_external_queue_calling(fault_pile.pile_type)
@@ -663,12 +732,33 @@ class AdvancedChargingQueueService:
         for request in fault_queue_requests:
             self._reassign_request_time_order(request)
 
+    def _handle_fault_batch_optimal_dispatch(self, fault_pile, fault_queue_requests):
+        """批量最优调度：故障队列请求优先，作为一个指派问题一次分配到可用桩"""
+        logger.info(f"采用批量最优调度策略处理故障桩 {fault_pile.pile_id} 的 {len(fault_queue_requests)} 个请求")
+        
+        self._pause_external_queue_calling(fault_pile.pile_type)
+        
+        with self._queue_event(fault_pile.pile_type) as state:
+            # 故障请求插入外部等候区队首（保持原先后顺序），再一次性调度
+            for index, request in enumerate(fault_queue_requests):
+                state.insert_external(request, index)
+            self._update_external_queue_positions(fault_pile.pile_type)
+            self._dispatch_to_piles(state, list(fault_queue_requests), strategy='batch_optimal')
+            
+            for request in fault_queue_requests:
+                state.notify(
+                    request.user_id,
+                    'queue_transfer',
+                    f'由于充电桩 {fault_pile.pile_id} 故障，您的请求 {request.queue_number} 已重新调度，当前位置：{request.get_queue_status_display()}'
+                )
+        
+        self._schedule_resume_external_queue_calling(fault_pile.pile_type)
+
     def _pause_external_queue_calling(self, pile_type):
         """暂停指定类型的外部等候区叫号"""
         param_key = f'{pile_type}_external_queue_paused'
         
         # 设置暂停标志
-        from .models import SystemParameter
         param, created = SystemParameter.objects.get_or_create(
             param_key=param_key,
             defaults={
@@ -680,81 +770,47 @@ class AdvancedChargingQueueService:
         if not created:
             param.param_value = 'true'
             param.save()
+        self._set_external_queue_paused(pile_type, True)
             
         logger.info(f"已暂停 {pile_type} 外部等候区叫号")
 
-    def _reassign_request_priority(self, request):
+    def _reassign_request_priority(self, request, index=0):
         """优先级模式重新分配请求"""
-        from .models import Notification
-        
-        # 清除原桩分配
-        original_pile = request.charging_pile
-        request.charging_pile = None
-        request.queue_level = 'external_waiting'
-        request.pile_queue_position = 0
-        
-        # 先保存到数据库（临时位置）
-        request.external_queue_position = 999  # 临时位置，避免冲突
-        request.save()
-        
-        # 更新其他外部等候区请求的位置（为故障请求让出第1位）
-        ChargingRequest.objects.filter(
-            charging_mode=request.charging_mode,
-            queue_level='external_waiting'
-        ).exclude(id=request.id).update(
-            external_queue_position=F('external_queue_position') + 1
-        )
-        
-        # 设置故障请求为第1位
-        request.external_queue_position = 1  # 优先级最高，插入队首
-        request.estimated_wait_time = self._calculate_external_wait_time(request)
-        request.save()
-        
-        # 立即尝试转移到可用桩
-        transferred = self._try_transfer_to_pile_queue(request)
-        
-        # 如果转移成功，需要重新整理外部等候区位置
-        if transferred:
-            self._normalize_external_queue_positions(request.charging_mode)
-        
-        # 发送重新调度通知
-        Notification.objects.create(
-            user=request.user,
-            type='queue_transfer',
-            message=f'由于充电桩 {original_pile.pile_id} 故障，您的请求 {request.queue_number} 已重新调度，当前位置：{request.get_queue_status_display()}'
-        )
+        with self._queue_event(request.charging_mode) as state:
+            # 清除原桩分配，插入外部等候区队首（优先级最高）
+            original_pile = request.charging_pile
+            state.insert_external(request, index)
+            self._update_external_queue_positions(request.charging_mode)
+            
+            # 立即尝试转移到可用桩（故障队列不受叫号暂停限制）
+            self._try_transfer_to_pile_queue(request, ignore_pause=True)
+            
+            # 发送重新调度通知
+            state.notify(
+                request.user_id,
+                'queue_transfer',
+                f'由于充电桩 {original_pile.pile_id} 故障，您的请求 {request.queue_number} 已重新调度，当前位置：{request.get_queue_status_display()}'
+            )
 
     def _reassign_request_time_order(self, request):
         """时间顺序模式重新分配请求"""
-        from .models import Notification
-        from django.db.models import F
-        
-        # 清除原桩分配
-        original_pile = request.charging_pile
-        request.charging_pile = None
-        request.queue_level = 'external_waiting'
-        request.pile_queue_position = 0
-        
-        # 先临时保存
-        request.external_queue_position = 999  # 临时位置
-        request.save()
-        
-        # 重新标准化所有外部等候区位置（按时间顺序）
-        self._normalize_external_queue_positions(request.charging_mode)
-        
-        # 尝试转移到可用桩
-        transferred = self._try_transfer_to_pile_queue(request)
-        
-        # 如果转移成功，需要重新整理外部等候区位置
-        if transferred:
+        with self._queue_event(request.charging_mode) as state:
+            # 清除原桩分配
+            original_pile = request.charging_pile
+            state.insert_external(request)
+            
+            # 重新标准化所有外部等候区位置（按时间顺序）
             self._normalize_external_queue_positions(request.charging_mode)
-        
-        # 发送重新调度通知
-        Notification.objects.create(
-            user=request.user,
-            type='queue_transfer',
-            message=f'由于充电桩 {original_pile.pile_id} 故障，您的请求 {request.queue_number} 已按时间顺序重新排队，当前位置：{request.get_queue_status_display()}'
-        )
+            
+            # 尝试转移到可用桩
+            self._try_transfer_to_pile_queue(request)
+            
+            # 发送重新调度通知
+            state.notify(
+                request.user_id,
+                'queue_transfer',
+                f'由于充电桩 {original_pile.pile_id} 故障，您的请求 {request.queue_number} 已按时间顺序重新排队，当前位置：{request.get_queue_status_display()}'
+            )
 
     def _schedule_resume_external_queue_calling(self, pile_type):
         """安排恢复外部等候区叫号（在所有故障请求处理完毕后）"""
@@ -766,7 +822,6 @@ class AdvancedChargingQueueService:
         """恢复指定类型的外部等候区叫号"""
         param_key = f'{pile_type}_external_queue_paused'
         
-        from .models import SystemParameter
         try:
             param = SystemParameter.objects.get(param_key=param_key)
             param.param_value = 'false'
@@ -774,37 +829,49 @@ class AdvancedChargingQueueService:
             logger.info(f"已恢复 {pile_type} 外部等候区叫号")
         except SystemParameter.DoesNotExist:
             pass  # 参数不存在说明没有暂停过
+        self._set_external_queue_paused(pile_type, False)
+
+    def resume_stalled_external_queue(self, pile_type):
+        """故障桩队列已处理完但叫号仍处于暂停时恢复叫号并补充调度，返回是否恢复
+        
+        正常流程中故障处理结束即恢复叫号；该方法用于清理进程中断等原因遗留的暂停标志。
+        """
+        if not self.is_external_queue_paused(pile_type):
+            return False
+        
+        with self._queue_event(pile_type) as state:
+            if not self._external_queue_paused(pile_type):
+                return False
+            if any(state.pile_queues.get(pile.pile_id) for pile in state.piles.values() if pile.status != 'normal'):
+                return False
+            
+            self._resume_external_queue_calling(pile_type)
+            self._process_external_queue_transfers(pile_type)
+            return True
 
     def _send_fault_notifications(self, pile, current_charging, fault_queue_requests):
         """发送故障相关通知"""
-        from .models import Notification
-        
-        # 给队列中的用户发送通知
-        for request in fault_queue_requests:
-            Notification.objects.create(
-                user=request.user,
-                type='pile_fault',
-                message=f'充电桩 {pile.pile_id} 发生故障，您的充电请求 {request.queue_number} 已重新调度。'
-            )
+        with self._queue_event(pile.pile_type) as state:
+            # 给队列中的用户发送通知
+            for request in fault_queue_requests:
+                state.notify(
+                    request.user_id,
+                    'pile_fault',
+                    f'充电桩 {pile.pile_id} 发生故障，您的充电请求 {request.queue_number} 已重新调度。'
+                )
 
     def handle_pile_recovery(self, pile):
         """处理充电桩故障恢复"""
-        from django.db import transaction
-        
         logger.info(f"检测到充电桩 {pile.pile_id} 故障恢复，开始恢复处理流程")
         
-        with transaction.atomic():
-            # 1. 检查是否还有其他同类桩仍有排队车辆
-            same_type_piles = ChargingPile.objects.filter(
-                pile_type=pile.pile_type,
-                status='normal'
-            ).exclude(pile_id=pile.pile_id)
+        with self._queue_event(pile.pile_type) as state:
+            state.attach_pile(pile)
             
+            # 1. 检查是否还有其他同类桩仍有排队车辆
             has_queue = any(
-                ChargingRequest.objects.filter(
-                    charging_pile=p,
-                    queue_level='pile_queue'
-                ).exists() for p in same_type_piles
+                state.pile_queues[p.pile_id]
+                for p in state.normal_piles()
+                if p.pile_id != pile.pile_id
             )
             
             if has_queue:
@@ -822,37 +889,44 @@ class AdvancedChargingQueueService:
 
     def _unified_reschedule_after_recovery(self, pile_type):
         """故障恢复后的统一重新调度"""
-        from .models import ChargingRequest
-        
-        # 获取所有同类型的正常桩队列中的请求
-        all_pile_requests = ChargingRequest.objects.filter(
-            charging_mode=pile_type,
-            queue_level='pile_queue'
-        ).order_by('created_at')  # 按时间顺序
-        
-        # 临时将所有请求移回外部等候区
-        for request in all_pile_requests:
-            request.queue_level = 'external_waiting'
-            request.charging_pile = None
-            request.pile_queue_position = 0
-            request.save()
-        
-        # 重新计算外部等候区位置
-        for i, request in enumerate(all_pile_requests, 1):
-            request.external_queue_position = i
-            request.estimated_wait_time = self._calculate_external_wait_time(request)
-            request.save()
-        
-        # 重新执行转移到桩队列的逻辑
-        self._process_external_queue_transfers(pile_type)
-        
-        logger.info(f"完成 {pile_type} 类型桩的统一重新调度，处理请求数: {len(all_pile_requests)}")
+        with self._queue_event(pile_type) as state:
+            # 获取所有同类型桩队列中的请求，按时间顺序
+            all_pile_requests = sorted(
+                (request for queue in state.pile_queues.values() for request in queue),
+                key=lambda request: request.created_at
+            )
+            
+            # 将所有请求移回外部等候区队首（它们已被叫号，排在未叫号请求之前）
+            for index, request in enumerate(all_pile_requests):
+                state.insert_external(request, index)
+            
+            # 重新计算外部等候区位置
+            self._update_external_queue_positions(pile_type)
+            
+            # 重新执行转移到桩队列的逻辑
+            self._process_external_queue_transfers(pile_type)
+            
+            logger.info(f"完成 {pile_type} 类型桩的统一重新调度，处理请求数: {len(all_pile_requests)}")
 
+    def _external_queue_paused(self, pile_type):
+        """检查叫号是否暂停：调度事件中只查询一次数据库"""
+        state = self._states.get(pile_type)
+        if state is None:
+            return self.is_external_queue_paused(pile_type)
+        if state.external_paused is None:
+            state.external_paused = self.is_external_queue_paused(pile_type)
+        return state.external_paused
+    
+    def _set_external_queue_paused(self, pile_type, paused):
+        """同步调度事件中缓存的叫号暂停状态"""
+        state = self._states.get(pile_type)
+        if state is not None:
+            state.external_paused = paused
+    
     def is_external_queue_paused(self, pile_type):
         """检查外部等候区是否暂停叫号"""
         param_key = f'{pile_type}_external_queue_paused'
         try:
-            from .models import SystemParameter
             param = SystemParameter.objects.get(param_key=param_key)
             return param.get_value() is True
         except:
@@ -875,8 +949,9 @@ class BillingService:
         duration = session.end_time - session.start_time
         session.charging_duration = duration.total_seconds() / 3600  # 转换为小时
         
-        # 模拟充电量（实际应该从充电桩获取）
-        session.charging_amount = session.request.requested_amount
+        # 充电量由进度更新、电表读数或结束充电的调用方记入会话，只在尚未记录时取请求的已充电量
+        if not session.charging_amount:
+            session.charging_amount = session.request.current_amount
         
         # 计算分时段费用
         self._calculate_time_based_cost(session)
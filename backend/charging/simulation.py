@@ -0,0 +1,374 @@
+"""
+排队服务离散事件模拟
+
+在虚拟时钟下把到达、取消、修改充电类型、完成充电、充电桩故障和恢复事件依次交给
+AdvancedChargingQueueService 执行，统计每类操作的查询数和耗时，以及请求的等待时间分布，
+用于在没有真实车辆的情况下发现 services.py 的性能退化。
+
+事件轨迹为按时间排序的字典列表（可保存为 JSON Lines 文件回放），时间单位为分钟：
+    {"time": 0.5, "op": "arrive", "car": "c1", "mode": "fast", "amount": 30}
+    {"time": 3.0, "op": "cancel", "car": "c1"}
+    {"time": 1.0, "op": "change_mode", "car": "c1", "new_mode": "slow"}
+    {"time": 9.0, "op": "complete", "car": "c1"}          # 提前结束充电
+    {"time": 20, "op": "fault", "pile": "FAST-001"}
+    {"time": 50, "op": "recover", "pile": "FAST-001"}
+请求开始充电后，模拟器按充电量和桩功率自动生成充电完成事件。
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test.utils import CaptureQueriesContext
+
+from accounts.models import User, Vehicle
+from .clock import VirtualClock
+from .models import ChargingPile, ChargingRequest
+from .services import AdvancedChargingQueueService
+from charging.utils.parameter_manager import ParameterManager, get_charging_pile_config, get_queue_config
+from charging.utils.queue_number import QueueNumberAllocator
+
+TRACE_OPS = ('arrive', 'cancel', 'change_mode', 'complete', 'fault', 'recover')
+
+# 等待时间分布的分组上限（分钟）
+WAIT_BUCKETS = (5, 15, 30, 60, 120, 240)
+
+
+def percentile(sorted_values, percent):
+    """已排序列表的百分位数（最近秩）"""
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+@contextmanager
+def in_memory_database(alias=DEFAULT_DB_ALIAS):
+    """临时把数据库连接切换到已迁移的内存 SQLite，结束后恢复原连接
+
+    参数缓存和排队号段是进程内状态，切换前后都会清空，模拟数据不会影响原数据库。
+    整个过程不访问原数据库，原数据库未迁移或无法连接时也可以运行。
+    """
+    from django.db.backends.sqlite3.base import DatabaseWrapper
+
+    original = connections[alias]
+    ParameterManager.reset_cache()
+    QueueNumberAllocator.reset()
+
+    memory = DatabaseWrapper({
+        **original.settings_dict,
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+        'USER': '',
+        'PASSWORD': '',
+        'HOST': '',
+        'PORT': '',
+        'OPTIONS': {},
+    }, alias)
+    connections[alias] = memory
+    try:
+        call_command('migrate', database=alias, verbosity=0, interactive=False)
+        yield memory
+    finally:
+        ParameterManager.reset_cache()
+        QueueNumberAllocator.reset()
+        memory.close()
+        connections[alias] = original
+
+
+def generate_trace(cars=200, arrival_rate=60.0, fast_ratio=0.5, min_amount=5.0, max_amount=60.0,
+                   cancel_ratio=0.1, change_mode_ratio=0.05, faults=1, fault_duration=30.0,
+                   pile_ids=(), seed=1):
+    """生成合成事件轨迹
+
+    到达为泊松过程（arrival_rate 辆/小时），部分请求在到达后随机时间取消或修改充电类型，
+    故障在到达时间范围内随机发生在 pile_ids 中的某个桩上，fault_duration 分钟后恢复。
+    """
+    rng = random.Random(seed)
+    trace = []
+    arrival = 0.0
+    for index in range(cars):
+        arrival += rng.expovariate(arrival_rate / 60)
+        car = f'c{index + 1}'
+        mode = 'fast' if rng.random() < fast_ratio else 'slow'
+        trace.append({
+            'time': round(arrival, 3),
+            'op': 'arrive',
+            'car': car,
+            'mode': mode,
+            'amount': round(rng.uniform(min_amount, max_amount), 1),
+        })
+        if rng.random() < cancel_ratio:
+            trace.append({'time': round(arrival + rng.uniform(1, 60), 3), 'op': 'cancel', 'car': car})
+        if rng.random() < change_mode_ratio:
+            trace.append({
+                'time': round(arrival + rng.uniform(0.5, 10), 3),
+                'op': 'change_mode',
+                'car': car,
+                'new_mode': 'slow' if mode == 'fast' else 'fast',
+            })
+
+    pile_ids = list(pile_ids)
+    for _ in range(faults if pile_ids else 0):
+        fault_time = rng.uniform(0, arrival)
+        pile_id = rng.choice(pile_ids)
+        trace.append({'time': round(fault_time, 3), 'op': 'fault', 'pile': pile_id})
+        trace.append({'time': round(fault_time + fault_duration, 3), 'op': 'recover', 'pile': pile_id})
+
+    trace.sort(key=lambda event: event['time'])
+    return trace
+
+
+def load_trace(path):
+    """读取 JSON Lines 格式的事件轨迹"""
+    trace = []
+    with open(path, encoding='utf-8') as trace_file:
+        for line_number, line in enumerate(trace_file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            if event.get('op') not in TRACE_OPS:
+                raise ValueError(f'第 {line_number} 行的事件类型无效: {event.get("op")}')
+            trace.append(event)
+    trace.sort(key=lambda event: event['time'])
+    return trace
+
+
+def save_trace(trace, path):
+    """把事件轨迹保存为 JSON Lines 文件"""
+    with open(path, 'w', encoding='utf-8') as trace_file:
+        for event in trace:
+            trace_file.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+
+def create_piles(fast_count=None, slow_count=None):
+    """按系统参数（或指定数量）创建充电桩，编号规则与 sync_charging_piles 一致"""
+    pile_config = get_charging_pile_config()
+    queue_config = get_queue_config()
+    counts = {
+        'fast': pile_config['fast_pile_num'] if fast_count is None else fast_count,
+        'slow': pile_config['slow_pile_num'] if slow_count is None else slow_count,
+    }
+    piles = []
+    for pile_type, prefix in (('fast', 'FAST'), ('slow', 'SLOW')):
+        for i in range(1, counts[pile_type] + 1):
+            piles.append(ChargingPile(
+                pile_id=f'{prefix}-{i:03d}',
+                pile_type=pile_type,
+                status='normal',
+                charging_power=pile_config[f'{pile_type}_power'],
+                max_queue_size=queue_config[f'{pile_type}_pile_max_queue_size'],
+            ))
+    return ChargingPile.objects.bulk_create(piles)
+
+
+class OperationStats:
+    """单类操作的执行统计"""
+
+    def __init__(self):
+        self.queries = []
+        self.latencies = []
+        self.skipped = 0
+
+    def record(self, queries, latency_ms):
+        self.queries.append(queries)
+        self.latencies.append(latency_ms)
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+
+class QueueSimulator:
+    """按事件轨迹驱动排队服务，收集性能和等待时间统计"""
+
+    def __init__(self, trace, service=None):
+        self.trace = trace
+        self.clock = VirtualClock()
+        self.service = service or AdvancedChargingQueueService(clock=self.clock.now)
+        self.stats = {op: OperationStats() for op in TRACE_OPS}
+        self.rejected = 0
+        self._events = []
+        self._sequence = itertools.count()
+        self._requests = {}
+        self._vehicles = {}
+        self._completion_scheduled = set()
+        self._arrivals = {}
+
+    def run(self):
+        """执行全部事件，返回 (墙钟耗时秒数, 执行的操作数)"""
+        self._create_vehicles()
+        for event in self.trace:
+            self._push(event['time'], event)
+
+        logger = logging.getLogger('charging')
+        previous_level = logger.level
+        logger.setLevel(logging.ERROR)
+        started = time.perf_counter()
+        try:
+            while self._events:
+                event_time, _, event = heapq.heappop(self._events)
+                self.clock.advance_to(event_time)
+                getattr(self, f'_{event["op"]}')(event)
+                self._schedule_completions()
+        finally:
+            logger.setLevel(previous_level)
+
+        executed = sum(stats.count for stats in self.stats.values())
+        return time.perf_counter() - started, executed
+
+    def _push(self, event_time, event):
+        heapq.heappush(self._events, (event_time, next(self._sequence), event))
+
+    def _create_vehicles(self):
+        """为轨迹中的每辆车预先创建用户和车辆（不计入统计）"""
+        cars = sorted({event['car'] for event in self.trace if event['op'] == 'arrive'})
+        users = User.objects.bulk_create([
+            User(username=f'sim_{car}', password='!') for car in cars
+        ])
+        vehicles = Vehicle.objects.bulk_create([
+            Vehicle(user=user, license_plate=f'SIM-{car}', battery_capacity=60)
+            for user, car in zip(users, cars)
+        ])
+        self._vehicles = {car: vehicle for car, vehicle in zip(cars, vehicles)}
+
+    def _measure(self, op, func):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            result = func()
+            elapsed = (time.perf_counter() - started) * 1000
+        self.stats[op].record(len(context), elapsed)
+        return result
+
+    def _request(self, event):
+        request_id = self._requests.get(event['car'])
+        if request_id is None:
+            return None
+        return ChargingRequest.objects.select_related('user').get(pk=request_id)
+
+    def _schedule_completions(self):
+        """为新开始充电的请求生成充电完成事件"""
+        charging = ChargingRequest.objects.filter(current_status='charging').values_list(
+            'id', 'start_time', 'requested_amount', 'charging_pile__charging_power'
+        )
+        for request_id, start_time, amount, power in charging:
+            if request_id in self._completion_scheduled:
+                continue
+            self._completion_scheduled.add(request_id)
+            finish = self.clock.minutes(start_time) + amount / power * 60
+            self._push(finish, {'op': 'complete', 'request_id': request_id})
+
+    def _arrive(self, event):
+        vehicle = self._vehicles[event['car']]
+        data = {
+            'charging_mode': event['mode'],
+            'requested_amount': event['amount'],
+            'battery_capacity': 60,
+            'vehicle_id': vehicle.pk,
+        }
+
+        def submit():
+            # 与提交接口一致：等候区满时拒绝
+            if not self.service.can_join_external_queue():
+                return None
+            return self.service.submit_charging_request(vehicle.user, data)
+
+        request = self._measure('arrive', submit)
+        if request is None:
+            self.rejected += 1
+        else:
+            self._requests[event['car']] = request.pk
+            self._arrivals[request.pk] = self.clock.now()
+
+    def _cancel(self, event):
+        request = self._request(event)
+        if request is None or request.current_status != 'waiting':
+            self.stats['cancel'].skipped += 1
+            return
+        try:
+            self._measure('cancel', lambda: self.service.cancel_charging_request(request))
+        except ValueError:
+            self.stats['cancel'].skipped += 1
+
+    def _change_mode(self, event):
+        request = self._request(event)
+        if (request is None or request.queue_level != 'external_waiting'
+                or request.charging_mode == event['new_mode']):
+            self.stats['change_mode'].skipped += 1
+            return
+        try:
+            self._measure('change_mode', lambda: self.service.change_charging_mode(request, event['new_mode']))
+        except ValueError:
+            self.stats['change_mode'].skipped += 1
+
+    def _complete(self, event):
+        if 'request_id' in event:
+            request_id = event['request_id']
+        else:
+            request_id = self._requests.get(event['car'])
+        request = ChargingRequest.objects.select_related('user', 'session', 'charging_pile').filter(pk=request_id).first()
+        if request is None or request.current_status != 'charging':
+            # 已被取消、提前结束或因故障停止
+            self.stats['complete'].skipped += 1
+            return
+
+        def complete():
+            # 与 update_charging_progress 的自动完成流程一致：结算、通知并释放充电桩
+            charged_minutes = (self.clock.now() - request.start_time).total_seconds() / 60
+            power = request.charging_pile.charging_power
+            self.service.complete_charging(request, min(request.requested_amount, power * charged_minutes / 60))
+
+        self._measure('complete', complete)
+
+    def _fault(self, event):
+        pile = ChargingPile.objects.filter(pile_id=event['pile']).first()
+        if pile is None or pile.status != 'normal':
+            self.stats['fault'].skipped += 1
+            return
+
+        def fault():
+            pile.status = 'fault'
+            pile.save()
+            self.service.handle_pile_fault(pile)
+
+        self._measure('fault', fault)
+
+    def _recover(self, event):
+        pile = ChargingPile.objects.filter(pile_id=event['pile']).first()
+        if pile is None or pile.status != 'fault':
+            self.stats['recover'].skipped += 1
+            return
+
+        def recover():
+            pile.status = 'normal'
+            pile.save()
+            self.service.handle_pile_recovery(pile)
+
+        self._measure('recover', recover)
+
+    def wait_times(self):
+        """各充电模式已开始充电请求的等待时间（分钟，从提交到开始充电）"""
+        waits = {'fast': [], 'slow': []}
+        # created_at 为真实时间，提交时刻取到达事件的虚拟时间
+        started = ChargingRequest.objects.filter(
+            pk__in=list(self._arrivals), start_time__isnull=False
+        ).values_list('pk', 'charging_mode', 'start_time')
+        for request_id, charging_mode, start_time in started:
+            waits[charging_mode].append((start_time - self._arrivals[request_id]).total_seconds() / 60)
+        for values in waits.values():
+            values.sort()
+        return waits
+
+    def outcome_counts(self):
+        """模拟结束时各状态的请求数"""
+        counts = {}
+        for status in ChargingRequest.objects.values_list('current_status', flat=True):
+            counts[status] = counts.get(status, 0) + 1
+        return counts
@@ -0,0 +1,129 @@
+"""
+队列状态快照缓存
+
+排队状态接口被大量客户端轮询，而队列内容只在调度事件、进度更新和充电桩变更时变化：
+调度事件和进度更新都会递增 QueueLock.version，充电桩变更会更新 charging_pile.updated_at。
+快照按这组版本缓存在进程内存中，版本未变时直接返回缓存（每次只需两条索引查询），
+版本变化后的第一次请求重建快照。
+
+缓存的快照会被多个请求共享，调用方不能修改返回的数据。
+
+同一组版本也用作轮询接口的 ETag：客户端带 If-None-Match 轮询时，
+版本未变即直接返回 304，不执行任何状态查询。
+"""
+
+import hashlib
+import threading
+from functools import wraps
+
+from django.db.models import Count, Max
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import ChargingPile, ChargingRequest, QueueLock
+
+
+def snapshot_version():
+    """当前队列内容的版本（两条查询）：各模式调度锁的版本号和充电桩的数量、最后修改时间
+
+    调度锁的 updated_at 一并计入，数据库重建后版本号从头开始也不会命中旧快照。
+    """
+    locks = tuple(sorted(QueueLock.objects.values_list('charging_mode', 'version', 'updated_at')))
+    piles = ChargingPile.objects.aggregate(count=Count('pk'), updated=Max('updated_at'))
+    return locks, piles['count'], piles['updated']
+
+
+def user_snapshot_version(user):
+    """某个用户的请求列表版本：队列版本加上该用户请求的最后修改时间（三条查询）
+
+    排队位置和充电量的变化都会递增队列版本，用户自己修改请求时更新 updated_at。
+    """
+    latest = ChargingRequest.objects.filter(user=user).aggregate(updated=Max('updated_at'))['updated']
+    return snapshot_version(), user.pk, latest
+
+
+class VersionedSnapshotCache:
+    """按版本缓存的快照：版本变化后才重新构建"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, name, build, version=None):
+        """读取快照，版本不一致时调用 build() 重建
+
+        版本必须在构建之前读取：构建期间发生的变化会使版本再次递增，旧版本下缓存的快照不会被误用。
+        """
+        version = snapshot_version() if version is None else version
+        entry = self._entries.get(name)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        with self._lock:
+            # 并发请求只构建一次
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            value = build()
+            self._entries[name] = (version, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+snapshot_cache = VersionedSnapshotCache()
+
+
+def queue_status_snapshot(charging_mode=None):
+    """排队状态快照（AdvancedChargingQueueService.get_queue_status 的缓存版本）"""
+    from .services import AdvancedChargingQueueService
+
+    return snapshot_cache.get(
+        f'queue_status:{charging_mode or "all"}',
+        lambda: AdvancedChargingQueueService().get_queue_status(charging_mode)
+    )
+
+
+def enhanced_queue_status_snapshot():
+    """增强排队状态快照（AdvancedChargingQueueService.get_enhanced_queue_status 的缓存版本）"""
+    from .services import AdvancedChargingQueueService
+
+    return snapshot_cache.get(
+        'enhanced_queue_status',
+        lambda: AdvancedChargingQueueService().get_enhanced_queue_status()
+    )
+
+
+def version_etag(version):
+    """版本对应的强 ETag"""
+    return quote_etag(hashlib.md5(repr(version).encode()).hexdigest())
+
+
+def conditional_on_version(version=None):
+    """按版本生成 ETag 的轮询接口装饰器，放在 api_view 和权限装饰器之下
+
+    version(request) 返回接口数据所依赖的版本，默认使用队列版本。
+    版本在执行视图之前读取，视图执行期间发生的变化只会让客户端下一次多取一次数据。
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            etag = version_etag(version(request) if version else snapshot_version())
+            # GET 请求的 If-None-Match 使用弱比较
+            etags = {tag.removeprefix('W/') for tag in parse_etags(request.headers.get('If-None-Match', ''))}
+            if '*' in etags or etag in etags:
+                response = Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            else:
+                response = view(request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK or not response.data.get('success', True):
+                    return response
+                response['ETag'] = etag
+            # 浏览器每次都带 ETag 重新验证，不直接使用本地缓存
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapped
+    return decorator
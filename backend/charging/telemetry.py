@@ -0,0 +1,72 @@
+"""
+充电桩电表遥测
+
+充电桩定期上报累计电表读数，一次请求可以携带多个桩的多条读数。同一个桩只使用时间最新的读数，
+会话充电量 = 读数 - 会话开始时的读数；所有会话在一个事务中批量写回，达到请求充电量的会话随即完成。
+"""
+
+from .models import ChargingRequest
+from .progress import apply_progress
+
+# 单次上报的最大读数条数
+MAX_BATCH_SIZE = 5000
+
+
+def latest_readings(readings):
+    """按充电桩取时间最新的一条读数，返回 {充电桩ID: 读数}"""
+    latest = {}
+    for reading in readings:
+        current = latest.get(reading['pile_id'])
+        if current is None or reading['timestamp'] > current['timestamp']:
+            latest[reading['pile_id']] = reading
+    return latest
+
+
+def ingest_readings(readings):
+    """写入一批已校验的电表读数（pile_id, timestamp, cumulative_kwh, power_kw），返回处理统计"""
+    latest = latest_readings(readings)
+    requests = list(
+        ChargingRequest.objects.filter(current_status='charging', charging_pile_id__in=list(latest))
+        .select_related('charging_pile', 'session', 'user')
+    )
+
+    fresh = []
+    stale = 0
+    for request in requests:
+        reading = latest[request.charging_pile_id]
+        last_reading_at = request.session.meter_reading_at if hasattr(request, 'session') else None
+        if (not request.start_time or not hasattr(request, 'session')
+                or reading['timestamp'] < request.start_time
+                or (last_reading_at and reading['timestamp'] <= last_reading_at)):
+            # 会话开始前的读数或乱序到达的旧读数
+            stale += 1
+            continue
+        fresh.append(request)
+
+    def meter_progress(request, now):
+        reading = latest[request.charging_pile_id]
+        session = request.session
+        meter_kwh = reading['cumulative_kwh']
+        if session.meter_start_kwh is None or meter_kwh - session.meter_start_kwh < request.current_amount:
+            # 首条读数（或电表清零、更换）：以已记录的充电量对齐，之后按电表增量累加
+            session.meter_start_kwh = meter_kwh - request.current_amount
+        request.current_amount = round(min(meter_kwh - session.meter_start_kwh, request.requested_amount), 2)
+        session.meter_kwh = meter_kwh
+        session.meter_power = reading['power_kw']
+        session.meter_reading_at = reading['timestamp']
+        return (reading['timestamp'] - request.start_time).total_seconds() / 3600
+
+    applied, completed = apply_progress(
+        fresh,
+        progress=meter_progress,
+        session_fields=['meter_start_kwh', 'meter_kwh', 'meter_power', 'meter_reading_at']
+    )
+
+    return {
+        'received': len(readings),
+        'piles': len(latest),
+        'applied': applied,
+        'completed': completed,
+        'stale': stale,
+        'idle': len(latest) - len(requests),
+    }
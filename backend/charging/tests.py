@@ -1,3 +1,1588 @@
-from django.test import TestCase
+# backend/charging/tests.py
+import asyncio
+import io
+import itertools
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from unittest import mock
+from datetime import timedelta
+from decimal import Decimal
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from accounts.models import User, Vehicle
+from rest_framework.authtoken.models import Token
+from .clock import Clock, ScaledClock, VirtualClock
+from .counters import CoalescedCache, count_mode, counters_cache, read_counters
+from .events import EventBroker, broker, queue_event_stream, read_request_status, wait_for_request_change, watcher
+from .leases import PileLeaseManager
+from .models import (ChargingPile, ChargingRequest, ChargingSession, Notification, PileLease, PileLeaseHolder,
+                     PileStatusEvent, QueueLock, QueueNumberSequence, SchedulerCommand)
+from .periodic import PeriodicScheduler, PeriodicTask, ProgressDaemon, VirtualTime
+from .scheduler import SchedulerWorker
+from .serialiazers import ChargingPileSerializer, ChargingRequestSerializer
+from .services import AdvancedChargingQueueService, BillingService
+from .simulation import QueueSimulator, create_piles, generate_trace, in_memory_database
+from .snapshots import queue_status_snapshot, snapshot_cache
+from .utils import dispatch_optimizer
+from .utils.charging_curve import CurveBuffer
+from .utils.completion_timers import CompletionTimerHeap, projected_completion
+from .utils.parameter_manager import ParameterManager, get_dispatch_config, get_queue_config
+from .utils.queue_number import QueueNumberAllocator
 
-# Create your tests here.
+
+class QueueServiceTestMixin:
+    """队列服务测试的公共数据构造"""
+
+    def create_piles(self, mode='fast', count=2, max_queue_size=2, power=120.0):
+        prefix = 'F' if mode == 'fast' else 'S'
+        piles = []
+        for i in range(1, count + 1):
+            piles.append(ChargingPile.objects.create(
+                pile_id=f'{prefix}{i}',
+                pile_type=mode,
+                max_queue_size=max_queue_size,
+                charging_power=power
+            ))
+        return piles
+
+    def create_vehicle(self, index):
+        user = User.objects.create_user(username=f'user{index}', password='testpass123')
+        return Vehicle.objects.create(user=user, license_plate=f'京A{index:05d}', battery_capacity=60)
+
+    def submit(self, index, mode='fast', amount=30.0, vehicle=None):
+        vehicle = vehicle or self.create_vehicle(index)
+        with transaction.atomic():
+            request = ChargingRequest.objects.create(
+                user=vehicle.user,
+                vehicle=vehicle,
+                charging_mode=mode,
+                requested_amount=amount,
+                battery_capacity=60
+            )
+            AdvancedChargingQueueService().add_to_external_queue(request)
+        return request
+
+    def submit_many(self, indexes, **kwargs):
+        """按编号依次提交请求，返回提交的请求列表"""
+        requests = []
+        for index in indexes:
+            requests.append(self.submit(index, **kwargs))
+        return requests
+
+    def progress_daemon(self):
+        """构造输出写入内存的进度守护进程"""
+        return ProgressDaemon(stdout=io.StringIO())
+
+    def assert_positions_consistent(self, mode='fast'):
+        external = list(ChargingRequest.objects.filter(
+            charging_mode=mode, queue_level='external_waiting'
+        ).order_by('external_queue_position').values_list('external_queue_position', flat=True))
+        self.assertEqual(external, list(range(1, len(external) + 1)))
+
+        for pile in ChargingPile.objects.filter(pile_type=mode):
+            positions = list(ChargingRequest.objects.filter(
+                charging_pile=pile, queue_level='pile_queue'
+            ).order_by('pile_queue_position').values_list('pile_queue_position', flat=True))
+            self.assertEqual(positions, list(range(1, len(positions) + 1)))
+            charging = ChargingRequest.objects.filter(charging_pile=pile, queue_level='charging').count()
+            self.assertLessEqual(charging, 1)
+            pile.refresh_from_db()
+            self.assertEqual(pile.is_working, charging == 1)
+
+
+class AdvancedChargingQueueServiceTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.piles = self.create_piles()
+
+    def test_submit_fills_piles_then_external_queue(self):
+        """测试提交请求依次占用充电桩、桩队列和外部等候区"""
+        requests = self.submit_many(range(8))
+
+        self.assertEqual(ChargingRequest.objects.filter(queue_level='charging').count(), 2)
+        self.assertEqual(ChargingRequest.objects.filter(queue_level='pile_queue').count(), 4)
+        self.assertEqual(ChargingRequest.objects.filter(queue_level='external_waiting').count(), 2)
+        self.assertEqual(ChargingSession.objects.count(), 2)
+        self.assert_positions_consistent()
+
+        last = ChargingRequest.objects.get(pk=requests[-1].pk)
+        self.assertEqual(last.external_queue_position, 2)
+
+    def test_complete_charging_advances_queues(self):
+        """测试完成充电后桩队列和外部等候区依次前移"""
+        requests = self.submit_many(range(8))
+        first = ChargingRequest.objects.get(pk=requests[0].pk)
+
+        AdvancedChargingQueueService().complete_charging(first)
+
+        first.refresh_from_db()
+        self.assertEqual(first.current_status, 'completed')
+        self.assertEqual(ChargingRequest.objects.filter(queue_level='charging').count(), 2)
+        self.assertEqual(ChargingRequest.objects.filter(queue_level='external_waiting').count(), 1)
+        self.assert_positions_consistent()
+
+    def test_complete_endpoint_rolls_back_when_release_fails(self):
+        """测试释放充电桩失败时结算、状态和通知一起回滚"""
+        requests = self.submit_many(range(4))
+        first = ChargingRequest.objects.get(pk=requests[0].pk)
+        client = APIClient()
+        client.force_authenticate(user=first.user)
+
+        with mock.patch.object(AdvancedChargingQueueService, '_process_next_in_pile_queue',
+                               side_effect=RuntimeError('release failed')):
+            response = client.post(reverse('charging:complete_charging'), {'request_id': str(first.pk)}, format='json')
+
+        self.assertEqual(response.status_code, 500)
+        first.refresh_from_db()
+        self.assertEqual((first.current_status, first.queue_level), ('charging', 'charging'))
+        self.assertIsNone(ChargingSession.objects.get(request=first).end_time)
+        self.assertFalse(Notification.objects.filter(type='charging_complete').exists())
+        self.assertTrue(ChargingPile.objects.get(pk=first.charging_pile_id).is_working)
+        self.assert_positions_consistent()
+
+        response = client.post(reverse('charging:complete_charging'), {'request_id': str(first.pk)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        first.refresh_from_db()
+        self.assertEqual(first.current_status, 'completed')
+        self.assertIsNotNone(ChargingSession.objects.get(request=first).end_time)
+        self.assertEqual(Notification.objects.filter(user=first.user, type='charging_complete').count(), 1)
+        self.assert_positions_consistent()
+
+    def test_cancel_external_request_renumbers_queue(self):
+        """测试取消外部等候区请求后位置保持连续"""
+        requests = self.submit_many(range(9))
+        waiting = ChargingRequest.objects.get(pk=requests[6].pk)
+        self.assertEqual(waiting.external_queue_position, 1)
+
+        AdvancedChargingQueueService().cancel_charging_request(waiting)
+
+        self.assertEqual(ChargingRequest.objects.get(pk=requests[8].pk).external_queue_position, 2)
+        self.assert_positions_consistent()
+
+    def test_pile_fault_reschedules_queue(self):
+        """测试充电桩故障后其队列被重新调度"""
+        self.submit_many(range(6))
+        pile = ChargingPile.objects.get(pile_id='F1')
+        pile.status = 'fault'
+        pile.save()
+
+        AdvancedChargingQueueService().handle_pile_fault(pile)
+
+        self.assertFalse(ChargingRequest.objects.filter(
+            charging_pile=pile, current_status__in=['waiting', 'charging']
+        ).exists())
+        self.assert_positions_consistent()
+
+    def test_submit_query_count_independent_of_queue_length(self):
+        """测试单次提交的查询数不随排队人数增长"""
+        self.submit_many(range(10))
+        with CaptureQueriesContext(connection) as short_queue:
+            self.submit(100)
+        self.submit_many(range(10, 30))
+        with CaptureQueriesContext(connection) as long_queue:
+            self.submit(101)
+
+        self.assertEqual(len(short_queue), len(long_queue))
+
+    def test_cancel_query_count_independent_of_queue_length(self):
+        """测试外部等候区队首取消时后续请求整体前移，语句数不随排队人数增长"""
+        def cancel_head():
+            head = ChargingRequest.objects.get(queue_level='external_waiting', external_queue_position=1)
+            with CaptureQueriesContext(connection) as context:
+                AdvancedChargingQueueService().cancel_charging_request(head)
+            self.assert_positions_consistent()
+            return context
+
+        self.submit_many(range(10))
+        short_queue = cancel_head()
+        self.submit_many(range(10, 40))
+        long_queue = cancel_head()
+
+        self.assertEqual(len(short_queue), len(long_queue))
+        shift_updates = [
+            query['sql'] for query in long_queue.captured_queries
+            if query['sql'].startswith('UPDATE "charging_request"') and 'CASE' not in query['sql']
+        ]
+        self.assertEqual(len(shift_updates), 1)
+
+    def test_external_wait_time_simulates_pile_handoffs(self):
+        """测试外部等候区等待时间按各桩依次空出的时间估算"""
+        # 每个请求在 120kW 桩上充电 15 分钟，每桩 1 辆充电 + 2 辆排队，剩余 45 分钟
+        requests = self.submit_many(range(9))
+        waits = [
+            ChargingRequest.objects.get(pk=request.pk).estimated_wait_time
+            for request in requests[6:]
+        ]
+        self.assertEqual(waits, [45, 45, 60])
+
+    def test_batch_dispatch_query_count_independent_of_batch_size(self):
+        """测试批量调度一次转移多个请求时语句数不随转移数量增长"""
+        def dispatch(count, offset):
+            ChargingPile.objects.update(status='fault', max_queue_size=8)
+            self.submit_many(range(offset, offset + count))
+            ChargingPile.objects.update(status='normal')
+            with CaptureQueriesContext(connection) as context:
+                transferred = AdvancedChargingQueueService()._process_external_queue_transfers('fast')
+            self.assertEqual(transferred, count)
+            self.assert_positions_consistent()
+            ChargingRequest.objects.update(current_status='completed', queue_level='completed')
+            ChargingPile.objects.update(is_working=False)
+            return context
+
+        small_batch = dispatch(4, 0)
+        large_batch = dispatch(16, 100)
+        self.assertEqual(len(small_batch), len(large_batch))
+
+    def test_resume_stalled_external_queue(self):
+        """测试遗留的叫号暂停在故障队列处理完后被恢复，并补充调度外部等候区"""
+        requests = self.submit_many(range(8))
+        AdvancedChargingQueueService()._pause_external_queue_calling('fast')
+        AdvancedChargingQueueService().complete_charging(ChargingRequest.objects.get(pk=requests[0].pk))
+        self.assertEqual(ChargingRequest.objects.filter(queue_level='external_waiting').count(), 2)
+
+        self.assertTrue(AdvancedChargingQueueService().resume_stalled_external_queue('fast'))
+
+        self.assertFalse(AdvancedChargingQueueService().is_external_queue_paused('fast'))
+        self.assertEqual(ChargingRequest.objects.filter(queue_level='external_waiting').count(), 1)
+        self.assertFalse(AdvancedChargingQueueService().resume_stalled_external_queue('fast'))
+        self.assert_positions_consistent()
+
+    def test_serializers_do_not_write_remaining_time(self):
+        """测试读取充电桩和请求的预计时间时不产生写操作"""
+        requests = self.submit_many(range(4))
+        pile = ChargingPile.objects.get(pile_id='F1')
+        request = ChargingRequest.objects.get(pk=requests[2].pk)
+
+        with CaptureQueriesContext(connection) as context:
+            pile_data = ChargingPileSerializer(pile).data
+            request_data = ChargingRequestSerializer(request).data
+
+        self.assertFalse([q for q in context.captured_queries if q['sql'].startswith('UPDATE')])
+        self.assertEqual(pile_data['estimated_remaining_time'], 30)
+        self.assertEqual(request_data['time_estimates']['pile_remaining_time'], 30)
+
+
+@unittest.skipUnless(dispatch_optimizer.is_available(), '需要 NumPy')
+class BatchOptimalDispatchTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.piles = self.create_piles()
+        ParameterManager.set_parameter('dispatch_strategy', 'batch_optimal')
+
+    def tearDown(self):
+        for key in ('dispatch_strategy', 'fault_dispatch_strategy'):
+            ParameterManager.clear_cache(key)
+
+    def test_plan_matches_exhaustive_search(self):
+        """测试批量最优调度的完成时间之和与穷举结果一致"""
+        amounts = [40.0, 12.0, 33.0, 5.0, 27.0]
+        rates = [0.5, 1.0, 2.0]
+        base_times = [30.0, 0.0, 10.0]
+        capacities = [2, 2, 1]
+
+        plan = dispatch_optimizer.plan_optimal_dispatch(amounts, rates, base_times, capacities)
+        result = dispatch_optimizer.evaluate_plan(plan, amounts, rates, base_times)
+
+        slots = [(p, k) for p, capacity in enumerate(capacities) for k in range(1, capacity + 1)]
+        best = min(
+            sum(base_times[slots[s][0]] + slots[s][1] * rates[slots[s][0]] * amounts[i] for i, s in enumerate(chosen))
+            for chosen in itertools.permutations(range(len(slots)), len(amounts))
+        )
+        self.assertAlmostEqual(sum(finish for _, finish in result.values()), best)
+        greedy = dispatch_optimizer.plan_greedy_dispatch(amounts, rates, base_times, capacities)
+        greedy_result = dispatch_optimizer.evaluate_plan(greedy, amounts, rates, base_times)
+        self.assertLessEqual(best, sum(finish for _, finish in greedy_result.values()))
+
+    def test_batch_dispatch_charges_short_requests_first(self):
+        """测试批量最优调度让充电量小的请求先充电，且只调度等候区前面的请求"""
+        ChargingPile.objects.update(status='fault')
+        requests = []
+        for i, amount in enumerate([60, 50, 40, 30, 20, 10, 5]):
+            requests.append(self.submit(i, amount=amount))
+        ChargingPile.objects.update(status='normal')
+
+        transferred = AdvancedChargingQueueService()._process_external_queue_transfers('fast')
+
+        self.assertEqual(transferred, 6)
+        self.assertEqual(
+            sorted(ChargingRequest.objects.filter(queue_level='charging').values_list('requested_amount', flat=True)),
+            [10, 20]
+        )
+        self.assertEqual(ChargingRequest.objects.get(pk=requests[6].pk).external_queue_position, 1)
+        for pile in self.piles:
+            amounts = list(ChargingRequest.objects.filter(
+                charging_pile=pile, queue_level='pile_queue'
+            ).order_by('pile_queue_position').values_list('requested_amount', flat=True))
+            self.assertEqual(amounts, sorted(amounts))
+        self.assert_positions_consistent()
+
+    def test_pile_fault_batch_optimal_strategy(self):
+        """测试故障调度策略为 batch_optimal 时故障队列被整体重新分配"""
+        ParameterManager.set_parameter('fault_dispatch_strategy', 'batch_optimal')
+        self.submit_many(range(6))
+        pile = ChargingPile.objects.get(pile_id='F1')
+        pile.status = 'fault'
+        pile.save()
+
+        AdvancedChargingQueueService().handle_pile_fault(pile)
+
+        self.assertFalse(ChargingRequest.objects.filter(
+            charging_pile=pile, current_status__in=['waiting', 'charging']
+        ).exists())
+        self.assertEqual(ChargingRequest.objects.filter(queue_level='pile_queue', charging_pile__pile_id='F2').count(), 2)
+        self.assertFalse(AdvancedChargingQueueService().is_external_queue_paused('fast'))
+        self.assert_positions_consistent()
+
+
+class QueueSimulatorTestCase(QueueServiceTestMixin, TestCase):
+
+    def test_trace_replay_drains_queues(self):
+        """测试模拟器回放包含取消、修改类型和故障的轨迹后所有请求都已结束"""
+        piles = create_piles(fast_count=2, slow_count=2)
+        trace = generate_trace(
+            cars=30, arrival_rate=120, cancel_ratio=0.2, change_mode_ratio=0.2,
+            faults=2, fault_duration=20, pile_ids=[pile.pile_id for pile in piles], seed=7
+        )
+        before = timezone.now()
+
+        simulator = QueueSimulator(trace)
+        _, executed = simulator.run()
+
+        self.assertGreater(executed, 30)
+        self.assertEqual(simulator.stats['arrive'].count + simulator.rejected, 30)
+        self.assertFalse(ChargingRequest.objects.filter(current_status__in=['waiting', 'charging']).exists())
+        self.assertEqual(
+            sum(len(values) for values in simulator.wait_times().values()),
+            ChargingRequest.objects.filter(start_time__isnull=False).count()
+        )
+        # 虚拟时钟只在模拟期间生效
+        self.assertLess(timezone.now() - before, simulator.clock.now() - before)
+        for charging_mode in ('fast', 'slow'):
+            self.assert_positions_consistent(charging_mode)
+
+
+class InMemoryDatabaseTestCase(SimpleTestCase):
+
+    def test_does_not_touch_configured_database(self):
+        """测试模拟数据库的切换和恢复不访问配置的数据库（SimpleTestCase 中访问会直接报错）"""
+        ParameterManager.reset_cache()
+
+        with in_memory_database():
+            ParameterManager.set_parameter('dispatch_strategy', 'batch_optimal')
+            self.assertEqual(get_dispatch_config()['strategy'], 'batch_optimal')
+
+        # 模拟数据库中的参数不会留在缓存中
+        self.assertIsNone(cache.get(f'{ParameterManager.CACHE_PREFIX}dispatch_strategy'))
+
+
+class ChargingProgressTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=6, max_queue_size=1)
+
+    def run_tick(self):
+        daemon = self.progress_daemon()
+        with CaptureQueriesContext(connection) as context:
+            daemon.update_charging_progress()
+        return context
+
+    def start_charging(self, count, offset):
+        requests = self.submit_many(range(offset, offset + count), amount=60.0)
+        ChargingRequest.objects.filter(current_status='charging').update(
+            start_time=timezone.now() - timedelta(minutes=10)
+        )
+        return requests
+
+    def test_tick_statement_count_independent_of_charging_requests(self):
+        """测试每个进度更新周期的语句数不随充电中的请求数增长"""
+        self.start_charging(2, 0)
+        small = self.run_tick()
+        self.start_charging(8, 100)
+        self.assertEqual(ChargingRequest.objects.filter(current_status='charging').count(), 6)
+        large = self.run_tick()
+
+        self.assertEqual(len(small), len(large))
+
+    def test_tick_updates_amounts_sessions_and_pile_remaining_time(self):
+        """测试进度更新后请求、会话和充电桩剩余时间保持一致"""
+        self.start_charging(8, 0)
+        self.run_tick()
+
+        for request in ChargingRequest.objects.filter(current_status='charging').select_related('session', 'charging_pile'):
+            self.assertGreater(request.current_amount, 0)
+            self.assertLess(request.current_amount, request.requested_amount)
+            self.assertEqual(request.session.charging_amount, request.current_amount)
+            pile = request.charging_pile
+            self.assertEqual(pile.estimated_remaining_time, pile.calculate_remaining_time())
+
+
+class PileTelemetryTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=2, max_queue_size=1)
+        self.requests = self.submit_many(range(3), amount=30.0)
+        self.started = timezone.now() - timedelta(minutes=5)
+        ChargingRequest.objects.filter(current_status='charging').update(start_time=self.started)
+        self.client = APIClient()
+        self.client.force_authenticate(
+            user=User.objects.create_user(username='gateway', password='testpass123', is_staff=True)
+        )
+
+    def post(self, readings):
+        response = self.client.post(reverse('charging:pile_telemetry'), {'readings': readings}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data['data']
+
+    def reading(self, pile_id, minutes, kwh, power=120.0):
+        return {
+            'pile_id': pile_id,
+            'timestamp': (self.started + timedelta(minutes=minutes)).isoformat(),
+            'cumulative_kwh': kwh,
+            'power_kw': power,
+        }
+
+    def test_batch_updates_sessions_and_completes_charging(self):
+        """测试一批读数按电表增量更新多个会话，达到请求量的会话完成并开始下一个请求"""
+        # 第三个请求在其中一个桩的队列中等待，让这个桩先充满
+        busy = ChargingRequest.objects.get(pk=self.requests[2].pk).charging_pile_id
+        other = 'F2' if busy == 'F1' else 'F1'
+
+        data = self.post([
+            self.reading(other, 1, 1000.0), self.reading(other, 2, 1002.0),
+            self.reading(busy, 2, 500.0), self.reading('S9', 2, 1.0),
+            {'pile_id': busy, 'timestamp': 'yesterday', 'cumulative_kwh': -1, 'power_kw': 1},
+        ])
+        self.assertEqual((data['piles'], data['applied'], data['idle']), (2, 2, 0))
+        self.assertEqual([item['index'] for item in data['rejected']], [3, 4])
+        self.assertEqual(data['rejected'][0]['errors'], {'pile_id': ['充电桩不存在']})
+
+        data = self.post([self.reading(other, 3, 1010.0), self.reading(busy, 3, 530.0), self.reading(busy, 1, 400.0)])
+        self.assertEqual((data['applied'], data['completed'], data['stale']), (2, 1, 0))
+
+        in_progress = ChargingRequest.objects.select_related('session').get(
+            charging_pile_id=other, current_status='charging'
+        )
+        self.assertEqual(in_progress.current_amount, 8.0)
+        self.assertEqual(in_progress.session.charging_amount, 8.0)
+        self.assertEqual(in_progress.session.meter_kwh, 1010.0)
+        self.assertEqual(
+            ChargingRequest.objects.filter(pk__in=[r.pk for r in self.requests[:2]], current_status='completed').count(), 1
+        )
+        self.assertEqual(ChargingRequest.objects.get(pk=self.requests[2].pk).current_status, 'charging')
+
+        # 旧读数乱序到达时忽略
+        data = self.post([self.reading(other, 2, 1005.0)])
+        self.assertEqual((data['applied'], data['stale']), (0, 1))
+        self.assert_positions_consistent()
+
+    def test_ending_early_bills_metered_amount(self):
+        """测试电表读数与请求充电量不同时，提前结束充电按电表读数结算"""
+        request = ChargingRequest.objects.get(pk=self.requests[0].pk)
+        self.post([self.reading(request.charging_pile_id, 1, 500.0)])
+        self.post([self.reading(request.charging_pile_id, 2, 512.0)])
+        client = APIClient()
+        client.force_authenticate(user=request.user)
+
+        response = client.post(reverse('charging:complete_charging'), {'request_id': str(request.pk)}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data']['total_amount'], 12.0)
+        session = ChargingSession.objects.get(request=request)
+        self.assertEqual(session.charging_amount, 12.0)
+        service_rate = Decimal(BillingService()._get_parameter('service_rate', '0.8'))
+        self.assertEqual(session.service_cost, Decimal('12.0') * service_rate)
+        self.assertEqual(ChargingRequest.objects.get(pk=request.pk).current_amount, 12.0)
+
+    def test_daemon_skips_sessions_with_live_telemetry(self):
+        """测试电表仍在上报读数的会话不再按功率估算进度"""
+        self.post([self.reading('F1', 4, 1000.0), self.reading('F1', 5, 1003.0)])
+        daemon = self.progress_daemon()
+        daemon.update_charging_progress()
+
+        amounts = dict(ChargingRequest.objects.filter(current_status='charging').values_list('charging_pile_id', 'current_amount'))
+        self.assertEqual(amounts['F1'], 0.0)
+        self.assertGreater(amounts['F2'], 0.0)
+
+
+class ChargingCurveTestCase(QueueServiceTestMixin, TestCase):
+
+    def test_buffer_round_trip_and_downsampling(self):
+        """测试曲线编码往返误差有界，长会话抽稀后仍保留首尾采样点"""
+        buffer = CurveBuffer()
+        for second in range(0, 20000, 5):
+            buffer.append(second, second * 120 / 3600 + 0.001, 118.5)
+
+        self.assertLessEqual(len(buffer), CurveBuffer.MAX_SAMPLES)
+        self.assertGreater(buffer.min_interval, 5)
+        restored = CurveBuffer.from_bytes(buffer.to_bytes())
+        self.assertEqual(len(restored), len(buffer))
+        self.assertEqual(restored.offsets[0], 0)
+        self.assertEqual(restored.offsets[-1], 19995)
+        self.assertAlmostEqual(restored.amounts[-1], 19995 * 120 / 3600 + 0.001, places=3)
+        self.assertLessEqual(len(buffer.to_bytes()), 13 + 12 * CurveBuffer.MAX_SAMPLES)
+
+    def test_progress_ticks_append_curve_samples(self):
+        """测试每次进度更新向会话曲线追加一个采样点，并可通过详单接口读取"""
+        self.create_piles(count=1, max_queue_size=1)
+        request = self.submit(1, amount=60.0)
+        start = timezone.now() - timedelta(minutes=10)
+        ChargingRequest.objects.filter(pk=request.pk).update(start_time=start)
+        ChargingSession.objects.filter(request=request).update(start_time=start)
+        daemon = self.progress_daemon()
+        daemon.update_charging_progress()
+        daemon.update_charging_progress()
+
+        session = ChargingSession.objects.get(request=request)
+        self.assertEqual(session.curve.sample_count, 2)
+        client = APIClient()
+        client.force_authenticate(user=request.user)
+        data = client.get(reverse('charging:bill_curve', args=[session.pk])).data['data']
+        self.assertEqual(data['sample_count'], 2)
+        self.assertAlmostEqual(data['amounts'][-1], session.charging_amount, places=2)
+        self.assertEqual(data['powers'], [120.0, 120.0])
+        self.assertGreaterEqual(data['offsets'][0], 600)
+
+        other = APIClient()
+        other.force_authenticate(user=User.objects.create_user(username='stranger', password='testpass123'))
+        self.assertEqual(other.get(reverse('charging:bill_curve', args=[session.pk])).status_code, 404)
+
+
+class QueueSnapshotCacheTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        snapshot_cache.clear()
+        self.create_piles(count=2, max_queue_size=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=User.objects.create_user(username='viewer', password='testpass123'))
+
+    def poll(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('charging:enhanced_queue_status'))
+        self.assertEqual(response.status_code, 200)
+        return response.data['data'], context
+
+    def test_repeated_poll_served_from_cache(self):
+        """测试队列未变化时重复轮询只执行版本查询，不读取请求"""
+        self.submit(0)
+        first, _ = self.poll()
+        second, context = self.poll()
+
+        self.assertEqual(first, second)
+        self.assertFalse(any('charging_request' in query['sql'] for query in context.captured_queries))
+
+    def test_queue_event_invalidates_snapshot(self):
+        """测试调度事件后下一次轮询返回新的快照"""
+        self.submit(0)
+        before, _ = self.poll()
+        self.submit(1)
+        self.submit(2)
+        after, _ = self.poll()
+
+        self.assertEqual(before['pile_queues']['fast']['charging_count'], 1)
+        self.assertEqual(after['pile_queues']['fast']['charging_count'], 2)
+        self.assertEqual(after['external_queue']['fast_count'], 0)
+        self.assertEqual(after['pile_queues']['fast']['waiting_count'], 1)
+
+    def test_progress_and_pile_status_change_invalidate_snapshot(self):
+        """测试进度更新和充电桩状态变更都会使快照失效"""
+        request = self.submit(0, amount=60.0)
+        ChargingRequest.objects.filter(pk=request.pk).update(start_time=timezone.now() - timedelta(minutes=10))
+        busy = ChargingRequest.objects.get(pk=request.pk).charging_pile_id
+        snapshot = queue_status_snapshot('fast')
+        self.assertEqual([pile['current_charging']['progress'] for pile in snapshot['fast']['piles']], [0, 0])
+
+        daemon = self.progress_daemon()
+        daemon.update_charging_progress()
+        snapshot = queue_status_snapshot('fast')
+        progress = {pile['pile_id']: pile['current_charging']['progress'] for pile in snapshot['fast']['piles']}
+        self.assertGreater(progress[busy], 0)
+
+        idle = next(pile_id for pile_id in progress if pile_id != busy)
+        AdvancedChargingQueueService().change_pile_status(idle, 'offline')
+        snapshot = queue_status_snapshot('fast')
+        self.assertEqual([pile['pile_id'] for pile in snapshot['fast']['piles']], [busy])
+
+
+class ConditionalStatusPollTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=2, max_queue_size=1)
+        self.vehicle = self.create_vehicle(0)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.vehicle.user)
+
+    def get(self, name, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(f'charging:{name}'), **headers)
+        return response, context
+
+    def test_unchanged_queue_answers_304_without_status_queries(self):
+        """测试队列未变化时带 ETag 的轮询直接返回 304，不执行状态查询"""
+        self.submit(0, vehicle=self.vehicle)
+        for name in ['queue_status', 'enhanced_queue_status', 'piles_status', 'public_status', 'active_requests']:
+            first, _ = self.get(name)
+            self.assertEqual(first.status_code, 200)
+            self.assertIn('ETag', first)
+
+            second, context = self.get(name, first['ETag'])
+            self.assertEqual(second.status_code, 304, name)
+            self.assertEqual(second['ETag'], first['ETag'])
+            self.assertFalse(second.content)
+            self.assertFalse(any(
+                'status"' in query['sql'] for query in context.captured_queries
+            ), name)
+
+        self.assertEqual(self.get('active_requests', 'W/' + first['ETag'])[0].status_code, 304)
+
+    def test_queue_event_and_request_modification_change_etag(self):
+        """测试调度事件和用户修改请求后 ETag 变化"""
+        request = self.submit(0, vehicle=self.vehicle)
+        queue_etag = self.get('enhanced_queue_status')[0]['ETag']
+        active_etag = self.get('active_requests')[0]['ETag']
+
+        self.submit(1)
+        response, _ = self.get('enhanced_queue_status', queue_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], queue_etag)
+        response, _ = self.get('active_requests', active_etag)
+        self.assertEqual(response.status_code, 200)
+        active_etag = response['ETag']
+
+        ChargingRequest.objects.filter(pk=request.pk).update(updated_at=timezone.now() + timedelta(seconds=1))
+        response, _ = self.get('active_requests', active_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], active_etag)
+
+    def test_active_requests_etag_is_per_user(self):
+        """测试活跃请求列表的 ETag 按用户区分"""
+        self.submit(0, vehicle=self.vehicle)
+        etag = self.get('active_requests')[0]['ETag']
+
+        self.client.force_authenticate(user=User.objects.create_user(username='other', password='testpass123'))
+        response, _ = self.get('active_requests', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data'], [])
+
+
+class QueueEventStreamTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=1, max_queue_size=1)
+        self.vehicle = self.create_vehicle(0)
+
+    @staticmethod
+    def event_names(chunks):
+        return [line.split(': ', 1)[1] for chunk in chunks for line in chunk.splitlines() if line.startswith('event: ')]
+
+    async def collect(self, stream):
+        """读取事件直到出现心跳"""
+        chunks = []
+        while True:
+            chunk = await stream.__anext__()
+            if chunk.startswith(':'):
+                return chunks
+            chunks.append(chunk)
+
+    def test_broker_delivers_across_threads(self):
+        """测试其他线程发布的事件只投递给订阅了该主题的连接"""
+        broker = EventBroker()
+
+        async def scenario():
+            station = broker.subscribe('station')
+            user = broker.subscribe('station', 'user:1')
+            thread = threading.Thread(target=broker.publish, args=('user:1', 'fast'))
+            thread.start()
+            thread.join()
+            received = await user.wait(1), await station.wait(0.05)
+            station.close()
+            user.close()
+            return received
+
+        user_messages, station_messages = async_to_sync(scenario)()
+        self.assertEqual(user_messages, [('user:1', 'fast')])
+        self.assertEqual(station_messages, [])
+        self.assertFalse(broker.has_subscribers())
+
+    def test_stream_pushes_queue_changes_after_commit(self):
+        """测试调度事件提交后推送排队增量、请求变化和通知"""
+        other = self.create_vehicle(1)
+
+        def submit(index, vehicle):
+            with self.captureOnCommitCallbacks(execute=True):
+                return self.submit(index, vehicle=vehicle)
+
+        async def scenario():
+            mine = queue_event_stream(self.vehicle.user, keepalive=0.2)
+            theirs = queue_event_stream(other.user, keepalive=0.2)
+            initial = [await mine.__anext__(), await theirs.__anext__()]
+            await sync_to_async(submit)(0, self.vehicle)
+            result = initial, await self.collect(mine), await self.collect(theirs)
+            await mine.aclose()
+            await theirs.aclose()
+            return result
+
+        initial, mine, theirs = async_to_sync(scenario)()
+        self.assertEqual(self.event_names(initial), ['snapshot', 'snapshot'])
+        self.assertIn('"requests": []', initial[0])
+        self.assertEqual(self.event_names(mine)[:2], ['station', 'request'])
+        self.assertIn('charging_start', self.event_names(mine))
+        self.assertIn('"current_status": "charging"', mine[1])
+        self.assertEqual(self.event_names(theirs), ['station'])
+        self.assertFalse(broker.has_subscribers())
+
+    def test_watcher_picks_up_changes_from_other_processes(self):
+        """测试没有本进程发布时，队列版本监视发现变化并推送给受影响的用户"""
+        self.addCleanup(setattr, watcher, 'interval', watcher.interval)
+        watcher.interval = 0.05
+
+        async def scenario():
+            stream = queue_event_stream(self.vehicle.user, keepalive=0.5)
+            await stream.__anext__()
+            # 未执行提交回调，相当于变化发生在其他进程
+            await asyncio.sleep(0.1)
+            await sync_to_async(self.submit)(0, vehicle=self.vehicle)
+            chunks = await self.collect(stream)
+            await stream.aclose()
+            return chunks
+
+        names = self.event_names(async_to_sync(scenario)())
+        self.assertEqual(names[:2], ['station', 'request'])
+
+    def test_reconnect_replays_missed_notifications(self):
+        """测试带 Last-Event-ID 重连时补发错过的通知"""
+        self.submit(0, vehicle=self.vehicle)
+        notifications = list(self.vehicle.user.notifications.order_by('id'))
+        self.assertTrue(notifications)
+
+        async def scenario():
+            stream = queue_event_stream(self.vehicle.user, last_event_id=0, keepalive=0.1)
+            chunks = await self.collect(stream)
+            await stream.aclose()
+            return chunks
+
+        chunks = async_to_sync(scenario)()
+        self.assertEqual(self.event_names(chunks)[1:], [n.type for n in notifications])
+        self.assertTrue(chunks[-1].startswith(f'id: {notifications[-1].pk}\n'))
+
+    def test_events_endpoint_authentication(self):
+        """测试事件接口接受令牌请求头或推送票据，不接受查询参数中的令牌，且只能通过 ASGI 访问"""
+        url = reverse('charging:queue_events')
+        token = Token.objects.create(user=self.vehicle.user)
+        headers = {'Authorization': f'Token {token.key}'}
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 501)
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        ticket = client.post(reverse('charging:queue_events_ticket')).data['data']['ticket']
+        self.assertNotIn(token.key, ticket)
+
+        async def open_stream(**kwargs):
+            response = await AsyncClient().get(url, **kwargs)
+            if response.status_code != 200:
+                return response.status_code, None
+            first = await response.streaming_content.__anext__()
+            await response.streaming_content.aclose()
+            return response.status_code, first
+
+        self.assertEqual(async_to_sync(open_stream)(), (401, None))
+        self.assertEqual(async_to_sync(open_stream)(data={'token': token.key}), (401, None))
+        self.assertEqual(async_to_sync(open_stream)(headers={'Authorization': 'Token invalid'}), (401, None))
+        for kwargs in ({'headers': headers}, {'data': {'ticket': ticket}}):
+            status_code, first = async_to_sync(open_stream)(**kwargs)
+            self.assertEqual(status_code, 200)
+            self.assertTrue(first.startswith(b'event: snapshot'))
+
+        # 过期的票据、其他用途签名的数据都不能建立连接
+        with mock.patch('charging.events.EVENT_TICKET_MAX_AGE', -1):
+            self.assertEqual(async_to_sync(open_stream)(data={'ticket': ticket}), (401, None))
+        forged = signing.dumps({'user': self.vehicle.user.pk}, salt='other')
+        self.assertEqual(async_to_sync(open_stream)(data={'ticket': forged}), (401, None))
+
+
+class PileSerializationQueryTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=2, max_queue_size=2)
+
+    def fill(self, offset, count):
+        for i in range(count):
+            self.submit(offset + i)
+
+    def test_batch_serialization_query_budget(self):
+        """测试批量序列化充电桩的查询数固定为三条，且与逐个序列化的结果一致"""
+        self.fill(0, 5)
+        expected = [ChargingPileSerializer(pile).data for pile in ChargingPile.objects.order_by('pile_id')]
+
+        with self.assertNumQueries(3):
+            data = ChargingPileSerializer(
+                ChargingPile.objects.with_queue_details().order_by('pile_id'), many=True
+            ).data
+        self.assertEqual(data, expected)
+        self.assertTrue(all(pile['current_user'] for pile in data))
+        self.assertEqual(sum(pile['queue_count'] for pile in data), 3)
+
+        self.create_piles(mode='slow', count=6)
+        self.fill(100, 4)
+        with self.assertNumQueries(3):
+            ChargingPileSerializer(ChargingPile.objects.with_queue_details(), many=True).data
+
+    def test_piles_status_queries_independent_of_pile_count(self):
+        """测试充电桩状态接口的查询数不随桩数增长"""
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_user(username='viewer', password='testpass123'))
+        self.fill(0, 2)
+        with CaptureQueriesContext(connection) as small:
+            response = client.get(reverse('charging:piles_status'))
+        self.assertEqual([pile['current_user'] for pile in response.data['data']['fast_piles']], ['user0', 'user1'])
+
+        self.create_piles(mode='slow', count=6)
+        self.fill(100, 6)
+        with CaptureQueriesContext(connection) as large:
+            response = client.get(reverse('charging:piles_status'))
+        self.assertEqual(len(response.data['data']['slow_piles']), 6)
+        self.assertEqual(len(small), len(large))
+
+
+class StationCounterTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        counters_cache.clear()
+        self.addCleanup(counters_cache.clear)
+        self.create_piles(count=2, max_queue_size=1)
+        self.create_piles(mode='slow', count=1, max_queue_size=1)
+
+    def assert_counters_match_database(self):
+        expected = {}
+        for mode in ['fast', 'slow']:
+            for field, value in count_mode(mode).items():
+                expected[field] = expected.get(field, 0) + value
+        self.assertEqual(read_counters(), expected)
+        return expected
+
+    def test_counters_follow_queue_events_and_pile_status_changes(self):
+        """测试调度事件和充电桩状态变更后计数与数据库统计一致"""
+        self.assertEqual(self.assert_counters_match_database()['total_piles'], 3)
+        requests = self.submit_many(range(5))
+        requests.append(self.submit(10, mode='slow'))
+        counters = self.assert_counters_match_database()
+        self.assertEqual((counters['charging'], counters['pile_queue_waiting'], counters['external_waiting']), (3, 2, 1))
+
+        service = AdvancedChargingQueueService()
+        service.cancel_charging_request(ChargingRequest.objects.get(pk=requests[4].pk))
+        service.complete_charging(ChargingRequest.objects.get(pk=requests[0].pk))
+        self.assert_counters_match_database()
+
+        faulty = ChargingRequest.objects.get(pk=requests[1].pk).charging_pile_id
+        service.change_pile_status(faulty, 'fault')
+        self.assertEqual(self.assert_counters_match_database()['fault_piles'], 1)
+        service.handle_pile_fault(ChargingPile.objects.get(pk=faulty))
+        self.assert_counters_match_database()
+
+    def test_public_status_served_from_cache(self):
+        """测试公开状态接口在缓存有效期内不执行查询"""
+        self.submit(0)
+        client = APIClient()
+        first = client.get(reverse('charging:public_status'))
+        self.assertEqual(first.data['data']['charging_count'], 1)
+        self.assertEqual(first.data['data']['available_piles'], 2)
+
+        with self.assertNumQueries(0):
+            second = client.get(reverse('charging:public_status'))
+            cached = client.get(reverse('charging:public_status'), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(cached.status_code, 304)
+
+    def test_expired_cache_loads_once_for_concurrent_readers(self):
+        """测试缓存过期时并发读取只加载一次"""
+        loads = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.05)
+            return len(loads)
+
+        cache = CoalescedCache(load, ttl=60)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, [1] * 8)
+
+
+class ActiveRequestReadTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=1, max_queue_size=1)
+        self.vehicle = self.create_vehicle(0)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.vehicle.user)
+
+    def add_vehicle(self, index):
+        return Vehicle.objects.create(user=self.vehicle.user, license_plate=f'京B{index:05d}', battery_capacity=60)
+
+    def test_active_requests_read_in_one_query(self):
+        """测试活跃请求接口只用一条联表查询读取请求（另加三条 ETag 版本查询），不随请求数增长"""
+        self.submit(0, vehicle=self.vehicle)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('charging:active_requests'))
+        self.assertEqual(response.data['data'][0]['queue_status'], '正在桩F1充电')
+
+        self.submit(1, vehicle=self.add_vehicle(1))
+        self.submit(2, vehicle=self.add_vehicle(2))
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('charging:active_requests'))
+
+        data = response.data['data']
+        self.assertEqual([item['queue_level'] for item in data], ['charging', 'pile_queue', 'external_waiting'])
+        self.assertEqual([item['ahead_count'] for item in data], [0, 0, 0])
+        self.assertEqual(data[0]['pile_info']['pile_id'], 'F1')
+        self.assertEqual(data[0]['session_info']['charging_amount'], 0.0)
+        self.assertEqual(
+            data[1]['time_estimates']['pile_remaining_time'], ChargingPile.objects.get().estimated_remaining_time
+        )
+        self.assertIsNone(data[2]['session_info'])
+
+    def test_request_status_reads_in_one_query(self):
+        """测试当前请求状态接口只执行一条查询且不写数据库"""
+        self.submit(5)
+        self.submit(1, vehicle=self.vehicle)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('charging:request_status'))
+        self.assertEqual(response.data['data']['ahead_count'], 0)
+        self.assertEqual(response.data['data']['queue_status'], '桩F1队列第1位')
+        self.assertEqual(response.data['data']['vehicle_info']['license_plate'], self.vehicle.license_plate)
+
+
+class RequestStatusLongPollTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=1, max_queue_size=1)
+        self.vehicle = self.create_vehicle(0)
+
+    def submit_and_commit(self, index, vehicle=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.submit(index, vehicle=vehicle)
+
+    def test_returns_immediately_when_version_differs(self):
+        """测试客户端版本与当前不同时立即返回当前状态"""
+        self.submit(0, vehicle=self.vehicle)
+        version, data, changed = async_to_sync(wait_for_request_change)(self.vehicle.user, 'stale', 5)
+        self.assertTrue(changed)
+        self.assertEqual(data['queue_status'], '正在桩F1充电')
+        self.assertEqual((version, data), read_request_status(self.vehicle.user))
+
+    def test_waits_until_request_changes(self):
+        """测试版本未变时等待，请求发生变化后返回新状态"""
+        self.submit(5)
+        version, data = read_request_status(self.vehicle.user)
+        self.assertIsNone(data)
+
+        async def scenario():
+            async def change():
+                await asyncio.sleep(0.1)
+                # 其他用户的变化不唤醒等待方，自己的请求变化才返回
+                await sync_to_async(self.submit_and_commit)(6)
+                await sync_to_async(self.submit_and_commit)(0, self.vehicle)
+
+            started = time.monotonic()
+            result, _ = await asyncio.gather(wait_for_request_change(self.vehicle.user, version, 5), change())
+            return result, time.monotonic() - started
+
+        (new_version, data, changed), elapsed = async_to_sync(scenario)()
+        self.assertTrue(changed)
+        self.assertNotEqual(new_version, version)
+        self.assertEqual(data['queue_level'], 'external_waiting')
+        self.assertLess(elapsed, 2)
+
+    def test_timeout_returns_unchanged(self):
+        """测试超时后返回未变化的状态"""
+        self.submit(0, vehicle=self.vehicle)
+        version, _ = read_request_status(self.vehicle.user)
+        started = time.monotonic()
+        new_version, data, changed = async_to_sync(wait_for_request_change)(self.vehicle.user, version, 0.2)
+        self.assertFalse(changed)
+        self.assertEqual(new_version, version)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertFalse(broker.has_subscribers())
+
+    def test_long_poll_endpoint(self):
+        """测试长轮询接口的认证、参数校验和返回格式"""
+        url = reverse('charging:request_status_wait')
+        token = Token.objects.create(user=self.vehicle.user)
+        self.submit(0, vehicle=self.vehicle)
+        headers = {'Authorization': f'Token {token.key}'}
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 501)
+
+        async def scenario():
+            client = AsyncClient()
+            anonymous = await client.get(url)
+            query_token = await client.get(url, {'token': token.key})
+            invalid = await client.get(url, {'timeout': '600'}, headers=headers)
+            first = await client.get(url, headers=headers)
+            version = json.loads(first.content)['data']['version']
+            second = await client.get(url, {'version': version, 'timeout': '0.1'}, headers=headers)
+            return anonymous, query_token, invalid, first, second
+
+        anonymous, query_token, invalid, first, second = async_to_sync(scenario)()
+        self.assertEqual(anonymous.status_code, 401)
+        self.assertEqual(query_token.status_code, 401)
+        self.assertEqual(invalid.status_code, 400)
+        first = json.loads(first.content)['data']
+        self.assertTrue(first['changed'])
+        self.assertEqual(first['request']['ahead_count'], 0)
+        second = json.loads(second.content)['data']
+        self.assertFalse(second['changed'])
+        self.assertEqual(second['version'], first['version'])
+
+
+class CompletionTimerTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=2, max_queue_size=1)
+
+    def test_timer_heap_orders_and_syncs(self):
+        """测试定时器按完成时刻弹出，同步时移除已不在充电的请求"""
+        start = timezone.now()
+        timers = CompletionTimerHeap()
+        timers.sync([('a', start, 60, 120), ('b', start, 30, 120), ('c', start, 90, 120)])
+        self.assertEqual(timers.next_deadline(), start + timedelta(minutes=15))
+
+        timers.sync([('a', start, 60, 120), ('c', start, 90, 120)])
+        due = timers.pop_due(start + timedelta(minutes=40))
+        self.assertEqual(due, [('a', projected_completion(start, 60, 120))])
+        self.assertEqual(list(timers.pop_due(start + timedelta(hours=1))), [('c', start + timedelta(minutes=45))])
+        self.assertIsNone(timers.next_deadline())
+
+    def test_due_timer_completes_charging_and_starts_next(self):
+        """测试到期的定时器完成充电，并为下一个开始充电的请求建立定时器"""
+        requests = self.submit_many(range(3), amount=60.0)
+        ChargingRequest.objects.filter(pk=requests[0].pk).update(start_time=timezone.now() - timedelta(minutes=31))
+        daemon = self.progress_daemon()
+        daemon.timer_versions = None
+        timers = CompletionTimerHeap()
+
+        self.assertEqual(daemon.process_completion_timers(timers), 1)
+
+        self.assertEqual(ChargingRequest.objects.get(pk=requests[0].pk).current_status, 'completed')
+        self.assertEqual(ChargingRequest.objects.get(pk=requests[2].pk).current_status, 'charging')
+        self.assertEqual(daemon.process_completion_timers(timers), 0)
+        self.assertEqual(len(timers), 2)
+        self.assertIn(requests[2].pk, timers)
+        self.assert_positions_consistent()
+
+
+class PileFaultDetectionTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=2, max_queue_size=1)
+        self.daemon = self.progress_daemon()
+        self.daemon.initialize_pile_status_cache()
+        self.daemon.detect_and_handle_pile_faults()
+
+    def age_piles(self):
+        """把充电桩的 updated_at 调到水位之前，只留下状态变更事件这一条线索"""
+        ChargingPile.objects.update(updated_at=timezone.now() - timedelta(minutes=10))
+
+    def test_quiet_tick_reads_no_piles(self):
+        """测试没有状态变化时故障检测只执行两条增量查询且不读取任何充电桩"""
+        self.age_piles()
+        with CaptureQueriesContext(connection) as context:
+            self.daemon.detect_and_handle_pile_faults()
+        self.assertEqual(len(context), 2)
+        self.assertEqual(self.daemon.changed_piles().count(), 0)
+
+    def test_progress_tick_does_not_mark_piles_changed(self):
+        """测试进度更新和完成充电写回剩余时间、占用状态后充电桩不会落入增量水位"""
+        requests = self.submit_many(range(4), amount=60.0)
+        ChargingRequest.objects.filter(current_status='charging').update(
+            start_time=timezone.now() - timedelta(minutes=10)
+        )
+        ChargingRequest.objects.filter(pk=requests[0].pk).update(start_time=timezone.now() - timedelta(hours=2))
+        # 水位设在当前时刻，跳过回退窗口
+        self.daemon.detect_and_handle_pile_faults()
+        self.daemon.pile_watermark = timezone.now()
+
+        self.daemon.update_charging_progress()
+
+        self.assertEqual(ChargingRequest.objects.get(pk=requests[0].pk).current_status, 'completed')
+        self.assertEqual(self.daemon.changed_piles().count(), 0)
+
+    def test_status_event_from_api_triggers_fault_handling(self):
+        """测试通过状态接口修改的故障在下一次增量检测时立即处理"""
+        requests = self.submit_many(range(2), amount=60.0)
+        faulty = ChargingRequest.objects.get(pk=requests[0].pk).charging_pile_id
+        admin = User.objects.create_user(username='admin', password='testpass123', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(user=admin)
+
+        response = client.put(
+            reverse('charging:update_pile_status', args=[faulty]), {'status': 'fault'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data']['previous_status'], 'normal')
+        self.assertEqual(PileStatusEvent.objects.get().to_status, 'fault')
+
+        self.age_piles()
+        self.daemon.detect_and_handle_pile_faults()
+
+        self.assertEqual(self.daemon.pile_status_cache[faulty], 'fault')
+        self.assertFalse(ChargingRequest.objects.filter(charging_pile_id=faulty, current_status='charging').exists())
+        self.assertFalse(ChargingPile.objects.get(pk=faulty).is_working)
+
+    def test_status_api_rejects_non_admin_and_invalid_status(self):
+        """测试状态接口只允许管理员使用并校验状态值"""
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_user(username='driver', password='testpass123'))
+        url = reverse('charging:update_pile_status', args=['F1'])
+        self.assertEqual(client.put(url, {'status': 'fault'}, format='json').status_code, 403)
+
+        client.force_authenticate(user=User.objects.create_user(username='admin', password='x', is_staff=True))
+        self.assertEqual(client.put(url, {'status': 'broken'}, format='json').status_code, 400)
+        self.assertFalse(PileStatusEvent.objects.exists())
+
+
+class PileLeaseTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles(count=4, max_queue_size=1)
+
+    def test_workers_split_piles_and_take_over_expired_leases(self):
+        """测试两个进程平分充电桩，一个进程失联后另一个接管它的租约"""
+        first = PileLeaseManager('worker-a', ttl=30)
+        second = PileLeaseManager('worker-b', ttl=30)
+
+        self.assertEqual(len(first.heartbeat()), 4)
+        # 第二个进程加入：第一个进程释放超出份额的租约后由第二个进程认领
+        self.assertEqual(second.heartbeat(), set())
+        first.heartbeat()
+        second.heartbeat()
+        self.assertEqual(len(first.held), 2)
+        self.assertEqual(len(second.held), 2)
+        self.assertFalse(first.held & second.held)
+
+        # 第一个进程失联，租约过期后被接管；它恢复后不能续回已被接管的租约
+        expired = timezone.now() - timedelta(seconds=1)
+        PileLease.objects.filter(holder='worker-a').update(expires_at=expired)
+        PileLeaseHolder.objects.filter(holder='worker-a').update(expires_at=expired)
+        self.assertEqual(len(second.heartbeat()), 4)
+        self.assertEqual(first.heartbeat(), set())
+
+        second.release_all()
+        self.assertEqual(len(first.heartbeat()), 4)
+
+    def test_sharded_progress_only_updates_held_piles(self):
+        """测试分片模式下进度更新只处理持有租约的充电桩"""
+        for i in range(4):
+            self.submit(i, amount=60.0)
+        ChargingRequest.objects.filter(current_status='charging').update(
+            start_time=timezone.now() - timedelta(minutes=10)
+        )
+        daemon = self.progress_daemon()
+        other = PileLeaseManager('worker-b', ttl=30)
+        other.heartbeat()
+        daemon.lease_manager = PileLeaseManager('worker-a', ttl=30)
+        daemon.renew_leases()
+        other.heartbeat()
+        daemon.renew_leases()
+        self.assertEqual(daemon.lease_manager.held, {'F3', 'F4'})
+        daemon.update_charging_progress()
+
+        for request in ChargingRequest.objects.filter(current_status='charging'):
+            updated = request.charging_pile_id in daemon.lease_manager.held
+            self.assertEqual(request.current_amount > 0, updated)
+
+    def test_lease_change_during_fault_scan_is_applied_next_scan(self):
+        """测试故障检测进行中续约失去的租约不会被本轮写回的水位覆盖，下一轮全量扫描"""
+        daemon = self.progress_daemon()
+        daemon.lease_manager = PileLeaseManager('worker-a', ttl=30)
+        daemon.initialize_pile_status_cache()
+        daemon.renew_leases()
+        daemon.detect_and_handle_pile_faults()
+        self.assertIsNotNone(daemon.pile_watermark)
+
+        other = PileLeaseManager('worker-b', ttl=30)
+        original = daemon.changed_piles
+        watermarks = []
+
+        def changed_piles():
+            # 模拟续约任务在本轮扫描期间运行：第二个进程加入后本进程释放一半充电桩
+            if not watermarks:
+                other.heartbeat()
+                daemon.renew_leases()
+            watermarks.append(daemon.pile_watermark)
+            return original()
+
+        with mock.patch.object(daemon, 'changed_piles', changed_piles):
+            daemon.detect_and_handle_pile_faults()
+            self.assertIsNotNone(daemon.pile_watermark)
+            daemon.detect_and_handle_pile_faults()
+
+        self.assertIsNotNone(watermarks[0])
+        self.assertIsNone(watermarks[1])
+        self.assertEqual(set(daemon.pile_status_cache), {'F1', 'F2'})
+
+
+class ClockTestCase(QueueServiceTestMixin, TestCase):
+
+    def test_clock_interface_requires_all_methods(self):
+        """测试时钟接口是抽象类，未实现全部方法的子类不能实例化"""
+        class NowOnlyClock(Clock):
+            def now(self):
+                return timezone.now()
+
+        self.assertRaises(TypeError, Clock)
+        self.assertRaises(TypeError, NowOnlyClock)
+
+    def test_scaled_clock_runs_faster_than_real_time(self):
+        """测试加速时钟按倍速流逝，sleep 的真实等待按倍速缩短"""
+        clock = ScaledClock(3600)
+        started = time.monotonic()
+        clock.sleep(36)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertGreaterEqual((clock.now() - clock.origin).total_seconds(), 36)
+
+    def test_virtual_clock_daemon_replays_slow_session_and_bills_it(self):
+        """测试虚拟时钟下守护进程在几秒内完成10小时的慢充并生成账单"""
+        self.create_piles(mode='slow', count=1, max_queue_size=1, power=7.0)
+        first = self.submit(1, mode='slow', amount=70.0)
+        second = self.submit(2, mode='slow', amount=7.0)
+        started = time.monotonic()
+        # 命令会注册信号处理器，测试结束后恢复
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+        # 估算进度含 80%-100% 的随机效率，10小时的充电最多需要12.5小时
+        call_command(
+            'update_charging_progress', daemon=True, virtual_clock=True, duration=24, interval=60,
+            stdout=io.StringIO()
+        )
+
+        self.assertLess(time.monotonic() - started, 30)
+        first = ChargingRequest.objects.select_related('session').get(pk=first.pk)
+        self.assertEqual(first.current_status, 'completed')
+        self.assertGreaterEqual(first.end_time - first.start_time, timedelta(hours=10))
+        self.assertGreater(first.session.total_cost, 0)
+        self.assertEqual(ChargingRequest.objects.get(pk=second.pk).current_status, 'completed')
+        # 时钟只作用于业务时间，不修改 timezone.now
+        self.assertLess(abs((timezone.now() - first.start_time).total_seconds()), 60)
+
+    def test_service_uses_injected_clock_without_changing_timezone_now(self):
+        """测试排队服务的开始、结束时间取自注入的时钟，timezone.now 保持真实时间"""
+        self.create_piles(count=1)
+        clock = VirtualClock()
+        service = AdvancedChargingQueueService(clock=clock.now)
+        vehicle = self.create_vehicle(1)
+        request = service.submit_charging_request(vehicle.user, {
+            'vehicle_id': vehicle.pk,
+            'charging_mode': 'fast',
+            'requested_amount': 30.0,
+            'battery_capacity': 60.0,
+        })
+        request.refresh_from_db()
+        self.assertEqual(request.start_time, clock.origin)
+
+        clock.advance(3 * 3600)
+        service.complete_charging(ChargingRequest.objects.select_related('session').get(pk=request.pk), 30.0)
+
+        request.refresh_from_db()
+        self.assertEqual(request.end_time - request.start_time, timedelta(hours=3))
+        self.assertLess(abs((timezone.now() - request.start_time).total_seconds()), 60)
+
+
+class PeriodicSchedulerTestCase(SimpleTestCase):
+
+    def run_for(self, tasks, seconds, clock):
+        """按虚拟时间运行周期任务，时钟到达 seconds 后停止"""
+        def stop():
+            if clock.monotonic() >= seconds:
+                scheduler.stop()
+
+        scheduler = PeriodicScheduler(tasks + [PeriodicTask('stop', seconds, stop)], clock=clock)
+        asyncio.run(scheduler.run())
+
+    def test_slow_task_does_not_delay_other_tasks(self):
+        """测试慢任务只跳过自己的轮次，不推迟其他周期任务"""
+        clock = VirtualTime()
+        fast = PeriodicTask('fast', 0.1, lambda: None)
+        slow = PeriodicTask('slow', 0.1, lambda: clock.sleep(0.45))
+
+        self.run_for([fast, slow], 1.05, clock)
+
+        # 快任务在 0, 0.1, ..., 1.0 执行；慢任务在 0、0.5、1.0 执行，每次错过之后的四轮
+        self.assertEqual(fast.metrics.runs, 11)
+        self.assertEqual(fast.metrics.missed_ticks, 0)
+        self.assertEqual(slow.metrics.runs, 3)
+        self.assertEqual(slow.metrics.missed_ticks, 12)
+        self.assertAlmostEqual(slow.metrics.max_latency, 450, places=3)
+
+    def test_interval_does_not_drift_with_task_duration(self):
+        """测试执行时刻只由起点和周期决定，不随执行耗时漂移"""
+        clock = VirtualTime()
+        started = []
+
+        def work():
+            started.append(round(clock.monotonic(), 6))
+            clock.sleep(0.03)
+
+        self.run_for([PeriodicTask('work', 0.1, work)], 0.35, clock)
+
+        self.assertEqual(started, [0.0, 0.1, 0.2, 0.3])
+
+
+class SchedulerWorkerTestCase(QueueServiceTestMixin, TestCase):
+
+    def setUp(self):
+        self.create_piles()
+
+    def command(self, command, **payload):
+        return SchedulerCommand.objects.create(charging_mode='fast', command=command, payload=payload)
+
+    def submit_command(self, index):
+        vehicle = self.create_vehicle(index)
+        return self.command('submit', user_id=vehicle.user_id, data={
+            'vehicle_id': vehicle.pk,
+            'charging_mode': 'fast',
+            'requested_amount': 30.0,
+            'battery_capacity': 60.0,
+        })
+
+    def test_batch_executes_commands_in_order(self):
+        """测试调度进程在一个批次中按顺序执行命令"""
+        commands = []
+        for i in range(7):
+            commands.append(self.submit_command(i))
+
+        self.assertEqual(SchedulerWorker('fast').run_once(), 7)
+
+        for command in commands:
+            command.refresh_from_db()
+            self.assertEqual(command.status, 'done')
+        last = ChargingRequest.objects.get(pk=commands[-1].result['request_id'])
+        self.assertEqual(last.queue_level, 'external_waiting')
+        self.assertEqual(last.external_queue_position, 1)
+        self.assert_positions_consistent()
+
+    def test_failed_command_does_not_roll_back_batch(self):
+        """测试批次中单条命令失败时其余命令仍然执行"""
+        first = self.submit_command(1)
+        invalid = self.command('change_mode', request_id=str(uuid.uuid4()), new_charging_mode='slow')
+        second = self.submit_command(2)
+
+        SchedulerWorker('fast').run_once()
+
+        for command in (first, invalid, second):
+            command.refresh_from_db()
+        self.assertEqual([first.status, invalid.status, second.status], ['done', 'failed', 'done'])
+        self.assertEqual(invalid.result['error_type'], 'DoesNotExist')
+        self.assertEqual(ChargingRequest.objects.filter(current_status='charging').count(), 2)
+        self.assert_positions_consistent()
+
+    def test_complete_command_settles_and_releases_in_one_event(self):
+        """测试完成命令在调度进程中一并结算、通知并释放充电桩"""
+        requests = self.submit_many(range(3))
+        first = ChargingRequest.objects.get(pk=requests[0].pk)
+        command = self.command('complete', request_id=str(first.pk), charged_amount=first.requested_amount)
+
+        SchedulerWorker('fast').run_once()
+
+        command.refresh_from_db()
+        self.assertEqual(command.status, 'done')
+        first.refresh_from_db()
+        self.assertEqual((first.current_status, first.current_amount), ('completed', first.requested_amount))
+        session = ChargingSession.objects.get(request=first)
+        self.assertIsNotNone(session.end_time)
+        self.assertGreater(session.total_cost, 0)
+        self.assertTrue(Notification.objects.filter(user=first.user, type='charging_complete').exists())
+        self.assertEqual(ChargingRequest.objects.filter(current_status='charging').count(), 2)
+        self.assert_positions_consistent()
+
+
+class QueueNumberAllocatorTestCase(TestCase):
+
+    def setUp(self):
+        QueueNumberAllocator.reset()
+
+    def tearDown(self):
+        QueueNumberAllocator.reset()
+        ParameterManager.clear_cache('queue_number_block_size')
+
+    def test_sequence_per_day_and_mode(self):
+        """测试排队号按日期和模式连续分配且不重复"""
+        fast = [QueueNumberAllocator.next_queue_number('fast') for _ in range(3)]
+        slow = QueueNumberAllocator.next_queue_number('slow')
+
+        self.assertEqual([number[-3:] for number in fast], ['001', '002', '003'])
+        self.assertTrue(fast[0].startswith('F'))
+        self.assertTrue(slow.startswith('S') and slow.endswith('001'))
+        self.assertEqual(QueueNumberSequence.objects.get(charging_mode='fast').last_value, 3)
+
+    def test_block_allocation_skips_database_until_exhausted(self):
+        """测试按号段分配时号段内的序号不访问数据库"""
+        ParameterManager.set_parameter('queue_number_block_size', 5, 'int')
+        today = timezone.localdate()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first = QueueNumberAllocator.next_value(today, 'fast')
+        with CaptureQueriesContext(connection) as context:
+            rest = [QueueNumberAllocator.next_value(today, 'fast') for _ in range(4)]
+        with self.captureOnCommitCallbacks(execute=True):
+            next_block = QueueNumberAllocator.next_value(today, 'fast')
+
+        self.assertEqual([first] + rest + [next_block], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(len(context), 0)
+        self.assertEqual(QueueNumberSequence.objects.get(charging_mode='fast').last_value, 10)
+
+    def test_block_discarded_when_transaction_rolls_back(self):
+        """测试外层事务回滚时不会继续使用该号段的剩余序号"""
+        ParameterManager.set_parameter('queue_number_block_size', 5, 'int')
+        today = timezone.localdate()
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            QueueNumberAllocator.next_value(today, 'fast')
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertNotIn((today, 'fast'), QueueNumberAllocator._blocks)
+
+
+class ConcurrentSchedulingTestCase(QueueServiceTestMixin, TransactionTestCase):
+    """多线程并发调度压力测试
+
+    内存 SQLite 无法跨线程并发写入，默认测试库是内存 SQLite 时，本测试类改用迁移好的临时文件数据库，
+    主线程和工作线程都连接到该文件。
+    """
+
+    THREADS = 6
+    REQUESTS_PER_THREAD = 4
+    QUEUE_PARAMETERS = {
+        'external_waiting_area_size': 50,
+        'fast_pile_max_queue_size': 2,
+        'slow_pile_max_queue_size': 2,
+        'queue_position_update_interval': 30,
+        'shortest_wait_time_threshold': 10,
+        'queue_number_block_size': 1,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.original_connection = None
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            cls.use_file_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.original_connection is not None:
+            cls.restore_database()
+        super().tearDownClass()
+
+    @classmethod
+    def use_file_database(cls):
+        """把默认连接切换到迁移好的临时 SQLite 文件，工作线程新建的连接也指向它"""
+        # 原连接保持打开，关闭会销毁共享的内存测试库
+        cls.original_connection = connections[DEFAULT_DB_ALIAS]
+        cls.original_settings = connections.settings[DEFAULT_DB_ALIAS]
+        handle, cls.database_file = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        connections.settings[DEFAULT_DB_ALIAS] = {
+            **cls.original_settings,
+            'NAME': cls.database_file,
+            'TEST': {**cls.original_settings.get('TEST', {}), 'NAME': cls.database_file},
+        }
+        connections[DEFAULT_DB_ALIAS] = connections.create_connection(DEFAULT_DB_ALIAS)
+        ParameterManager.reset_cache()
+        call_command('migrate', database=DEFAULT_DB_ALIAS, verbosity=0, interactive=False)
+
+    @classmethod
+    def restore_database(cls):
+        """关闭临时文件数据库并恢复原连接"""
+        connections[DEFAULT_DB_ALIAS].close()
+        connections.settings[DEFAULT_DB_ALIAS] = cls.original_settings
+        connections[DEFAULT_DB_ALIAS] = cls.original_connection
+        ParameterManager.reset_cache()
+        os.remove(cls.database_file)
+
+    def setUp(self):
+        for charging_mode in ('fast', 'slow'):
+            QueueLock.objects.get_or_create(charging_mode=charging_mode)
+        self.create_piles(count=3, max_queue_size=2)
+        # 预先写入并缓存队列参数，使每个调度事务的第一条语句就是加锁写入
+        # （SQLite 中先读后写的事务在并发时会直接报 database is locked）
+        for key, value in self.QUEUE_PARAMETERS.items():
+            ParameterManager.set_parameter(key, value, 'int')
+        get_queue_config()
+        QueueNumberAllocator.reset()
+
+    def tearDown(self):
+        QueueNumberAllocator.reset()
+        for key in self.QUEUE_PARAMETERS:
+            ParameterManager.clear_cache(key)
+
+    def test_concurrent_submit_cancel_complete_keeps_positions_consistent(self):
+        """测试多线程并发提交、取消和完成充电后队列位置保持一致"""
+        vehicles = []
+        for thread in range(self.THREADS):
+            thread_vehicles = []
+            for i in range(self.REQUESTS_PER_THREAD):
+                thread_vehicles.append(self.create_vehicle(thread * 100 + i))
+            vehicles.append(thread_vehicles)
+        errors = []
+        barrier = threading.Barrier(self.THREADS)
+
+        def worker(thread_vehicles):
+            try:
+                barrier.wait()
+                submitted = []
+                for vehicle in thread_vehicles:
+                    submitted.append(self.submit(0, vehicle=vehicle))
+                service = AdvancedChargingQueueService()
+                for request in submitted[::2]:
+                    request = ChargingRequest.objects.select_related('user').get(pk=request.pk)
+                    if request.current_status == 'charging':
+                        service.complete_charging(request)
+                    elif request.current_status == 'waiting':
+                        try:
+                            service.cancel_charging_request(request)
+                        except ValueError:
+                            # 读取状态后已被其他线程叫号开始充电
+                            pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(v,)) for v in vehicles]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assert_positions_consistent()
+
+        total = self.THREADS * self.REQUESTS_PER_THREAD
+        self.assertEqual(ChargingRequest.objects.count(), total)
+        self.assertEqual(
+            len(set(ChargingRequest.objects.values_list('queue_number', flat=True))), total
+        )
+        # 每个进入充电状态的请求恰好有一个会话
+        started = ChargingRequest.objects.filter(start_time__isnull=False).count()
+        self.assertEqual(ChargingSession.objects.count(), started)
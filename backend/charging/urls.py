@@ -14,20 +14,26 @@ urlpatterns = [
     path('request/<uuid:request_id>/cancel/', views.cancel_charging_request, name='cancel_request'),
     path('request/<uuid:request_id>/change-mode/', views.change_charging_mode, name='change_charging_mode'),
     path('request/status/', views.charging_request_status, name='request_status'),
+    path('request/status/wait/', views.wait_charging_request_status, name='request_status_wait'),
     path('requests/active/', views.active_charging_requests, name='active_requests'),
     path('complete/', views.complete_charging, name='complete_charging'),
     
     # 充电进度控制
     path('progress/update/', views.update_charging_progress, name='update_progress'),
+    path('telemetry/', views.ingest_pile_telemetry, name='pile_telemetry'),
     
     # 排队信息
     path('queue/status/', views.queue_status, name='queue_status'),
     path('piles/status/', views.piles_status, name='piles_status'),
+    path('piles/<str:pile_id>/status/', views.update_pile_status, name='update_pile_status'),
     path('queue/enhanced/', views.enhanced_queue_status, name='enhanced_queue_status'),
+    path('events/', views.queue_events, name='queue_events'),
+    path('events/ticket/', views.issue_queue_events_ticket, name='queue_events_ticket'),
     
     # 账单管理
     path('bills/', views.BillListView.as_view(), name='bills'),
     path('bills/<uuid:bill_id>/', views.bill_detail, name='bill_detail'),
+    path('bills/<uuid:bill_id>/curve/', views.bill_curve, name='bill_curve'),
     
     # 历史记录管理
     path('history/', views.ChargingHistoryView.as_view(), name='charging_history'),
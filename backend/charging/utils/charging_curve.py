@@ -0,0 +1,116 @@
+"""
+充电曲线的紧凑存储
+
+每个充电会话的曲线是一串 (距开始的秒数, 累计充电量kWh, 功率kW) 采样点。
+时间和充电量按 float32 差分存储，功率按 float32 原值存储，三列依次排列在一个二进制块中。
+编码差分时以上一个点的还原值为基准，量化误差不会随采样点累积。
+采样点超过上限时隔点抽稀，并把最小采样间隔加倍，长会话的存储大小保持有界。
+"""
+
+import struct
+import sys
+from array import array
+from itertools import accumulate
+
+# 头部：格式版本、采样点数、最小采样间隔（秒）
+HEADER = struct.Struct('<BId')
+VERSION = 1
+
+
+def _float32(value):
+    return array('f', [value])[0]
+
+
+def _pack_floats(values):
+    data = array('f', values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def _unpack_floats(blob, start, count):
+    data = array('f')
+    data.frombytes(blob[start:start + count * data.itemsize])
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data
+
+
+class CurveBuffer:
+    """单个会话的充电曲线缓冲"""
+
+    # 超过该采样点数时隔点抽稀
+    MAX_SAMPLES = 1024
+
+    def __init__(self, offsets=(), amounts=(), powers=(), min_interval=0.0):
+        # 内存中保存还原后的绝对值，编码时再转为差分
+        self.offsets = list(offsets)
+        self.amounts = list(amounts)
+        self.powers = list(powers)
+        self.min_interval = min_interval
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        if not blob:
+            return cls()
+        blob = bytes(blob)
+        version, count, min_interval = HEADER.unpack_from(blob)
+        if version != VERSION:
+            raise ValueError(f'不支持的充电曲线格式版本: {version}')
+        width = array('f').itemsize * count
+        start = HEADER.size
+        return cls(
+            accumulate(_unpack_floats(blob, start, count)),
+            accumulate(_unpack_floats(blob, start + width, count)),
+            _unpack_floats(blob, start + 2 * width, count),
+            min_interval,
+        )
+
+    def to_bytes(self):
+        return b''.join((
+            HEADER.pack(VERSION, len(self), self.min_interval),
+            _pack_floats(self._deltas(self.offsets)),
+            _pack_floats(self._deltas(self.amounts)),
+            _pack_floats(self.powers),
+        ))
+
+    @staticmethod
+    def _deltas(values):
+        return [value - previous for previous, value in zip([0.0] + values[:-1], values)]
+
+    def append(self, offset, amount, power):
+        """追加一个采样点，返回是否写入（早于末尾采样点的乱序点被忽略）"""
+        if self.offsets and offset < self.offsets[-1]:
+            return False
+
+        if len(self) >= 2 and offset - self.offsets[-2] < self.min_interval:
+            # 与前一个保留点的间隔不足最小采样间隔：替换末尾的点，曲线总以最新的采样结束
+            self._pop()
+
+        previous_offset = self.offsets[-1] if self.offsets else 0.0
+        previous_amount = self.amounts[-1] if self.amounts else 0.0
+        # 以还原值为基准计算差分，量化误差不累积
+        self.offsets.append(previous_offset + _float32(offset - previous_offset))
+        self.amounts.append(previous_amount + _float32(amount - previous_amount))
+        self.powers.append(_float32(power))
+
+        if len(self) > self.MAX_SAMPLES:
+            self.downsample()
+        return True
+
+    def _pop(self):
+        self.offsets.pop()
+        self.amounts.pop()
+        self.powers.pop()
+
+    def downsample(self):
+        """隔点抽稀（保留首尾采样点），最小采样间隔加倍"""
+        keep = list(range(0, len(self) - 1, 2)) + [len(self) - 1]
+        self.offsets = [self.offsets[i] for i in keep]
+        self.amounts = [self.amounts[i] for i in keep]
+        self.powers = [self.powers[i] for i in keep]
+        spacing = (self.offsets[-1] - self.offsets[0]) / max(len(self) - 1, 1)
+        self.min_interval = max(self.min_interval * 2, spacing)
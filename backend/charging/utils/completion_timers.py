@@ -0,0 +1,81 @@
+"""
+充电完成定时器
+
+充电会话的完成时刻可以由开始时间、请求充电量和桩功率直接算出，
+定时器堆按预计完成时刻排序，守护进程只需睡到最近的完成时刻再处理，
+不必按固定间隔轮询全部充电中的请求。
+"""
+
+import heapq
+import math
+from datetime import timedelta
+
+
+def projected_completion(start_time, requested_amount, charging_power):
+    """预计完成时刻（向上取整到毫秒，保证到点时按时长计算的充电量不小于请求量）"""
+    milliseconds = math.ceil(requested_amount / charging_power * 3600 * 1000)
+    return start_time + timedelta(milliseconds=milliseconds)
+
+
+class CompletionTimerHeap:
+    """按预计完成时刻排序的定时器堆（过期条目在弹出时惰性丢弃）"""
+
+    def __init__(self):
+        self._heap = []
+        # 请求ID -> 当前有效的到期时刻
+        self._deadlines = {}
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, request_id):
+        return request_id in self._deadlines
+
+    def schedule(self, request_id, deadline):
+        """设置（或改期）请求的到期时刻"""
+        if self._deadlines.get(request_id) == deadline:
+            return
+        self._deadlines[request_id] = deadline
+        heapq.heappush(self._heap, (deadline, str(request_id), request_id))
+
+    def cancel(self, request_id):
+        self._deadlines.pop(request_id, None)
+
+    def sync(self, rows):
+        """按当前充电中的请求同步定时器
+
+        rows 为 (请求ID, 开始时间, 请求充电量, 桩功率)；已有定时器保持不变，
+        新开始充电的请求加入定时器，不再充电的请求移除。
+        """
+        charging = set()
+        for request_id, start_time, requested_amount, charging_power in rows:
+            charging.add(request_id)
+            if request_id not in self._deadlines:
+                self.schedule(request_id, projected_completion(start_time, requested_amount, charging_power))
+
+        for request_id in list(self._deadlines):
+            if request_id not in charging:
+                self.cancel(request_id)
+
+    def _discard_stale(self):
+        while self._heap:
+            deadline, _, request_id = self._heap[0]
+            if self._deadlines.get(request_id) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def next_deadline(self):
+        """最近的到期时刻，没有定时器时返回 None"""
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """弹出所有已到期的定时器，返回 [(请求ID, 到期时刻)]（按到期时刻排序）"""
+        due = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                return due
+            _, _, request_id = heapq.heappop(self._heap)
+            del self._deadlines[request_id]
+            due.append((request_id, deadline))
@@ -0,0 +1,132 @@
+"""
+批量调度分配求解
+
+把外部等候区中本轮可以调度的请求与各桩队列的空位看作一个指派问题。
+桩 p 上倒数第 k 个位置的请求，其充电时长 a_i·r_p（a_i 为请求电量，r_p 为桩每 kWh 所需分钟数）
+会计入它自己以及排在它后面的共 k 个请求的完成时间，因此请求 i 放在空位 (p, k) 的代价为
+B_p + a_i·k·r_p（B_p 为桩当前的预计剩余时间），指派的总代价就是这批请求的完成时间之和。
+
+代价可分离为空位固定代价 B_p 与权重 w = k·r_p 的乘积项：选定空位集合后，按排序不等式
+电量最大的请求应放在权重最小的空位上。因此把空位按权重升序、请求按电量降序排列后，
+问题化为"从空位序列中选出与请求一一对应的子序列"，用 NumPy 按空位逐个向量化动态规划求解，
+复杂度 O(空位数 × 请求数)，几百辆车、几十个桩也只需毫秒级。
+
+NumPy 不可用或超出时间预算时，调用方退回逐个选择剩余时间最短的桩的贪心策略。
+"""
+
+import heapq
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - 未安装 NumPy 时使用贪心策略
+    np = None
+
+
+class DispatchTimeout(Exception):
+    """求解超出时间预算"""
+
+
+def is_available() -> bool:
+    """NumPy 是否可用"""
+    return np is not None
+
+
+def plan_optimal_dispatch(amounts: Sequence[float], rates: Sequence[float], base_times: Sequence[float],
+                          capacities: Sequence[int], time_budget_ms: Optional[float] = None) -> List[List[int]]:
+    """按完成时间之和最小求解批量调度
+
+    Args:
+        amounts: 按先后顺序排列的请求充电量(kWh)
+        rates: 每个桩充 1kWh 所需的分钟数
+        base_times: 每个桩当前的预计剩余时间(分钟)
+        capacities: 每个桩本轮还能接收的请求数
+        time_budget_ms: 求解时间预算(毫秒)，超出时抛出 DispatchTimeout
+
+    Returns:
+        每个桩按排队顺序（从前到后）分配到的请求下标列表。调度数量为 min(请求数, 空位总数)，
+        与贪心策略一样按先后顺序取前面的请求，只优化它们的分配。
+    """
+    deadline = None
+    if time_budget_ms is not None:
+        deadline = time.perf_counter() + time_budget_ms / 1000
+
+    plan = [[] for _ in base_times]
+    count = min(len(amounts), int(sum(capacities)))
+    if count == 0:
+        return plan
+
+    # 请求按电量降序
+    amounts = np.asarray(amounts[:count], dtype=float)
+    request_order = np.argsort(-amounts, kind='stable')
+    sorted_amounts = amounts[request_order]
+
+    # 空位 (p, k) 按权重 k·r_p 升序；倒数位置超过调度数量的空位不可能用到
+    capacities = np.minimum(np.asarray(capacities, dtype=np.int64), count)
+    slot_piles = np.repeat(np.arange(len(capacities)), capacities)
+    slot_ranks = np.concatenate([np.arange(1, c + 1) for c in capacities])
+    slot_weights = slot_ranks * np.asarray(rates, dtype=float)[slot_piles]
+    slot_order = np.argsort(slot_weights, kind='stable')
+    slot_bases = np.asarray(base_times, dtype=float)[slot_piles]
+
+    # best[j]: 已处理的空位中选出 j 个、依次放置电量最大的 j 个请求的最小代价
+    best = np.full(count + 1, np.inf)
+    best[0] = 0.0
+    taken = np.zeros((len(slot_order), count), dtype=bool)
+    for step, slot in enumerate(slot_order):
+        candidate = best[:-1] + slot_bases[slot] + sorted_amounts * slot_weights[slot]
+        improved = candidate < best[1:]
+        taken[step] = improved
+        best[1:] = np.where(improved, candidate, best[1:])
+
+        if deadline is not None and step % 32 == 31 and time.perf_counter() > deadline:
+            raise DispatchTimeout()
+
+    # 回溯得到每个请求的空位
+    placed = [[] for _ in base_times]
+    remaining = count
+    for step in range(len(slot_order) - 1, -1, -1):
+        if remaining == 0:
+            break
+        if taken[step, remaining - 1]:
+            slot = slot_order[step]
+            placed[slot_piles[slot]].append((int(slot_ranks[slot]), int(request_order[remaining - 1])))
+            remaining -= 1
+
+    for pile_index, items in enumerate(placed):
+        # 倒数位置越大越靠前
+        plan[pile_index] = [request_index for _, request_index in sorted(items, reverse=True)]
+    return plan
+
+
+def plan_greedy_dispatch(amounts: Sequence[float], rates: Sequence[float], base_times: Sequence[float],
+                         capacities: Sequence[int]) -> List[List[int]]:
+    """贪心策略：按请求顺序依次交给预计完成时间最早且有空位的桩（与逐个选择剩余时间最短的桩等价）"""
+    plan = [[] for _ in base_times]
+    remaining = list(capacities)
+    slots = [(float(base_times[p]), p) for p in range(len(base_times)) if remaining[p] > 0]
+    heapq.heapify(slots)
+
+    for request_index, amount in enumerate(amounts):
+        if not slots:
+            break
+        finish_time, pile_index = heapq.heappop(slots)
+        plan[pile_index].append(request_index)
+        remaining[pile_index] -= 1
+        if remaining[pile_index] > 0:
+            heapq.heappush(slots, (finish_time + amount * rates[pile_index], pile_index))
+    return plan
+
+
+def evaluate_plan(plan: List[List[int]], amounts: Sequence[float], rates: Sequence[float],
+                  base_times: Sequence[float]) -> Dict[int, Tuple[float, float]]:
+    """计算调度方案中每个请求的等待时间和完成时间，返回 {请求下标: (等待, 完成)}"""
+    result = {}
+    for pile_index, requests in enumerate(plan):
+        elapsed = float(base_times[pile_index])
+        for request_index in requests:
+            wait_time = elapsed
+            elapsed += amounts[request_index] * rates[pile_index]
+            result[request_index] = (wait_time, elapsed)
+    return result
@@ -16,6 +16,8 @@ class ParameterManager:
     CACHE_PREFIX = 'sys_param:'
     # 缓存超时时间（秒）
     CACHE_TIMEOUT = 300  # 5分钟
+    # 本进程写入过缓存的参数键名
+    _cached_keys = set()
     
     @classmethod
     def get_parameter(cls, key: str, default: Any = None, param_type: str = 'auto') -> Any:
@@ -43,6 +45,7 @@ class ParameterManager:
             
             # 存入缓存
             cache.set(cache_key, value, cls.CACHE_TIMEOUT)
+            cls._cached_keys.add(key)
             return value
             
         except SystemParameter.DoesNotExist:
@@ -127,6 +130,12 @@ class ParameterManager:
                 f"{cls.CACHE_PREFIX}{param.param_key}" 
                 for param in SystemParameter.objects.all()
             ])
+    
+    @classmethod
+    def reset_cache(cls):
+        """清除本进程写入过的参数缓存（不查询数据库，切换数据库连接前后使用）"""
+        cache.delete_many([f"{cls.CACHE_PREFIX}{key}" for key in cls._cached_keys])
+        cls._cached_keys.clear()
 
 
 # 常用参数获取函数（简化接口）
@@ -148,6 +157,16 @@ def get_queue_config():
         'slow_pile_max_queue_size': ParameterManager.get_parameter('slow_pile_max_queue_size', 5, 'int'),
         'queue_update_interval': ParameterManager.get_parameter('queue_position_update_interval', 30, 'int'),
         'shortest_wait_threshold': ParameterManager.get_parameter('shortest_wait_time_threshold', 10, 'int'),
+        'queue_number_block_size': ParameterManager.get_parameter('queue_number_block_size', 1, 'int'),
+    }
+
+
+def get_dispatch_config():
+    """获取桩队列调度策略配置"""
+    return {
+        'strategy': ParameterManager.get_parameter('dispatch_strategy', 'greedy'),
+        # 几百辆车、几十个桩时求解耗时约 1~10ms，20ms 预算留有余量，又不会让调度锁被长时间占用
+        'time_budget_ms': ParameterManager.get_parameter('dispatch_time_budget_ms', 20, 'int'),
     }
 
 
@@ -188,4 +207,20 @@ def get_fault_handling_config():
         'auto_recovery_enabled': ParameterManager.get_parameter('auto_recovery_enabled', True, 'boolean'),
         'notification_delay': ParameterManager.get_parameter('fault_notification_delay', 0, 'int'),
         'recovery_reschedule_enabled': ParameterManager.get_parameter('recovery_reschedule_enabled', True, 'boolean'),
-    } 
\ No newline at end of file
+    } 
+
+
+def get_scheduler_config():
+    """获取调度模式配置"""
+    return {
+        'mode': ParameterManager.get_parameter('scheduler_mode', 'direct'),
+        'batch_size': ParameterManager.get_parameter('scheduler_batch_size', 50, 'int'),
+        'command_timeout': ParameterManager.get_parameter('scheduler_command_timeout', 10, 'int'),
+    }
+
+
+def get_telemetry_config():
+    """获取充电桩电表遥测配置"""
+    return {
+        'timeout_seconds': ParameterManager.get_parameter('telemetry_timeout_seconds', 60, 'int'),
+    }
@@ -0,0 +1,96 @@
+"""
+排队号分配工具
+
+排队号格式为 {F|S}{MMDDHHMM}{序号}，序号按日期和充电模式从计数器行中分配。
+计数器通过一条原子 UPDATE 递增，每个进程一次可以领取一段序号（号段），
+号段用完前分配排队号不需要访问数据库，多个进程之间也不会重复。
+"""
+
+import threading
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from charging.models import ChargingRequest, QueueNumberSequence
+from charging.utils.parameter_manager import get_queue_config
+
+
+class QueueNumberAllocator:
+    """排队号分配器（按进程缓存号段）"""
+    
+    # {(日期, 充电模式): [下一个可用序号, 号段末尾序号]}
+    _blocks = {}
+    _lock = threading.Lock()
+    
+    @classmethod
+    def next_queue_number(cls, charging_mode: str) -> str:
+        """分配一个新的排队号"""
+        now = timezone.localtime()
+        sequence = cls.next_value(now.date(), charging_mode)
+        prefix = 'F' if charging_mode == 'fast' else 'S'
+        return f"{prefix}{now.strftime('%m%d%H%M')}{sequence:03d}"
+    
+    @classmethod
+    def next_value(cls, date, charging_mode: str) -> int:
+        """从本进程的号段中取下一个序号，号段用完时向数据库领取新号段"""
+        key = (date, charging_mode)
+        with cls._lock:
+            block = cls._blocks.get(key)
+            if block is not None and block[0] <= block[1]:
+                value = block[0]
+                block[0] += 1
+                return value
+        
+        block_size = max(get_queue_config()['queue_number_block_size'], 1)
+        start, end = cls._reserve_block(date, charging_mode, block_size)
+        if start < end:
+            # 号段在外层事务提交后才真正生效，回滚时不能继续使用其余序号
+            transaction.on_commit(lambda: cls._store_block(key, start + 1, end))
+        return start
+    
+    @classmethod
+    def _store_block(cls, key, start, end):
+        with cls._lock:
+            block = cls._blocks.get(key)
+            if block is None or block[0] > block[1]:
+                # 只保留当天的号段
+                cls._blocks = {k: v for k, v in cls._blocks.items() if k[0] == key[0]}
+                cls._blocks[key] = [start, end]
+    
+    @classmethod
+    def _reserve_block(cls, date, charging_mode: str, block_size: int):
+        """原子地把计数器推进 block_size，返回领取到的 (起始序号, 末尾序号)"""
+        with transaction.atomic():
+            updated = QueueNumberSequence.objects.filter(
+                date=date, charging_mode=charging_mode
+            ).update(last_value=F('last_value') + block_size)
+            
+            if not updated:
+                # 当天第一次分配：以当天已有请求数为起点，兼容启用序列前生成的排队号
+                existing = ChargingRequest.objects.filter(
+                    charging_mode=charging_mode,
+                    created_at__date=date
+                ).count()
+                try:
+                    with transaction.atomic():
+                        QueueNumberSequence.objects.create(
+                            date=date,
+                            charging_mode=charging_mode,
+                            last_value=existing + block_size
+                        )
+                    return existing + 1, existing + block_size
+                except IntegrityError:
+                    # 其它进程已创建计数器行，改为递增
+                    QueueNumberSequence.objects.filter(
+                        date=date, charging_mode=charging_mode
+                    ).update(last_value=F('last_value') + block_size)
+            
+            end = QueueNumberSequence.objects.filter(
+                date=date, charging_mode=charging_mode
+            ).values_list('last_value', flat=True).get()
+            return end - block_size + 1, end
+    
+    @classmethod
+    def reset(cls):
+        """清空本进程缓存的号段（测试使用）"""
+        with cls._lock:
+            cls._blocks = {}
@@ -1,17 +1,32 @@
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from rest_framework import status, generics, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.db import transaction
 from .models import (ChargingRequest, ChargingPile, ChargingSession, 
                     SystemParameter, Notification)
-from .serialiazers import (ChargingRequestSerializer, ChargingRequestCreateSerializer,
-                         ChargingPileSerializer, ChargingSessionSerializer,
-                         SystemParameterSerializer, NotificationSerializer)
+from .serialiazers import (ActiveChargingRequestSerializer, ChargingRequestSerializer,
+                         ChargingRequestCreateSerializer, ChargingPileSerializer, ChargingSessionSerializer,
+                         SystemParameterSerializer, NotificationSerializer,
+                         PileTelemetryReadingSerializer)
+from .counters import station_counters
+from .events import (EVENT_TICKET_MAX_AGE, LONG_POLL_TIMEOUT, MAX_LONG_POLL_TIMEOUT, event_ticket_user_id,
+                     issue_event_ticket, queue_event_stream, released, wait_for_request_change)
 from .services import AdvancedChargingQueueService, BillingService
+from .progress import apply_progress
+from .scheduler import get_queue_service
+from .snapshots import (conditional_on_version, enhanced_queue_status_snapshot, queue_status_snapshot,
+                        snapshot_version, user_snapshot_version)
+from .telemetry import MAX_BATCH_SIZE, ingest_readings
+from charging.utils.charging_curve import CurveBuffer
 from charging.utils.parameter_manager import ParameterManager
 
 # Create your views here.
@@ -26,7 +41,7 @@ class ChargingRequestView(generics.GenericAPIView):
             # 车辆验证已在序列化器中完成
             
             # 检查外部等候区容量
-            queue_service = AdvancedChargingQueueService()
+            queue_service = get_queue_service()
             if not queue_service.can_join_external_queue():
                 return Response({
                     'success': False,
@@ -36,9 +51,8 @@ class ChargingRequestView(generics.GenericAPIView):
                     }
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            with transaction.atomic():
-                charging_request = serializer.save(user=request.user)
-                queue_service.add_to_external_queue(charging_request)
+            # 创建请求并加入外部等候区（单写者模式下由调度进程执行）
+            charging_request = queue_service.submit_charging_request(request.user, serializer.validated_data)
             
             response_data = ChargingRequestSerializer(charging_request).data
             
@@ -134,10 +148,18 @@ def cancel_charging_request(request, request_id):
             }
         }, status=status.HTTP_400_BAD_REQUEST)
     
-    with transaction.atomic():
-        queue_service = AdvancedChargingQueueService()
+    queue_service = get_queue_service()
+    try:
         queue_service.cancel_charging_request(charging_request)
-    
+    except ValueError as e:
+        return Response({
+            'success': False,
+            'error': {
+                'code': 'INVALID_REQUEST',
+                'message': str(e)
+            }
+        }, status=status.HTTP_400_BAD_REQUEST)
+
     return Response({
         'success': True,
         'message': '充电请求已取消'
@@ -174,7 +196,7 @@ def change_charging_mode(request, request_id):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         # 使用队列服务修改充电类型
-        queue_service = AdvancedChargingQueueService()
+        queue_service = get_queue_service()
         updated_request = queue_service.change_charging_mode(charging_request, new_charging_mode)
         
         # 返回更新后的请求信息
@@ -208,10 +230,8 @@ def change_charging_mode(request, request_id):
 def charging_request_status(request):
     """查看当前充电请求状态"""
     try:
-        charging_request = ChargingRequest.objects.filter(
-            user=request.user,
-            current_status__in=['waiting', 'charging']
-        ).first()
+        # 请求连同车辆、充电桩和会话一次查询读出
+        charging_request = ChargingRequest.objects.active_for(request.user).first()
         
         if not charging_request:
             return Response({
@@ -222,20 +242,9 @@ def charging_request_status(request):
                 }
             }, status=status.HTTP_200_OK)
         
-        # 根据队列层级计算前面等待的数量
-        ahead_count = 0
-        if charging_request.queue_level == 'external_waiting':
-            ahead_count = charging_request.external_queue_position - 1
-        elif charging_request.queue_level == 'pile_queue':
-            ahead_count = charging_request.pile_queue_position - 1
-        
-        data = ChargingRequestSerializer(charging_request).data
-        data['ahead_count'] = ahead_count
-        data['queue_status'] = charging_request.get_queue_status_display()
-        
         return Response({
             'success': True,
-            'data': data
+            'data': ActiveChargingRequestSerializer(charging_request).data
         })
     except Exception as e:
         return Response({
@@ -248,24 +257,21 @@ def charging_request_status(request):
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@conditional_on_version(lambda request: station_counters())
 def public_system_status(request):
-    """公开的系统状态接口，不需要认证"""
+    """公开的系统状态接口，不需要认证（读取进程内缓存的充电站计数）"""
     try:
-        # 获取基本系统统计
-        total_piles = ChargingPile.objects.count()
-        working_piles = ChargingPile.objects.filter(is_working=True).count()
-        waiting_requests = ChargingRequest.objects.filter(current_status='waiting').count()
-        charging_requests = ChargingRequest.objects.filter(current_status='charging').count()
+        counters = station_counters()
         
         return Response({
             'success': True,
             'data': {
                 'system_status': 'online',
-                'total_piles': total_piles,
-                'available_piles': total_piles - working_piles,
-                'working_piles': working_piles,
-                'waiting_count': waiting_requests,
-                'charging_count': charging_requests
+                'total_piles': counters['total_piles'],
+                'available_piles': counters['total_piles'] - counters['working_piles'],
+                'working_piles': counters['working_piles'],
+                'waiting_count': counters['waiting'],
+                'charging_count': counters['charging']
             }
         })
     except Exception as e:
@@ -301,39 +307,11 @@ def complete_charging(request):
         )
     
     try:
-        with transaction.atomic():
-            # 计算账单
-            session = charging_request.session
-            billing_service = BillingService()
-            billing_service.calculate_bill(session)
-            session.save()
-            
-            # 完成充电
-            charging_request.current_amount = charging_request.requested_amount
-            charging_request.current_status = 'completed'
-            charging_request.end_time = timezone.now()
-            charging_request.save()
-            
-            # 处理后续逻辑
-            if hasattr(charging_request, 'session'):
-                session = charging_request.session
-                session.end_time = timezone.now()
-                session.charging_amount = charging_request.requested_amount
-                
-                billing_service = BillingService()
-                billing_service.calculate_bill(session)
-                session.save()
-            
-            # 使用新的队列服务完成充电
-            queue_service = AdvancedChargingQueueService()
-            queue_service.complete_charging(charging_request)
-            
-            # 发送完成通知
-            Notification.objects.create(
-                user=charging_request.user,
-                type='charging_complete',
-                message=f'您的充电请求 {charging_request.queue_number} 已完成，总费用：{session.total_cost}元'
-            )
+        # 结算、完成通知、释放充电桩并推进队列在同一个事务中提交（单写者模式下由调度进程执行）
+        # 按已充电量（进度估算或电表读数）结算，提前结束时不按请求充电量计费
+        queue_service = get_queue_service()
+        queue_service.complete_charging(charging_request)
+        session = charging_request.session
         
         return Response({
             'success': True,
@@ -346,6 +324,14 @@ def complete_charging(request):
             }
         })
         
+    except ValueError as e:
+        return Response({
+            'success': False,
+            'error': {
+                'code': 'INVALID_REQUEST',
+                'message': str(e)
+            }
+        }, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({
             'success': False,
@@ -399,9 +385,7 @@ def update_charging_progress(request):
             
             if action == 'auto':
                 # 自动计算进度
-                from .management.commands.update_charging_progress import Command
-                cmd = Command()
-                cmd.update_request_progress(charging_request)
+                apply_progress([charging_request])
                 
             elif action == 'increase':
                 # 增加指定量
@@ -476,12 +460,60 @@ def update_charging_progress(request):
             }
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def ingest_pile_telemetry(request):
+    """批量上报充电桩电表读数API - 仅管理员（充电桩网关账号）可用
+    
+    校验失败的读数单独列出，不影响同一批中的其他读数。
+    """
+    readings = request.data.get('readings')
+    if not isinstance(readings, list) or not readings:
+        return Response({
+            'success': False,
+            'error': {
+                'code': 'MISSING_PARAMETER',
+                'message': 'readings 必须是非空数组'
+            }
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    if len(readings) > MAX_BATCH_SIZE:
+        return Response({
+            'success': False,
+            'error': {
+                'code': 'INVALID_PARAMETER',
+                'message': f'单次最多上报 {MAX_BATCH_SIZE} 条读数'
+            }
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    # 逐条校验字段，充电桩是否存在用一次查询校验
+    serializer = PileTelemetryReadingSerializer(data=readings, many=True)
+    serializer.is_valid()
+    
+    try:
+        result = ingest_readings(serializer.validated_data)
+    except Exception as e:
+        return Response({
+            'success': False,
+            'error': {
+                'code': 'UPDATE_ERROR',
+                'message': f'写入电表读数失败：{str(e)}'
+            }
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    result['rejected'] = serializer.rejected
+    return Response({
+        'success': True,
+        'data': result
+    })
+
 @api_view(['GET'])
+@conditional_on_version()
 def enhanced_queue_status(request):
     """获取增强的排队状态（支持多级队列）"""
     try:
-        queue_service = AdvancedChargingQueueService()
-        queue_data = queue_service.get_enhanced_queue_status()
+        # 队列未变化时直接使用缓存的快照
+        queue_data = enhanced_queue_status_snapshot()
         
         return Response({
             'success': True,
@@ -497,12 +529,14 @@ def enhanced_queue_status(request):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['GET'])
+@conditional_on_version(lambda request: (
+    snapshot_version(), ParameterManager.get_parameter('external_waiting_area_size', 50)
+))
 def queue_status(request):
     """获取排队状态（保持向后兼容）"""
     try:
-        # 使用增强的队列服务
-        queue_service = AdvancedChargingQueueService()
-        enhanced_data = queue_service.get_queue_status()
+        # 使用增强的队列服务（队列未变化时直接使用缓存的快照）
+        enhanced_data = queue_status_snapshot()
         
         # 转换为旧格式以保持兼容性
         fast_data = enhanced_data.get('fast', {})
@@ -540,19 +574,166 @@ def queue_status(request):
             }
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def _event_error(code, message, http_status):
+    return JsonResponse({
+        'success': False,
+        'error': {
+            'code': code,
+            'message': message
+        }
+    }, status=http_status)
+
+def _header_token_user(request):
+    """Authorization: Token <key> 请求头认证（与其他接口相同的 TokenAuthentication），失败时返回 None"""
+    try:
+        result = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+def _ticket_user(ticket):
+    """推送票据认证，失败时返回 None"""
+    user_id = event_ticket_user_id(ticket)
+    if user_id is None:
+        return None
+    return get_user_model().objects.filter(pk=user_id, is_active=True).first()
+
+async def _authenticated_user(request, allow_ticket=False):
+    """异步视图的认证：令牌请求头，或（allow_ticket 时）?ticket= 推送票据；失败时返回 None"""
+    user = await released(_header_token_user)(request)
+    ticket = request.GET.get('ticket')
+    if user is None and allow_ticket and ticket:
+        user = await released(_ticket_user)(ticket)
+    return user
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def issue_queue_events_ticket(request):
+    """签发排队事件推送票据：浏览器的 EventSource 无法设置请求头，用短期票据代替查询参数中的令牌"""
+    return Response({
+        'success': True,
+        'data': {
+            'ticket': issue_event_ticket(request.user),
+            'expires_in': EVENT_TICKET_MAX_AGE
+        }
+    })
+
+def _async_view_error(request):
+    """异步视图的公共检查：只支持 GET，且必须通过 ASGI 服务器访问"""
+    if request.method != 'GET':
+        return _event_error('METHOD_NOT_ALLOWED', '只支持 GET 请求', status.HTTP_405_METHOD_NOT_ALLOWED)
+    if not isinstance(request, ASGIRequest):
+        return _event_error('ASGI_REQUIRED', '该接口需要通过 ASGI 服务器访问', status.HTTP_501_NOT_IMPLEMENTED)
+    return None
+
+async def queue_events(request):
+    """排队事件推送（Server-Sent Events），需要通过 ASGI 服务器访问
+    
+    浏览器的 EventSource 无法设置请求头，可以先通过 events/ticket/ 换取短期票据，再以 ?ticket= 传递。
+    """
+    error = _async_view_error(request)
+    if error:
+        return error
+    user = await _authenticated_user(request, allow_ticket=True)
+    if user is None:
+        return _event_error('AUTH_REQUIRED', '需要认证', status.HTTP_401_UNAUTHORIZED)
+    
+    # 断线重连时浏览器带上最后收到的通知ID
+    last_event_id = request.headers.get('Last-Event-ID')
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    
+    response = StreamingHttpResponse(
+        queue_event_stream(user, last_event_id), content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # 关闭反向代理的响应缓冲
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def wait_charging_request_status(request):
+    """长轮询当前充电请求状态，需要通过 ASGI 服务器访问
+    
+    客户端带上次返回的 version，请求状态变化或等待超时（timeout 秒）后返回；等待期间不占用数据库连接。
+    """
+    error = _async_view_error(request)
+    if error:
+        return error
+    user = await _authenticated_user(request)
+    if user is None:
+        return _event_error('AUTH_REQUIRED', '需要认证', status.HTTP_401_UNAUTHORIZED)
+    
+    try:
+        timeout = float(request.GET.get('timeout', LONG_POLL_TIMEOUT))
+    except ValueError:
+        timeout = -1
+    if not 0 <= timeout <= MAX_LONG_POLL_TIMEOUT:
+        return _event_error(
+            'VALIDATION_ERROR', f'timeout 必须在0到{MAX_LONG_POLL_TIMEOUT}秒之间', status.HTTP_400_BAD_REQUEST
+        )
+    
+    version, data, changed = await wait_for_request_change(user, request.GET.get('version') or None, timeout)
+    response = JsonResponse({
+        'success': True,
+        'data': {
+            'version': version,
+            'changed': changed,
+            'request': data
+        }
+    })
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+@api_view(['PUT'])
+@permission_classes([IsAdminUser])
+def update_pile_status(request, pile_id):
+    """修改充电桩状态API - 仅管理员可用（故障/恢复处理由进度守护进程根据状态事件执行）"""
+    new_status = request.data.get('status')
+    if new_status not in dict(ChargingPile.STATUS_CHOICES):
+        return Response({
+            'success': False,
+            'error': {
+                'code': 'INVALID_PARAMETER',
+                'message': '充电桩状态必须是 normal、fault 或 offline'
+            }
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        pile, event = AdvancedChargingQueueService().change_pile_status(
+            pile_id, new_status, source='api', reason=str(request.data.get('reason') or '')[:200]
+        )
+    except ChargingPile.DoesNotExist:
+        return Response({
+            'success': False,
+            'error': {
+                'code': 'RESOURCE_NOT_FOUND',
+                'message': '充电桩不存在'
+            }
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    return Response({
+        'success': True,
+        'data': {
+            'pile_id': pile.pile_id,
+            'status': pile.status,
+            'previous_status': event.from_status if event else pile.status,
+            'event_id': event.id if event else None
+        },
+        'message': '充电桩状态已更新' if event else '充电桩状态未变化'
+    })
+
 @api_view(['GET'])
+@conditional_on_version()
 def piles_status(request):
     """获取充电桩状态"""
-    fast_piles = ChargingPile.objects.filter(pile_type='fast')
-    slow_piles = ChargingPile.objects.filter(pile_type='slow')
+    # 一次预取所有桩正在充电的请求，查询数不随桩数增长
+    piles = list(ChargingPile.objects.with_queue_details())
+    fast_piles = [pile for pile in piles if pile.pile_type == 'fast']
+    slow_piles = [pile for pile in piles if pile.pile_type == 'slow']
     
     def get_pile_data(pile):
         current_user = None
         if pile.is_working:
-            current_request = ChargingRequest.objects.filter(
-                charging_pile=pile,
-                current_status='charging'
-            ).first()
+            current_request = pile.get_current_request()
             if current_request:
                 current_user = current_request.user.username
         
@@ -1145,6 +1326,30 @@ def bill_detail(request, bill_id):
         }
     })
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def bill_curve(request, bill_id):
+    """查看详单对应的充电曲线（管理员可查看所有用户的曲线）
+    
+    曲线整体存储在一个二进制块中，一次读取即可还原全部采样点，按列返回。
+    """
+    sessions = ChargingSession.objects.all() if request.user.is_staff else ChargingSession.objects.filter(user=request.user)
+    session = get_object_or_404(sessions.select_related('curve'), id=bill_id)
+    
+    buffer = session.curve.get_buffer() if hasattr(session, 'curve') else CurveBuffer()
+    return Response({
+        'success': True,
+        'data': {
+            'bill_id': str(session.id),
+            'start_time': session.start_time,
+            'sample_count': len(buffer),
+            'min_interval': buffer.min_interval,
+            'offsets': [round(offset, 1) for offset in buffer.offsets],
+            'amounts': [round(amount, 3) for amount in buffer.amounts],
+            'powers': [round(power, 2) for power in buffer.powers]
+        }
+    })
+
 # 通知相关视图
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -1178,40 +1383,16 @@ def mark_notification_read(request, notification_id):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@conditional_on_version(lambda request: user_snapshot_version(request.user))
 def active_charging_requests(request):
     """获取当前用户的所有活跃充电请求"""
     try:
-        charging_requests = ChargingRequest.objects.filter(
-            user=request.user,
-            current_status__in=['waiting', 'charging']
-        ).order_by('created_at')
-        
-        if not charging_requests.exists():
-            return Response({
-                'success': True,
-                'data': []
-            })
-        
-        # 为每个请求计算前面等待的数量和状态信息
-        results = []
-        for charging_request in charging_requests:
-            # 根据队列层级计算前面等待的数量
-            ahead_count = 0
-            if charging_request.queue_level == 'external_waiting':
-                ahead_count = charging_request.external_queue_position - 1
-            elif charging_request.queue_level == 'pile_queue':
-                ahead_count = charging_request.pile_queue_position - 1
-            
-            data = ChargingRequestSerializer(charging_request).data
-            data['ahead_count'] = ahead_count
-            data['queue_status'] = charging_request.get_queue_status_display()
-            data['queue_level'] = charging_request.queue_level
-            
-            results.append(data)
+        # 所有活跃请求连同车辆、充电桩和会话一次查询读出，前方人数由队列位置直接得出
+        charging_requests = ChargingRequest.objects.active_for(request.user)
         
         return Response({
             'success': True,
-            'data': results
+            'data': ActiveChargingRequestSerializer(charging_requests, many=True).data
         })
     except Exception as e:
         return Response({
@@ -171,8 +171,12 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'if-none-match',
 ]
 
+# 轮询接口的 ETag 需要暴露给前端脚本
+CORS_EXPOSE_HEADERS = ['etag']
+
 CORS_ALLOW_METHODS = [
     'DELETE',
     'GET',